@@ -6,6 +6,7 @@ from sqlalchemy import pool
 from alembic import context
 
 from database import db
+from alembic_env.online import LockReport
 
 from os import getenv
 from dotenv import load_dotenv
@@ -16,9 +17,8 @@ config = context.config
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
-# if config.config_file_name is not None:
-#     fileConfig(config.config_file_name)
-fileConfig(config.config_file_name)
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
@@ -76,13 +76,41 @@ def run_migrations_online() -> None:
         poolclass=pool.NullPool,
     )
 
-    with connectable.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata
-        )
+    # -x options (see alembic_env/online.py): alembic -x lock_timeout=5s -x dry_run=true upgrade head
+    x_arguments = context.get_x_argument(as_dictionary=True)
+    dry_run = x_arguments.get("dry_run", "").lower() in ("1", "true", "yes")
 
-        with context.begin_transaction():
-            context.run_migrations()
+    with connectable.connect() as connection:
+        if connection.dialect.name == "postgresql":
+            # Session settings: they also apply to the autocommit blocks (CREATE INDEX CONCURRENTLY, backfills).
+            # A migration that waits longer than lock_timeout for a lock fails, instead of blocking every query behind it
+            connection.exec_driver_sql(f"SET lock_timeout = '{x_arguments.get('lock_timeout', '5s')}'")
+            connection.exec_driver_sql(f"SET statement_timeout = '{x_arguments.get('statement_timeout', '0')}'")
+            connection.commit()
+        elif dry_run:
+            # SQLite commits DDL statements by itself: they would not be rolled back
+            raise SystemExit("The dry run needs PostgreSQL (transactional DDL)")
+
+        if not dry_run:
+            # One transaction per revision: a failed revision does not roll back the ones that were already applied
+            context.configure(connection=connection, target_metadata=target_metadata, transaction_per_migration=True)
+            with context.begin_transaction():
+                context.run_migrations()
+            return
+
+        # DRY RUN: the transaction is opened before configure, so Alembic runs every revision inside it (external
+        # transaction), and it is rolled back at the end
+        report = LockReport()
+        report.attach(connection)
+        connection.info["lock_report"] = report
+        transaction = connection.begin()
+        try:
+            context.configure(connection=connection, target_metadata=target_metadata)
+            with context.begin_transaction():
+                context.run_migrations()
+        finally:
+            transaction.rollback()
+        report.print(connection)
 
 
 if context.is_offline_mode():
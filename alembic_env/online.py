@@ -0,0 +1,218 @@
+import re, time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Sequence
+from alembic import op
+from sqlalchemy import event, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+
+"""
+ONLINE (LOCK-SAFE) MIGRATION HELPERS, for the revisions of alembic_env/versions:
+    from alembic_env import online
+
+- online.create_index_concurrently(...) / online.drop_index_concurrently(...)
+    PostgreSQL: CREATE/DROP INDEX CONCURRENTLY, outside the migration transaction (autocommit block). Writes on the table
+    are not blocked while the index is built. An INVALID index left by a failed build is dropped and built again
+- online.backfill(...)
+    UPDATE in batches of primary key ranges, each batch committed on its own (autocommit block), with progress and
+    a pause between batches, instead of one huge UPDATE that locks every row until the end of the migration
+- online.with_lock_retries(...)
+    Runs DDL that needs an ACCESS EXCLUSIVE lock (ALTER TABLE...) with a short lock_timeout inside a SAVEPOINT, and
+    retries it. Waiting for a lock queues every other query of the table behind the migration, failing fast does not
+- lock_timeout / statement_timeout of every migration: -x lock_timeout=5s -x statement_timeout=0 (see env.py)
+
+DRY RUN (against a LOCAL copy of the database):
+    alembic -x dry_run=true upgrade head
+Every statement is executed inside a transaction that is rolled back at the end, and a report prints the lock that each
+one takes, its table (and size), and how long it took. Concurrent indexes and backfills are not executed, their
+impact is estimated (rows to update, batches).
+"""
+
+# Statement pattern -> (lock mode on the table, what it blocks)
+LOCK_RULES = (
+    (r"^CREATE\s+(UNIQUE\s+)?INDEX\s+CONCURRENTLY", "SHARE UPDATE EXCLUSIVE", "nothing (other DDL only)"),
+    (r"^DROP\s+INDEX\s+CONCURRENTLY", "SHARE UPDATE EXCLUSIVE", "nothing (other DDL only)"),
+    (r"^CREATE\s+(UNIQUE\s+)?INDEX", "SHARE", "writes"),
+    (r"^(ALTER|DROP)\s+TABLE", "ACCESS EXCLUSIVE", "reads and writes"),
+    (r"^DROP\s+INDEX", "ACCESS EXCLUSIVE", "reads and writes"),
+    (r"^(UPDATE|DELETE|INSERT)", "ROW EXCLUSIVE", "writes of the same rows"),
+    (r"^CREATE\s+TABLE", "-", "nothing (new table)"),
+)
+TABLE_PATTERN = re.compile(r'\b(?:TABLE|ON|UPDATE|INTO|FROM)\s+(?:ONLY\s+)?(?:IF\s+(?:NOT\s+)?EXISTS\s+)?"?(\w+)"?', re.IGNORECASE)
+
+
+# The dry run (env.py) keeps its LockReport in the info of the migration connection
+def lock_report() -> "LockReport | None":
+    return op.get_bind().info.get("lock_report")
+
+
+def is_dry_run() -> bool:
+    return lock_report() is not None
+
+
+def is_postgresql() -> bool:
+    return op.get_bind().dialect.name == "postgresql"
+
+
+def classify(statement: str) -> tuple[str, str, str | None]:
+    # (lock mode, what it blocks, table)
+    sql = " ".join(statement.split()).lstrip("(")
+    table = TABLE_PATTERN.search(sql)
+    for pattern, lock, blocks in LOCK_RULES:
+        if re.match(pattern, sql, re.IGNORECASE):
+            return lock, blocks, table.group(1) if table else None
+    return "-", "-", table.group(1) if table else None
+
+
+class LockReport:
+    """
+    Records the statements executed on a connection (dry run). Notes are added by the helpers for the work that is
+    only estimated.
+    """
+
+    def __init__(self):
+        self.entries: list[dict] = []
+        self._started: dict[int, float] = {}
+
+    def attach(self, connection: Connection):
+        event.listen(connection, "before_cursor_execute", self._before)
+        event.listen(connection, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context_, executemany):
+        self._started[id(cursor)] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context_, executemany):
+        elapsed = time.perf_counter() - self._started.pop(id(cursor), time.perf_counter())
+        if statement.lstrip().upper().startswith(("SELECT", "SET", "SAVEPOINT", "RELEASE", "ROLLBACK", "PRAGMA", "SHOW")):
+            return
+        self.add(statement, elapsed * 1000)
+
+    def add(self, statement: str, elapsed_ms: float | None, note: str = ""):
+        lock, blocks, table = classify(statement)
+        self.entries.append({"statement": " ".join(statement.split())[:120], "lock": lock, "blocks": blocks,
+                             "table": table, "elapsed_ms": elapsed_ms, "note": note})
+
+    def print(self, connection: Connection):
+        print("\nDRY RUN: lock impact of the pending migrations (rolled back)")
+        for entry in self.entries:
+            elapsed = "estimated" if entry["elapsed_ms"] is None else f"{entry['elapsed_ms']:.1f} ms"
+            print(f"- [{entry['lock']}] blocks {entry['blocks']} | table {entry['table'] or '-'}"
+                  f"{table_size(connection, entry['table'])} | {elapsed}\n    {entry['statement']}")
+            if entry["note"]:
+                print(f"    {entry['note']}")
+
+
+def table_size(connection: Connection, table: str | None) -> str:
+    if table is None or connection.dialect.name != "postgresql":
+        return ""
+    row = connection.execute(
+        text("SELECT reltuples::bigint AS rows, pg_total_relation_size(oid) AS bytes FROM pg_class WHERE relname = :table AND relkind = 'r'"),
+        {"table": table},
+    ).first()
+    return "" if row is None else f" (~{max(row.rows, 0)} rows, {row.bytes // 1024} KiB)"
+
+
+def dry_run_note(statement: str, note: str):
+    report = lock_report()
+    if report is not None:
+        report.add(statement, None, note)
+
+
+@contextmanager
+def timeouts(lock_timeout: str | None = None, statement_timeout: str | None = None):
+    # SET LOCAL only lasts until the end of the current transaction (PostgreSQL)
+    if is_postgresql():
+        if lock_timeout is not None:
+            op.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        if statement_timeout is not None:
+            op.execute(f"SET LOCAL statement_timeout = '{statement_timeout}'")
+    yield
+
+
+def with_lock_retries(operation: Callable[[], None], attempts: int = 5, lock_timeout: str = "2s", backoff_seconds: float = 1.0):
+    if not is_postgresql():
+        operation()
+        return
+    connection = op.get_bind()
+    for attempt in range(1, attempts + 1):
+        savepoint = connection.begin_nested()
+        try:
+            with timeouts(lock_timeout=lock_timeout):
+                operation()
+            savepoint.commit()
+            return
+        except OperationalError as err:
+            savepoint.rollback()
+            # 55P03: lock_not_available. Any other error is not retried
+            if getattr(err.orig, "pgcode", None) != "55P03" or attempt == attempts:
+                raise
+            print(f"Lock not available (attempt {attempt}/{attempts}), retrying in {backoff_seconds * attempt:.1f} s")
+            time.sleep(backoff_seconds * attempt)
+
+
+def create_index_concurrently(index_name: str, table_name: str, columns: Sequence[str], unique: bool = False, **kwargs):
+    if not is_postgresql():
+        op.create_index(index_name, table_name, list(columns), unique=unique, **kwargs)
+        return
+
+    statement = f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY {index_name} ON {table_name} ({', '.join(columns)})"
+    if is_dry_run():
+        dry_run_note(statement, "Not executed: CONCURRENTLY cannot run inside the dry-run transaction. It does not block writes")
+        return
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction: the migration transaction is committed before it
+    with op.get_context().autocommit_block():
+        invalid = op.get_bind().execute(text(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "WHERE pg_class.relname = :index AND NOT pg_index.indisvalid"
+        ), {"index": index_name}).first()
+        if invalid is not None:
+            # Left by a build that failed or was interrupted: it is not used by queries, but it is updated by writes
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True)
+        op.create_index(index_name, table_name, list(columns), unique=unique, postgresql_concurrently=True,
+                        if_not_exists=True, **kwargs)
+
+
+def drop_index_concurrently(index_name: str, table_name: str):
+    if not is_postgresql():
+        op.drop_index(index_name, table_name=table_name)
+        return
+    if is_dry_run():
+        dry_run_note(f"DROP INDEX CONCURRENTLY {index_name}", "Not executed: it does not block reads nor writes")
+        return
+    with op.get_context().autocommit_block():
+        op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+
+
+def backfill(table_name: str, set_clause: str, where: str = "1 = 1", batch_size: int = 1000, pause_seconds: float = 0.1,
+             key: str = "id", progress: Callable[[int, int], None] | None = None) -> int:
+    """
+    UPDATE <table_name> SET <set_clause> WHERE <where>, in batches of <batch_size> consecutive keys.
+    The WHERE clause should be false for the rows that were already updated, so an interrupted backfill can be resumed.
+    """
+    connection = op.get_bind()
+    bounds = connection.execute(text(f"SELECT MIN({key}), MAX({key}) FROM {table_name} WHERE {where}")).first()
+    pending = connection.execute(text(f"SELECT COUNT(*) FROM {table_name} WHERE {where}")).scalar()
+    statement = f"UPDATE {table_name} SET {set_clause} WHERE {key} >= :start AND {key} < :end AND ({where})"
+    if bounds[0] is None:
+        return 0
+    if is_dry_run():
+        batches = -(-(bounds[1] - bounds[0] + 1) // batch_size)
+        dry_run_note(statement, f"Not executed: {pending} rows in {batches} batches (<= {batch_size} rows locked at a time), "
+                                f"~{batches * pause_seconds:.0f} s of pauses")
+        return 0
+
+    progress = progress or (lambda done, total: print(f"Backfill {table_name}: {done}/{total} rows"))
+    updated = 0
+    # PostgreSQL: every batch is committed on its own (and its row locks released), outside the migration transaction.
+    # Alembic has no autocommit blocks for databases without transactional DDL (SQLite): the batches run as they are
+    with op.get_context().autocommit_block() if is_postgresql() else nullcontext():
+        start = bounds[0]
+        while start <= bounds[1]:
+            result = connection.execute(text(statement), {"start": start, "end": start + batch_size})
+            updated += result.rowcount
+            progress(updated, pending)
+            start += batch_size
+            if pause_seconds:
+                time.sleep(pause_seconds)
+    return updated
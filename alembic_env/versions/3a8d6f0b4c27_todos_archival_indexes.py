@@ -0,0 +1,40 @@
+"""Adding the partial indexes of the archival job
+
+Revision ID: 3a8d6f0b4c27
+Revises: e2f7b5c30a91
+Create Date: 2026-10-20 17:25:19.640833
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from alembic_env import online
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3a8d6f0b4c27'
+down_revision: Union[str, Sequence[str], None] = 'e2f7b5c30a91'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Same predicates as database/models.py (COMPLETED_TODOS, DELETED_TODOS)
+COMPLETED_TODOS = "completed"
+DELETED_TODOS = "deleted_at IS NOT NULL"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    online.create_index_concurrently('ix_todos_completed_updated_at', 'todos', ['updated_at', 'id'],
+                                     sqlite_where=sa.text(COMPLETED_TODOS),
+                                     postgresql_where=sa.text(COMPLETED_TODOS))
+    online.create_index_concurrently('ix_todos_deleted_at', 'todos', ['deleted_at', 'id'],
+                                     sqlite_where=sa.text(DELETED_TODOS),
+                                     postgresql_where=sa.text(DELETED_TODOS))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    online.drop_index_concurrently('ix_todos_deleted_at', 'todos')
+    online.drop_index_concurrently('ix_todos_completed_updated_at', 'todos')
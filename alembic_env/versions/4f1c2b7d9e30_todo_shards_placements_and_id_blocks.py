@@ -0,0 +1,43 @@
+"""Adding todo_shard_placements and id_blocks tables (todos sharding)
+
+Revision ID: 4f1c2b7d9e30
+Revises: 88dc7b20926b
+Create Date: 2026-10-19 14:12:37.418093
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4f1c2b7d9e30'
+down_revision: Union[str, Sequence[str], None] = '88dc7b20926b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Only in the primary database. The shards get their todos tables from ShardRouter.create_tables (database/shards.py)
+    op.create_table(
+        'todo_shard_placements',
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('shard', sa.String(), nullable=False),
+        sa.Column('moving', sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('owner_id'),
+    )
+    op.create_table(
+        'id_blocks',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('next_value', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('id_blocks')
+    op.drop_table('todo_shard_placements')
@@ -0,0 +1,41 @@
+"""Adding todo due dates and recurrence
+
+Revision ID: 5d2e8f1a7c94
+Revises: c41e7a9b3f06
+Create Date: 2026-10-19 23:41:27.902164
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from alembic_env import online
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2e8f1a7c94'
+down_revision: Union[str, Sequence[str], None] = 'c41e7a9b3f06'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Same predicate as database/models.py (PENDING_DUE_TODOS)
+PENDING_DUE_TODOS = "due_at IS NOT NULL AND deleted_at IS NULL AND NOT completed"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Nullable columns without default: no table rewrite, only a short ACCESS EXCLUSIVE lock (retried if not available)
+    online.with_lock_retries(lambda: op.add_column('todos', sa.Column('due_at', sa.DateTime(timezone=True), nullable=True)))
+    online.with_lock_retries(lambda: op.add_column('todos', sa.Column('recurrence', sa.String(), nullable=True)))
+    # Every due_at is NULL: the partial index is empty when it is created
+    online.create_index_concurrently('ix_todos_pending_due_at', 'todos', ['due_at', 'id'],
+                                     sqlite_where=sa.text(PENDING_DUE_TODOS),
+                                     postgresql_where=sa.text(PENDING_DUE_TODOS))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    online.drop_index_concurrently('ix_todos_pending_due_at', 'todos')
+    op.drop_column('todos', 'recurrence')
+    op.drop_column('todos', 'due_at')
@@ -0,0 +1,78 @@
+"""Numbering the todos without change sequence (paged first sync)
+
+Revision ID: 7b3d9e2f6a15
+Revises: 5d2e8f1a7c94
+Create Date: 2026-10-20 10:12:53.480217
+
+"""
+from contextlib import nullcontext
+from typing import Sequence, Union
+
+from alembic import op
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from alembic_env import online
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b3d9e2f6a15'
+down_revision: Union[str, Sequence[str], None] = '5d2e8f1a7c94'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+
+def reserve(connection, owner_id: int, count: int) -> int:
+    # First of <count> new change numbers of the owner, like utils/todo_changes.py reserve()
+    last_seq = connection.execute(
+        text("UPDATE todo_change_counters SET last_seq = last_seq + :count WHERE owner_id = :owner_id RETURNING last_seq"),
+        {"owner_id": owner_id, "count": count},
+    ).scalar()
+    if last_seq is not None:
+        return last_seq - count + 1
+    try:
+        connection.execute(text("INSERT INTO todo_change_counters (owner_id, last_seq) VALUES (:owner_id, :count)"),
+                           {"owner_id": owner_id, "count": count})
+        return 1
+    except IntegrityError:
+        # The first change of the owner was committed meanwhile
+        return reserve(connection, owner_id, count)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # The first sync (GET /todo/changes?since=0) is paged by change_seq: the todos that kept NULL since e9b14c7a3d62 get
+    # the next numbers of their owner, BATCH_SIZE at a time (committed on their own on PostgreSQL). Their numbers
+    # may be below a token already given: those clients got them with their first sync, and their content did not change
+    connection = op.get_bind()
+    select_legacy = "SELECT id FROM todos WHERE owner_id = :owner_id AND change_seq IS NULL ORDER BY id LIMIT :limit"
+    if online.is_dry_run():
+        pending = connection.execute(text("SELECT COUNT(*) FROM todos WHERE change_seq IS NULL AND owner_id IS NOT NULL")).scalar()
+        online.dry_run_note("UPDATE todos SET change_seq = ...", f"Not executed: {pending} todos, {BATCH_SIZE} at a time")
+        return
+
+    with op.get_context().autocommit_block() if online.is_postgresql() else nullcontext():
+        owners = connection.execute(text(
+            "SELECT DISTINCT owner_id FROM todos WHERE change_seq IS NULL AND owner_id IS NOT NULL ORDER BY owner_id"
+        )).scalars().all()
+        for owner_id in owners:
+            while True:
+                ids = connection.execute(text(select_legacy), {"owner_id": owner_id, "limit": BATCH_SIZE}).scalars().all()
+                if not ids:
+                    break
+                # Interrupted between the two: the numbers reserved are not used (a gap), the todos stay NULL and are
+                # numbered when the migration is run again
+                first = reserve(connection, owner_id, len(ids))
+                connection.execute(
+                    text("UPDATE todos SET change_seq = :change_seq WHERE id = :todo_id AND change_seq IS NULL"),
+                    [{"change_seq": first + offset, "todo_id": todo_id} for offset, todo_id in enumerate(ids)],
+                )
+            print(f"Numbered the todos of owner {owner_id}")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # Nothing to undo: the numbers are valid change numbers
+    pass
@@ -0,0 +1,53 @@
+"""Adding soft delete columns to todos and the todos_archive table
+
+Revision ID: 88dc7b20926b
+Revises: 850ea21b99cd
+Create Date: 2026-10-19 12:21:07.118520
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '88dc7b20926b'
+down_revision: Union[str, Sequence[str], None] = '850ea21b99cd'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('todos', sa.Column('created_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('todos', sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('todos', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+    # Existing todos start their archival countdown now
+    op.execute("UPDATE todos SET created_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP")
+
+    op.create_table(
+        'todos_archive',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(), nullable=True),
+        sa.Column('description', sa.String(), nullable=True),
+        sa.Column('priority', sa.Integer(), nullable=True),
+        sa.Column('completed', sa.Boolean(), nullable=True),
+        sa.Column('owner_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('archived_at', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_todos_archive_owner_id_id', 'todos_archive', ['owner_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_todos_archive_owner_id_id', table_name='todos_archive')
+    op.drop_table('todos_archive')
+    op.drop_column('todos', 'deleted_at')
+    op.drop_column('todos', 'updated_at')
+    op.drop_column('todos', 'created_at')
@@ -0,0 +1,34 @@
+"""Adding revoked_at to revoked_access_tokens (overlapping denylist fetches)
+
+Revision ID: 9c6a4e1d2b83
+Revises: 7b3d9e2f6a15
+Create Date: 2026-10-20 14:37:05.118402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from alembic_env import online
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c6a4e1d2b83'
+down_revision: Union[str, Sequence[str], None] = '7b3d9e2f6a15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Nullable column without default: no table rewrite, only a short ACCESS EXCLUSIVE lock (retried if not available).
+    # The existing rows stay NULL: they are read by the first fetch of every worker (every revocation not expired yet)
+    online.with_lock_retries(lambda: op.add_column('revoked_access_tokens', sa.Column('revoked_at', sa.DateTime(timezone=True), nullable=True)))
+    online.create_index_concurrently('ix_revoked_access_tokens_revoked_at', 'revoked_access_tokens', ['revoked_at'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    online.drop_index_concurrently('ix_revoked_access_tokens_revoked_at', 'revoked_access_tokens')
+    op.drop_column('revoked_access_tokens', 'revoked_at')
@@ -0,0 +1,47 @@
+"""Adding todo positions (manual ordering)
+
+Revision ID: a6f0d2c8e519
+Revises: e9b14c7a3d62
+Create Date: 2026-10-19 21:04:12.318520
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from alembic_env import online
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6f0d2c8e519'
+down_revision: Union[str, Sequence[str], None] = 'e9b14c7a3d62'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Same predicate as database/models.py (MAX_POSITION_LENGTH = 24)
+POSITIONS_TO_REBALANCE = "length(position) > 24 OR position IS NULL"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Nullable column without default: no table rewrite, only a short ACCESS EXCLUSIVE lock (retried if not available)
+    online.with_lock_retries(lambda: op.add_column(
+        'todos', sa.Column('position', sa.String().with_variant(sa.String(collation='C'), 'postgresql'), nullable=True)
+    ))
+    # The existing todos keep their order (by id): "m" + 13 decimal digits is a valid rank key (see utils/ranks.py),
+    # with room for new todos after it. The rebalance job shortens them later.
+    # The todos created by the old code during the deploy stay NULL: the rebalance job puts them at the end
+    padded_id = "lpad(CAST(id AS TEXT), 13, '0')" if online.is_postgresql() else "substr('0000000000000' || id, -13, 13)"
+    online.backfill('todos', f"position = 'm' || {padded_id}", where="position IS NULL")
+    online.create_index_concurrently('ix_todos_owner_id_position', 'todos', ['owner_id', 'position', 'id'])
+    online.create_index_concurrently('ix_todos_positions_to_rebalance', 'todos', ['owner_id', 'position'],
+                                     sqlite_where=sa.text(POSITIONS_TO_REBALANCE),
+                                     postgresql_where=sa.text(POSITIONS_TO_REBALANCE))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    online.drop_index_concurrently('ix_todos_positions_to_rebalance', 'todos')
+    online.drop_index_concurrently('ix_todos_owner_id_position', 'todos')
+    op.drop_column('todos', 'position')
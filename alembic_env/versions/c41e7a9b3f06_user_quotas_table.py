@@ -0,0 +1,35 @@
+"""Adding user_quotas table
+
+Revision ID: c41e7a9b3f06
+Revises: a6f0d2c8e519
+Create Date: 2026-10-19 22:37:05.724913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41e7a9b3f06'
+down_revision: Union[str, Sequence[str], None] = 'a6f0d2c8e519'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'user_quotas',
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('max_todos', sa.Integer(), nullable=True),
+        sa.Column('writes_per_minute', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('owner_id'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('user_quotas')
@@ -0,0 +1,31 @@
+"""Adding the (owner_id, id) index to todos
+
+Revision ID: d3a8c61f2b47
+Revises: b7e2d4a91c58
+Create Date: 2026-10-19 17:42:10.305218
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from alembic_env import online
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3a8c61f2b47'
+down_revision: Union[str, Sequence[str], None] = 'b7e2d4a91c58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY (PostgreSQL): "todos" is the busiest table, its writes must not wait for the index build
+    online.create_index_concurrently('ix_todos_owner_id_id', 'todos', ['owner_id', 'id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    online.drop_index_concurrently('ix_todos_owner_id_id', 'todos')
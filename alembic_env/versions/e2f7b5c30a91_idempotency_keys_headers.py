@@ -0,0 +1,32 @@
+"""Adding the response headers to idempotency_keys
+
+Revision ID: e2f7b5c30a91
+Revises: 9c6a4e1d2b83
+Create Date: 2026-10-20 16:02:41.557390
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from alembic_env import online
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2f7b5c30a91'
+down_revision: Union[str, Sequence[str], None] = '9c6a4e1d2b83'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Nullable column without default: no table rewrite, only a short ACCESS EXCLUSIVE lock (retried if not available).
+    # The responses saved before keep NULL: they are replayed with their Content-Type only (see utils/idempotency.py)
+    online.with_lock_retries(lambda: op.add_column('idempotency_keys', sa.Column('headers', sa.JSON(), nullable=True)))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('idempotency_keys', 'headers')
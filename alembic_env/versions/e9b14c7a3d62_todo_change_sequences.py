@@ -0,0 +1,46 @@
+"""Adding todo change sequences (delta sync)
+
+Revision ID: e9b14c7a3d62
+Revises: d3a8c61f2b47
+Create Date: 2026-10-19 18:26:47.591034
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from alembic_env import online
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e9b14c7a3d62'
+down_revision: Union[str, Sequence[str], None] = 'd3a8c61f2b47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'todo_change_counters',
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('last_seq', sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('owner_id'),
+    )
+    # Nullable columns without default: no table rewrite, only a short ACCESS EXCLUSIVE lock (retried if not available).
+    # Existing todos keep NULL until their next change, the first sync (since=0) returns them anyway
+    online.with_lock_retries(lambda: op.add_column('todos', sa.Column('change_seq', sa.BigInteger(), nullable=True)))
+    online.with_lock_retries(lambda: op.add_column('todos_archive', sa.Column('change_seq', sa.BigInteger(), nullable=True)))
+    online.create_index_concurrently('ix_todos_owner_id_change_seq', 'todos', ['owner_id', 'change_seq'])
+    online.create_index_concurrently('ix_todos_archive_owner_id_change_seq', 'todos_archive', ['owner_id', 'change_seq'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    online.drop_index_concurrently('ix_todos_archive_owner_id_change_seq', 'todos_archive')
+    online.drop_index_concurrently('ix_todos_owner_id_change_seq', 'todos')
+    op.drop_column('todos_archive', 'change_seq')
+    op.drop_column('todos', 'change_seq')
+    op.drop_table('todo_change_counters')
@@ -0,0 +1,89 @@
+"""
+GROUP COMMIT BENCHMARK (todo inserts under burst load)
+    python benchmarks/group_commit.py [--rows 2000] [--concurrency 100] [--max-rows 100] [--max-delay-ms 5]
+
+Inserts --rows todos with --concurrency concurrent "requests", in two modes:
+1. One commit per request: what create_todo does by default (a session, add, commit, in a thread)
+2. Group commit: TodoInsertBatcher (utils/group_commit.py), as create_todo does with TODO_GROUP_COMMIT=true
+and prints the throughput, the latency percentiles and the batch statistics of each mode.
+
+The database is POSTGRESQL_DB_URI (the tables are created if needed and the inserted rows are deleted afterwards),
+or a temporary SQLite database when it is not set. The fsync cost, and so the gain, is only realistic on PostgreSQL.
+"""
+import argparse, asyncio, os, statistics, sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import delete
+from database import db, models
+from utils.group_commit import TodoInsertBatcher
+
+BENCHMARK_TITLE = "group-commit-benchmark"
+
+
+def todo_values(index: int) -> dict:
+    return {"title": BENCHMARK_TITLE, "description": f"Todo {index}", "priority": 1, "completed": False, "owner_id": None}
+
+
+async def run_requests(insert_one, rows: int, concurrency: int) -> tuple[float, list[float]]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def request(index: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await insert_one(index)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request(index) for index in range(rows)))
+    return time.perf_counter() - start, latencies
+
+
+def report(name: str, rows: int, elapsed: float, latencies: list[float]):
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(f"{name}: {rows / elapsed:,.0f} rows/s ({elapsed:.2f} s), "
+          f"latency p50 {percentiles[49] * 1000:.1f} ms, p99 {percentiles[98] * 1000:.1f} ms")
+
+
+async def benchmark(engine, args):
+    session_factory = db.create_session_factory(engine)
+
+    def commit_one(index: int):
+        with session_factory() as session:
+            session.add(models.Todos(**todo_values(index)))
+            session.commit()
+
+    elapsed, latencies = await run_requests(lambda index: asyncio.to_thread(commit_one, index), args.rows, args.concurrency)
+    report("one commit per request", args.rows, elapsed, latencies)
+
+    batcher = TodoInsertBatcher(args.max_rows, args.max_delay_ms)
+    batcher.start()
+    elapsed, latencies = await run_requests(lambda index: batcher.submit(engine, todo_values(index)), args.rows, args.concurrency)
+    await batcher.close()
+    report("group commit          ", args.rows, elapsed, latencies)
+    print("group commit stats:", batcher.stats.as_dict())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--max-rows", type=int, default=100)
+    parser.add_argument("--max-delay-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = db.create_db_engine(os.getenv("POSTGRESQL_DB_URI", f"sqlite:///{tmp}/benchmark.db"))
+        db.Base.metadata.create_all(bind=engine)
+        try:
+            asyncio.run(benchmark(engine, args))
+        finally:
+            with engine.begin() as connection:
+                connection.execute(delete(models.Todos).where(models.Todos.title == BENCHMARK_TITLE))
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+STARTUP BENCHMARK (worker cold start)
+    python benchmarks/startup.py [--runs 5] [--top 15]
+
+1. Import time of "main", measured with: python -X importtime -c "import main"
+   Prints the total time and the slowest modules (cumulative time, including their own imports)
+2. Time to first 200: starts a fresh "uvicorn main:create_app --factory" process and polls GET /healthy until it
+   returns 200 (interpreter start + imports + app creation + lifespan startup + first request)
+
+If POSTGRESQL_DB_URI / SECRET_KEY are not set, a temporary SQLite database and a random secret are used.
+The import time budget is enforced by test/test_main.py (STARTUP_IMPORT_BUDGET_MS).
+"""
+import argparse, os, secrets, socket, statistics, subprocess, sys, tempfile, time, urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_times(module: str = "main") -> dict[str, int]:
+    # -X importtime writes one line per imported module to stderr: "import time: self [us] | cumulative | package"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_200(env: dict, timeout: float = 30.0) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:create_app", "--factory", "--port", str(port), "--log-level", "warning"],
+                              cwd=ROOT, env=env)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthy", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.005)
+        raise TimeoutError("The server did not answer GET /healthy")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    totals = [run["main"] / 1000 for run in runs]
+    print(f"import main: median {statistics.median(totals):.1f} ms (min {min(totals):.1f}, max {max(totals):.1f}, runs {args.runs})")
+    print(f"\nSlowest modules (cumulative, last run):")
+    for name, cumulative in sorted(runs[-1].items(), key=lambda item: item[1], reverse=True)[1:args.top + 1]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    env = dict(os.environ)
+    with tempfile.TemporaryDirectory() as tmp:
+        env.setdefault("POSTGRESQL_DB_URI", f"sqlite:///{tmp}/startup.db")
+        env.setdefault("SECRET_KEY", secrets.token_hex(32))
+        first_200 = [time_to_first_200(env) * 1000 for _ in range(args.runs)]
+    print(f"\ntime to first 200 (GET /healthy): median {statistics.median(first_200):.1f} ms "
+          f"(min {min(first_200):.1f}, max {max(first_200):.1f}, runs {args.runs})")
+
+
+if __name__ == "__main__":
+    main()
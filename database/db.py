@@ -1,34 +1,136 @@
-import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
-from dotenv import load_dotenv
+import time, threading
+from fastapi import Request
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
 
-load_dotenv()
+# Engines and sessions are created per application instance (see create_app in main.py), not at import time.
+# Each app keeps them in app.state.engine, app.state.session_factory and app.state.db_router
 
-POSTGRESQL_DB_URI = os.getenv("POSTGRESQL_DB_URI")
+# CONNECTION POOL (per engine, per process): pool_size connections are kept open, up to max_overflow more are opened
+# under load (and closed when they are returned). A request waits up to pool_timeout seconds for a free connection.
+# With several worker processes, serve.py sizes them so all the workers stay under the connection limit of the database
+def create_db_engine(database_uri: str, pool_size: int = 5, max_overflow: int = 10, pool_timeout: float = 30) -> Engine:
+    if make_url(database_uri).get_backend_name() == "sqlite":
+        # allowing multiple threads to connect to our database
+        return create_engine(database_uri, connect_args={"check_same_thread": False})
 
-# engine = create_engine(SQLALCHEMY_DATABASE_URI, connect_args={"check_same_thread": False}) # allowing multiple threads to connect to our database
+    # Changing the timezone of the connection in SQLAlchemy to UTC, the reason:
+    # - Each PostgreSQL connection has an associated time zone that defaults to the system's time zone
+    # - Although the timezone is stored correctly in UTC, if we don't do this, when retrieving the timestamp, it will be
+    #   returned as a naive datetime in the system's time zone
+    return create_engine(database_uri, connect_args={"options": "-c timezone=UTC"},
+                         pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout)
 
-# We are going to bind this engine to the Base, using Base.metadata.create_all(bind=engine), creating the database tables
-# Changing the timezone of the connection in SQLAlchemy to UTC, the reason:
-# - Each PostgreSQL connection has an associated time zone that defaults to the system's time zone
-# - Although the timezone is stored correctly in UTC, if we don't do this, when retrieving the timestamp, it will be
-#   returned as a naive datetime in the system's time zone
-engine = create_engine(POSTGRESQL_DB_URI, connect_args={"options": "-c timezone=UTC"})
 
-# Autocommit dictates whether individual SQL statements are automatically committed to the database.
-# Autoflush dictates whether in-memory object changes are automatically written to the database connection before queries, ensuring data consistency within a transaction.
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def create_app_engine(database_uri: str, settings) -> Engine:
+    # Engine of the app (primary, replicas, shards), with the pool of its settings
+    return create_db_engine(database_uri, settings.db_pool_size, settings.db_max_overflow, settings.db_pool_timeout_seconds)
 
-# The binding with our engine and its creation occurs in main.py with:
-# Base.metadata.create_all(bind=engine)
+
+def create_session_factory(engine: Engine) -> sessionmaker:
+    # Autocommit dictates whether individual SQL statements are automatically committed to the database.
+    # Autoflush dictates whether in-memory object changes are automatically written to the database connection before queries, ensuring data consistency within a transaction.
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+# We are going to bind an engine to the Base, using Base.metadata.create_all(bind=engine), creating the database tables
+# The binding with the app engine and its creation occurs at the startup of the app (see main.py lifespan)
 Base = declarative_base()
 
-# DEPENDENCY FUNCTION
+
+"""
+READ REPLICAS
+- Writes (and reads that must be consistent with them) use the PRIMARY: get_db
+- Read-only routes use a REPLICA: get_read_db. Replicas are picked round-robin, or by least checked-out connections
+- READ-YOUR-WRITES: replication is asynchronous, so after a request writes, the client gets a 'read_primary_until'
+  cookie, and its reads go to the primary during read_your_writes_seconds (Settings). The cookie works across workers
+- Without replicas, get_read_db is the same as get_db
+"""
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+
+class DatabaseRouter:
+    def __init__(self, primary: Engine, replicas: list[Engine] | None = None, policy: str = "round_robin", sticky_seconds: float = 5):
+        self.primary = primary
+        self.replicas = replicas or []
+        self.policy = policy
+        self.sticky_seconds = sticky_seconds
+        self.primary_sessions = create_session_factory(primary)
+        self.replica_sessions = [create_session_factory(replica) for replica in self.replicas]
+        self._next = 0
+        self._lock = threading.Lock()
+
+        # Any INSERT/UPDATE/DELETE (ORM flush or bulk statement) on a primary session marks its request as a writer
+        event.listen(self.primary_sessions, "after_flush", self._mark_write)
+        event.listen(self.primary_sessions, "do_orm_execute", self._mark_bulk_write)
+
+    @staticmethod
+    def _mark_write(session: Session, *args):
+        request = session.info.get("request")
+        if request is not None:
+            request.state.db_wrote = True
+
+    @classmethod
+    def _mark_bulk_write(cls, orm_execute_state):
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            cls._mark_write(orm_execute_state.session)
+
+    def replica_index(self) -> int:
+        if self.policy == "least_connections":
+            # Pools that don't count their connections (e.g. SQLite in memory) are considered idle
+            return min(range(len(self.replicas)), key=lambda index: getattr(self.replicas[index].pool, "checkedout", lambda: 0)())
+        with self._lock:
+            index = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+        return index
+
+    def read_session(self, request: Request | None = None) -> Session:
+        if not self.replicas or (request is not None and self.is_sticky(request)):
+            return self.primary_sessions()
+        return self.replica_sessions[self.replica_index()]()
+
+    def is_sticky(self, request: Request) -> bool:
+        try:
+            return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def dispose(self):
+        for engine in (self.primary, *self.replicas):
+            engine.dispose()
+
+
+# MIDDLEWARE (only registered when there are replicas): after a request that wrote, its client reads from the primary
+async def read_your_writes(request: Request, call_next):
+    response = await call_next(request)
+    if getattr(request.state, "db_wrote", False):
+        router: DatabaseRouter = request.app.state.db_router
+        response.set_cookie(
+            key=READ_PRIMARY_COOKIE,
+            value=f"{time.time() + router.sticky_seconds:.3f}",
+            max_age=max(1, int(router.sticky_seconds)),
+            samesite='strict',
+            httponly=True,
+        )
+    return response
+
+
+# DEPENDENCY FUNCTIONS
 # When the function is invoked by FastAPI, the returned value is provided to the route handler
-def get_db():
-    database_session = SessionLocal() # getting the Session object, that is bound to our db.engine
+def get_db(request: Request):
+    database_session = request.app.state.session_factory() # getting the Session object, that is bound to the primary engine of this app
+    database_session.info["request"] = request
+    try:
+        yield database_session
+    finally:
+        database_session.close()
+
+
+# Read-only routes. The session may be bound to a replica, so it must not be used to write
+def get_read_db(request: Request):
+    database_session = request.app.state.db_router.read_session(request)
     try:
         yield database_session
     finally:
-        database_session.close()
\ No newline at end of file
+        database_session.close()
@@ -1,6 +1,9 @@
+import uuid
+from datetime import datetime, timezone
 from database import db
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
-from pydantic import BaseModel, Field
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Uuid, Index, BigInteger, LargeBinary, JSON, text
+from pydantic import BaseModel, Field, field_validator, model_validator
+from utils import recurrence as recurrence_rules
 
 ### USERS ###
 class Users(db.Base):
@@ -65,36 +68,92 @@ class UserPhoneValidator(BaseModel):
     phone_number: str | None
 
 ### TOKENS ###
+# One row per SESSION (refresh token family), not per refresh token:
+# - Every refresh token carries its family id ('fid' claim) and a unique 'jti' claim
+# - Rotation updates the jti of the family row, instead of deleting a row and inserting a new one
+# - A refresh token whose jti is not the current one of its family was already used (REUSE): the family is revoked
+# - Revoking a session (or all sessions of a user) is a single indexed DELETE statement
 class RefreshTokens(db.Base):
     __tablename__ = "refresh_tokens"
-    id = Column(Integer, primary_key=True, index=True)
+    family_id = Column(Uuid, primary_key=True)
     user_id: int = Column(Integer, ForeignKey('users.id'), index=True)
-    refresh_token = Column(String, index=True, unique=True)
+    jti = Column(Uuid, nullable=False) # jti of the only valid refresh token of the family
+    created_at = Column(DateTime(timezone=True))
+    rotated_at = Column(DateTime(timezone=True))
     expires_at = Column(DateTime(timezone=True))
 
     """
     SQLITE3 SCHEMA:
     CREATE TABLE refresh_tokens (
-        id INTEGER NOT NULL,
+        family_id CHAR(32) NOT NULL,
         user_id INTEGER,
-        refresh_token VARCHAR,
+        jti CHAR(32) NOT NULL,
+        created_at DATETIME,
+        rotated_at DATETIME,
         expires_at DATETIME,
-        PRIMARY KEY (id),
+        PRIMARY KEY (family_id),
         FOREIGN KEY(user_id) REFERENCES users (id)
     );
-    CREATE INDEX ix_refresh_tokens_id ON refresh_tokens (id);
-    CREATE UNIQUE INDEX ix_refresh_tokens_refresh_token ON refresh_tokens (refresh_token);
     CREATE INDEX ix_refresh_tokens_user_id ON refresh_tokens (user_id);
     """
 
 
+# Authoritative store of the revoked ACCESS TOKENS (see utils/denylist.py). Rows are useless once the token expires
+class RevokedAccessTokens(db.Base):
+    __tablename__ = "revoked_access_tokens"
+    id = Column(Integer, primary_key=True)
+    jti = Column(Uuid, nullable=False)
+    expires_at = Column(DateTime(timezone=True), index=True)
+    # The workers fetch the revocations of the last minutes by this time, not by id: the ids of concurrent inserts are
+    # not committed in their order (see utils/denylist.py)
+    revoked_at = Column(DateTime(timezone=True), index=True)
+
+    """
+    SQLITE3 SCHEMA:
+    CREATE TABLE revoked_access_tokens (
+        id INTEGER NOT NULL,
+        jti CHAR(32) NOT NULL,
+        expires_at DATETIME,
+        revoked_at DATETIME,
+        PRIMARY KEY (id)
+    );
+    CREATE INDEX ix_revoked_access_tokens_expires_at ON revoked_access_tokens (expires_at);
+    CREATE INDEX ix_revoked_access_tokens_revoked_at ON revoked_access_tokens (revoked_at);
+    """
+
+
+class SessionResponse(BaseModel):
+    family_id: uuid.UUID
+    user_id: int
+    created_at: datetime
+    rotated_at: datetime | None
+    expires_at: datetime
+
+    model_config = {"from_attributes": True}
+
+
 class TokenResponse(BaseModel):
     message: str
     access_token: str
     token_type: str
 
 
-### USERS ###
+### TODOS ###
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+# MANUAL ORDERING (see utils/ranks.py): longer positions are shortened by the rebalance job.
+# It is part of the predicate of the partial index ix_todos_positions_to_rebalance: changing it needs a migration
+MAX_POSITION_LENGTH = 24
+POSITIONS_TO_REBALANCE = f"length(position) > {MAX_POSITION_LENGTH} OR position IS NULL"
+# DUE-TIME SCHEDULER (see utils/scheduler.py): the todos that can still become due. Predicate of the partial index
+# ix_todos_pending_due_at (same rule: changing it needs a migration)
+PENDING_DUE_TODOS = "due_at IS NOT NULL AND deleted_at IS NULL AND NOT completed"
+# ARCHIVAL JOB (see utils/archiver.py): predicates of the partial indexes ix_todos_completed_updated_at and
+# ix_todos_deleted_at (same rule: changing them needs a migration)
+COMPLETED_TODOS = "completed"
+DELETED_TODOS = "deleted_at IS NOT NULL"
+
 class Todos(db.Base):
     __tablename__ = "todos"
 
@@ -105,6 +164,40 @@ class Todos(db.Base):
     priority = Column(Integer)
     completed = Column(Boolean, default=False)
     owner_id = Column(Integer, ForeignKey('users.id'))
+    created_at = Column(DateTime(timezone=True), default=utc_now)
+    updated_at = Column(DateTime(timezone=True), default=utc_now, onupdate=utc_now)
+    # SOFT DELETE: a deleted todo is a tombstone (deleted_at is not NULL), until the archival job moves it to todos_archive
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
+    # DELTA SYNC (see utils/todo_changes.py): sequence number of the last change of the todo, per owner
+    change_seq = Column(BigInteger, nullable=True)
+    # MANUAL ORDERING: rank key of the todo in the list of its owner, compared byte by byte (collation "C" in PostgreSQL)
+    position = Column(String().with_variant(String(collation="C"), "postgresql"), nullable=True)
+    # DUE DATE of the current occurrence, and its RRULE-style recurrence (see utils/recurrence.py)
+    due_at = Column(DateTime(timezone=True), nullable=True)
+    recurrence = Column(String, nullable=True)
+
+    # Every query of routers/todos.py filters by owner (WHERE owner_id = ? [AND id = ?]). Without it, a sequential scan.
+    # The plans of those queries are checked by test/test_query_plans.py
+    __table_args__ = (
+        Index("ix_todos_owner_id_id", "owner_id", "id"),
+        Index("ix_todos_owner_id_change_seq", "owner_id", "change_seq"),
+        # GET /todo/?order=position (keyset pagination on (position, id)) and the neighbours of PATCH /todo/{id}/move
+        Index("ix_todos_owner_id_position", "owner_id", "position", "id"),
+        # PARTIAL INDEX: only the todos that the rebalance job has to fix, so finding them does not read the whole table.
+        # With position, the job reads only the index (SQLite prefers a covering index otherwise)
+        Index("ix_todos_positions_to_rebalance", "owner_id", "position",
+              sqlite_where=text(POSITIONS_TO_REBALANCE), postgresql_where=text(POSITIONS_TO_REBALANCE)),
+        # PARTIAL INDEX: the range scans of the scheduler (due_at in the next minutes) only read the pending todos with a
+        # due date, not the completed, deleted or undated ones
+        Index("ix_todos_pending_due_at", "due_at", "id",
+              sqlite_where=text(PENDING_DUE_TODOS), postgresql_where=text(PENDING_DUE_TODOS)),
+        # PARTIAL INDEXES: the archival job reads the completed todos by updated_at and the deleted ones by deleted_at
+        # (one range scan each), not the whole hot table
+        Index("ix_todos_completed_updated_at", "updated_at", "id",
+              sqlite_where=text(COMPLETED_TODOS), postgresql_where=text(COMPLETED_TODOS)),
+        Index("ix_todos_deleted_at", "deleted_at", "id",
+              sqlite_where=text(DELETED_TODOS), postgresql_where=text(DELETED_TODOS)),
+    )
 
     """
     SQLITE3 SCHEMA:
@@ -115,10 +208,174 @@ class Todos(db.Base):
         priority INTEGER,
         completed BOOLEAN,
         owner_id INTEGER,
+        created_at DATETIME,
+        updated_at DATETIME,
+        deleted_at DATETIME,
+        change_seq BIGINT,
+        position VARCHAR,
+        due_at DATETIME,
+        recurrence VARCHAR,
         PRIMARY KEY (id),
         FOREIGN KEY(owner_id) REFERENCES users (id)
     );
     CREATE INDEX ix_todos_id ON todos (id);
+    CREATE INDEX ix_todos_owner_id_id ON todos (owner_id, id);
+    CREATE INDEX ix_todos_owner_id_change_seq ON todos (owner_id, change_seq);
+    CREATE INDEX ix_todos_owner_id_position ON todos (owner_id, position, id);
+    CREATE INDEX ix_todos_positions_to_rebalance ON todos (owner_id, position) WHERE length(position) > 24 OR position IS NULL;
+    CREATE INDEX ix_todos_pending_due_at ON todos (due_at, id) WHERE due_at IS NOT NULL AND deleted_at IS NULL AND NOT completed;
+    CREATE INDEX ix_todos_completed_updated_at ON todos (updated_at, id) WHERE completed;
+    CREATE INDEX ix_todos_deleted_at ON todos (deleted_at, id) WHERE deleted_at IS NOT NULL;
+    """
+
+
+# COLD STORAGE for completed and deleted todos (see utils/archiver.py), so the hot "todos" table and its indexes stay small
+class TodosArchive(db.Base):
+    __tablename__ = "todos_archive"
+
+    id = Column(Integer, primary_key=True) # Same id that the todo had in the "todos" table
+    title = Column(String)
+    description = Column(String)
+    priority = Column(Integer)
+    completed = Column(Boolean)
+    owner_id = Column(Integer, ForeignKey('users.id'))
+    created_at = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True))
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
+    archived_at = Column(DateTime(timezone=True))
+    # Archiving is a change too: the todo leaves GET /todo/, delta sync clients get it as deleted
+    change_seq = Column(BigInteger, nullable=True)
+
+    # Paginating the archive of an owner (WHERE owner_id = ? AND id < ? ORDER BY id DESC)
+    __table_args__ = (
+        Index("ix_todos_archive_owner_id_id", "owner_id", "id"),
+        Index("ix_todos_archive_owner_id_change_seq", "owner_id", "change_seq"),
+    )
+
+    """
+    SQLITE3 SCHEMA:
+    CREATE TABLE todos_archive (
+        id INTEGER NOT NULL,
+        title VARCHAR,
+        description VARCHAR,
+        priority INTEGER,
+        completed BOOLEAN,
+        owner_id INTEGER,
+        created_at DATETIME,
+        updated_at DATETIME,
+        deleted_at DATETIME,
+        archived_at DATETIME,
+        change_seq BIGINT,
+        PRIMARY KEY (id),
+        FOREIGN KEY(owner_id) REFERENCES users (id)
+    );
+    CREATE INDEX ix_todos_archive_owner_id_id ON todos_archive (owner_id, id);
+    CREATE INDEX ix_todos_archive_owner_id_change_seq ON todos_archive (owner_id, change_seq);
+    """
+
+
+# Last change sequence number of each owner (see utils/todo_changes.py). Stored with the todos (in the owner's shard),
+# so it is updated in the same transaction as them. The row lock orders the changes of an owner
+class TodoChangeCounters(db.Base):
+    __tablename__ = "todo_change_counters"
+
+    owner_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    last_seq = Column(BigInteger, nullable=False, default=0)
+
+
+### QUOTAS (see utils/quotas.py) ###
+# Per-user overrides of the quota of the role. NULL: the value of the role (or the default one). 0: unlimited
+class UserQuotas(db.Base):
+    __tablename__ = "user_quotas"
+
+    owner_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    max_todos = Column(Integer, nullable=True)
+    writes_per_minute = Column(Integer, nullable=True)
+
+    """
+    SQLITE3 SCHEMA:
+    CREATE TABLE user_quotas (
+        owner_id INTEGER NOT NULL,
+        max_todos INTEGER,
+        writes_per_minute INTEGER,
+        PRIMARY KEY (owner_id),
+        FOREIGN KEY(owner_id) REFERENCES users (id)
+    );
+    """
+
+
+class UserQuotaValidator(BaseModel):
+    max_todos: int | None = Field(default=None, ge=0)
+    writes_per_minute: int | None = Field(default=None, ge=0)
+
+
+### SHARDING (see database/shards.py). These tables live in the PRIMARY database ###
+# Users whose todos are not in the shard chosen by the hash ring (moved by the rebalancing tool)
+class TodoShardPlacements(db.Base):
+    __tablename__ = "todo_shard_placements"
+
+    owner_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    shard = Column(String, nullable=False)
+    moving = Column(Boolean, default=False) # While True, the writes of the owner are rejected (503)
+
+    """
+    SQLITE3 SCHEMA:
+    CREATE TABLE todo_shard_placements (
+        owner_id INTEGER NOT NULL,
+        shard VARCHAR NOT NULL,
+        moving BOOLEAN,
+        PRIMARY KEY (owner_id),
+        FOREIGN KEY(owner_id) REFERENCES users (id)
+    );
+    """
+
+
+# HiLo id allocator: every process reserves blocks of ids, so todo ids are unique across all the shards
+class IdBlocks(db.Base):
+    __tablename__ = "id_blocks"
+
+    name = Column(String, primary_key=True)
+    next_value = Column(BigInteger, nullable=False)
+
+    """
+    SQLITE3 SCHEMA:
+    CREATE TABLE id_blocks (
+        name VARCHAR NOT NULL,
+        next_value BIGINT NOT NULL,
+        PRIMARY KEY (name)
+    );
+    """
+
+
+# Responses of the requests with an Idempotency-Key header (see utils/idempotency.py)
+class IdempotencyKeys(db.Base):
+    __tablename__ = "idempotency_keys"
+
+    scope = Column(String, primary_key=True) # "<path>|user:<id>", or "<path>|anonymous"
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False) # SHA-256 of the request (method, path, body)
+    status_code = Column(Integer, nullable=True) # NULL while the first request is being executed
+    body = Column(LargeBinary, nullable=True)
+    media_type = Column(String, nullable=True)
+    headers = Column(JSON, nullable=True) # [[name, value], ...] of the response, without the hop-by-hop ones
+    created_at = Column(DateTime(timezone=True), default=utc_now)
+    expires_at = Column(DateTime(timezone=True), index=True)
+
+    """
+    SQLITE3 SCHEMA:
+    CREATE TABLE idempotency_keys (
+        scope VARCHAR NOT NULL,
+        "key" VARCHAR NOT NULL,
+        fingerprint VARCHAR NOT NULL,
+        status_code INTEGER,
+        body BLOB,
+        media_type VARCHAR,
+        headers JSON,
+        created_at DATETIME,
+        expires_at DATETIME,
+        PRIMARY KEY (scope, "key")
+    );
+    CREATE INDEX ix_idempotency_keys_expires_at ON idempotency_keys (expires_at);
     """
 
 
@@ -129,4 +386,73 @@ class TodoValidator(BaseModel):
     description: str = Field(min_length=3, max_length=100)
     priority: int = Field(ge=1, le=5)
     completed: bool
+    # Optional. A recurrence (RRULE subset, see utils/recurrence.py) needs a due date: its first occurrence
+    due_at: datetime | None = None
+    recurrence: str | None = Field(default=None, max_length=200)
+
+    @field_validator("due_at")
+    @classmethod
+    def due_at_in_utc(cls, value: datetime | None) -> datetime | None:
+        # Without an offset, the time is in UTC
+        if value is None:
+            return None
+        value = value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+        # Bounded (checked before the conversion, which could overflow): the next occurrence of a recurrence is computed
+        # from it (see utils/recurrence.py)
+        if not recurrence_rules.MIN_DUE_AT <= value < recurrence_rules.MAX_DUE_AT:
+            raise ValueError(f"due_at must be between {recurrence_rules.MIN_DUE_AT.year} and {recurrence_rules.MAX_DUE_AT.year - 1}")
+        return value.astimezone(timezone.utc)
+
+    @model_validator(mode="after")
+    def valid_recurrence(self):
+        if self.recurrence is not None:
+            if self.due_at is None:
+                raise ValueError("A recurring todo needs a due_at")
+            # Stored in its canonical form
+            self.recurrence = str(recurrence_rules.parse_rule(self.recurrence))
+        return self
+
+
+# PATCH /todo/{todo_id}/move: the todo goes right after OR right before another todo of the same owner
+class TodoMoveValidator(BaseModel):
+    after_id: int | None = Field(default=None, gt=0)
+    before_id: int | None = Field(default=None, gt=0)
+
+    @model_validator(mode="after")
+    def one_anchor(self):
+        if (self.after_id is None) == (self.before_id is None):
+            raise ValueError("Provide either after_id or before_id")
+        return self
+
+
+# Public representation of a todo. Bookkeeping columns (timestamps, tombstones) are not exposed
+class TodoResponse(BaseModel):
+    id: int
+    title: str
+    description: str
+    priority: int
+    completed: bool
+    owner_id: int
+    due_at: datetime | None = None
+    recurrence: str | None = None
+
+    model_config = {"from_attributes": True}
+
+    @field_validator("due_at")
+    @classmethod
+    def due_at_in_utc(cls, value: datetime | None) -> datetime | None:
+        # SQLite returns naive datetimes (stored in UTC)
+        return value.replace(tzinfo=timezone.utc) if value is not None and value.tzinfo is None else value
+
+
+# POST /todo/: the id of the new todo, with or without the group commit
+class TodoCreatedResponse(BaseModel):
+    id: int
+
 
+# GET /todo/changes: the todos created or updated since the sync token, and the ids of the ones that are gone
+class TodoChangesResponse(BaseModel):
+    changes: list[TodoResponse]
+    deleted: list[int]
+    token: int # "since" of the next sync
+    has_more: bool # True: the next page must be requested right away, with the new token
@@ -0,0 +1,329 @@
+import asyncio, bisect, hashlib, threading, time
+from typing import Annotated, Callable
+from fastapi import Depends, HTTPException, Request, status
+from sqlalchemy import delete, func, inspect, insert, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.schema import CreateIndex, CreateTable
+from database import db, models
+from utils.cache import TTLCache
+from utils.settings import Settings
+from utils.tokens import get_logged_in_user
+
+"""
+HORIZONTAL SHARDING OF TODOS (by owner_id)
+- Settings.todo_shards: "a=postgresql://...,b=postgresql://...". When it is empty, the todos stay in the primary database
+  and nothing in this module is used (app.state.shard_router is None)
+- Each owner is mapped to a shard by a CONSISTENT-HASH RING (with virtual nodes), so adding a shard only moves ~1/N
+  of the owners, instead of almost all of them (as owner_id % N would do)
+- The shards only contain "todos" and "todos_archive". Users, tokens and the sharding tables stay in the primary:
+    - todo_shard_placements: owners that were moved by the rebalancing tool. It overrides the ring
+    - id_blocks: todo ids are reserved in blocks from the primary (HiLo), so they are unique across the shards and
+      a todo keeps its id when its owner is moved
+- The todo routes use the shard of the logged in user (get_todo_db / get_todo_read_db). The admin routes, that need
+  the todos of every owner, query all the shards concurrently (fan_out) and merge the results
+
+REBALANCING (online, one owner at a time):
+    python -m database.shards --owner 12 --to b     moves the todos of the owner 12 to the shard "b"
+    python -m database.shards --pin                 BEFORE deploying a new TODO_SHARDS: pins the owners whose ring
+                                                    position changes to the shard that has their todos today
+    python -m database.shards --all                 AFTER deploying it: moves every pinned owner to its ring position
+While an owner is moving, its writes are rejected with 503 (Retry-After), and its reads keep using the source shard.
+"""
+
+# Tables stored in every shard, moved by owner_id (the change counters too: they are updated with the todos)
+TODO_TABLES = (models.Todos.__table__, models.TodosArchive.__table__)
+SHARDED_TABLES = (*TODO_TABLES, models.TodoChangeCounters.__table__)
+
+
+def hash_key(key: str) -> int:
+    # hash() is randomized per process, the ring must be the same in every worker
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes: list[str], virtual_nodes: int = 100):
+        # Every node is placed in many points of the ring, so the owners are evenly distributed
+        points = sorted((hash_key(f"{node}#{index}"), node) for node in nodes for index in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key) -> str:
+        # The first point clockwise from the hash of the key (wrapping around the end of the ring)
+        index = bisect.bisect(self._hashes, hash_key(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+class IdAllocator:
+    """
+    HiLo: every process reserves `block_size` ids with ONE update of id_blocks (primary), and hands them out from memory.
+    The ids are unique across processes and shards, but not strictly increasing across processes.
+    """
+
+    def __init__(self, primary_sessions: sessionmaker, name: str, first_id: Callable[[], int], block_size: int = 100):
+        self.primary_sessions = primary_sessions
+        self.name = name
+        self.first_id = first_id
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def next_id(self) -> int:
+        with self._lock:
+            if self._next >= self._end:
+                self._next = self._reserve()
+                self._end = self._next + self.block_size
+            value = self._next
+            self._next += 1
+            return value
+
+    def _reserve(self) -> int:
+        with self.primary_sessions() as session:
+            # The UPDATE locks the row until the commit, so two processes never get the same block
+            updated = session.execute(
+                update(models.IdBlocks)
+                .where(models.IdBlocks.name == self.name)
+                .values(next_value=models.IdBlocks.next_value + self.block_size)
+            ).rowcount
+            if updated:
+                end = session.scalar(select(models.IdBlocks.next_value).where(models.IdBlocks.name == self.name))
+                session.commit()
+                return end - self.block_size
+
+            # First block ever: starting after the ids that already exist
+            start = self.first_id()
+            session.add(models.IdBlocks(name=self.name, next_value=start + self.block_size))
+            try:
+                session.commit()
+            except IntegrityError:
+                # Another process created the row first
+                session.rollback()
+                return self._reserve()
+            return start
+
+
+class ShardRouter:
+    def __init__(self, shards: dict[str, Engine], primary_sessions: sessionmaker, placement_cache_seconds: float = 5):
+        self.engines = shards
+        self.sessions = {name: db.create_session_factory(engine) for name, engine in shards.items()}
+        self.ring = HashRing(list(shards))
+        self.primary_sessions = primary_sessions
+        # (shard, moving) of each owner. Kept for a few seconds, the rebalancing tool waits longer than that
+        self.placements = TTLCache(ttl=placement_cache_seconds)
+        self.todo_ids = IdAllocator(primary_sessions, "todos", self.max_todo_id)
+
+    @classmethod
+    def from_settings(cls, settings: Settings, primary_sessions: sessionmaker) -> "ShardRouter | None":
+        shards = {}
+        for entry in settings.todo_shards.split(","):
+            if not entry.strip():
+                continue
+            name, separator, uri = entry.partition("=")
+            if not separator or not name.strip() or not uri.strip():
+                raise ValueError(f"Invalid TODO_SHARDS entry {entry!r}, expected <name>=<uri>")
+            shards[name.strip()] = db.create_app_engine(uri.strip(), settings)
+        if not shards:
+            return None
+        return cls(shards, primary_sessions, settings.shard_placement_cache_seconds)
+
+    def placement(self, owner_id: int, db_session: Session) -> tuple[str, bool]:
+        cached = self.placements.get(owner_id)
+        if cached is not None:
+            return cached
+        row = db_session.get(models.TodoShardPlacements, owner_id)
+        if row is not None and row.shard in self.engines:
+            cached = (row.shard, bool(row.moving))
+        else:
+            cached = (self.ring.node_for(owner_id), False)
+        self.placements.set(owner_id, cached)
+        return cached
+
+    def max_todo_id(self) -> int:
+        # Also looking at the primary, in case its todos were copied to the shards when sharding was enabled
+        sessions = [self.primary_sessions, *self.sessions.values()]
+        highest = 0
+        for session_factory in sessions:
+            with session_factory() as session:
+                for table in TODO_TABLES:
+                    if inspect(session.get_bind()).has_table(table.name):
+                        highest = max(highest, session.scalar(select(func.max(table.c.id))) or 0)
+        return highest + 1
+
+    def create_tables(self):
+        # Without the foreign key to "users", that only exists in the primary
+        for engine in self.engines.values():
+            with engine.begin() as connection:
+                for table in SHARDED_TABLES:
+                    if not inspect(connection).has_table(table.name):
+                        connection.execute(CreateTable(table, include_foreign_key_constraints=[]))
+                        for index in table.indexes:
+                            connection.execute(CreateIndex(index))
+
+    async def fan_out(self, query: Callable[[Session], object]) -> list:
+        # The sessions are synchronous, so each shard is queried in its own thread, all of them at the same time
+        def run(session_factory: sessionmaker):
+            with session_factory() as session:
+                return query(session)
+        return await asyncio.gather(*(asyncio.to_thread(run, factory) for factory in self.sessions.values()))
+
+    def dispose(self):
+        for engine in self.engines.values():
+            engine.dispose()
+
+
+### REBALANCING ###
+def set_placement(router: ShardRouter, owner_id: int, shard: str, moving: bool):
+    with router.primary_sessions() as session:
+        session.merge(models.TodoShardPlacements(owner_id=owner_id, shard=shard, moving=moving))
+        session.commit()
+    router.placements.delete(owner_id)
+
+
+def move_owner(router: ShardRouter, owner_id: int, target: str, freeze_seconds: float | None = None) -> int:
+    if target not in router.engines:
+        raise ValueError(f"Unknown shard {target!r}")
+    # Every worker must see each placement change before the next step (their placements cache expires)
+    if freeze_seconds is None:
+        freeze_seconds = router.placements.ttl + 1
+
+    with router.primary_sessions() as session:
+        source, _ = router.placement(owner_id, session)
+    if source == target:
+        return 0
+
+    # 1. Stopping the writes of the owner. Its reads still use the source
+    set_placement(router, owner_id, source, moving=True)
+    time.sleep(freeze_seconds)
+
+    # 2. Copying the rows. Rows left in the target by an interrupted move are replaced
+    moved = 0
+    with router.sessions[source]() as source_session, router.sessions[target]() as target_session:
+        for table in SHARDED_TABLES:
+            rows = [dict(row) for row in source_session.execute(select(table).where(table.c.owner_id == owner_id)).mappings()]
+            target_session.execute(delete(table).where(table.c.owner_id == owner_id))
+            if rows:
+                target_session.execute(insert(table), rows)
+            moved += len(rows) if table in TODO_TABLES else 0
+        target_session.commit()
+
+    # 3. The target becomes the owner's shard. Workers that still see "moving" keep rejecting its writes for a while
+    set_placement(router, owner_id, target, moving=False)
+    time.sleep(freeze_seconds)
+
+    # 4. Nobody reads the source copy anymore
+    with router.sessions[source]() as source_session:
+        for table in SHARDED_TABLES:
+            source_session.execute(delete(table).where(table.c.owner_id == owner_id))
+        source_session.commit()
+    return moved
+
+
+def owners_by_shard(router: ShardRouter) -> dict[str, set[int]]:
+    owners = {}
+    for name, session_factory in router.sessions.items():
+        with session_factory() as session:
+            owners[name] = {owner_id for table in SHARDED_TABLES
+                            for owner_id in session.scalars(select(table.c.owner_id).distinct())}
+    return owners
+
+
+def pin_owners(router: ShardRouter) -> int:
+    # The owners whose todos are not where the (new) ring places them keep using their current shard
+    pinned = 0
+    with router.primary_sessions() as session:
+        pins = {row.owner_id for row in session.query(models.TodoShardPlacements.owner_id)}
+    for name, owners in owners_by_shard(router).items():
+        for owner_id in owners:
+            if owner_id not in pins and router.ring.node_for(owner_id) != name:
+                set_placement(router, owner_id, name, moving=False)
+                pinned += 1
+    return pinned
+
+
+def rebalance(router: ShardRouter, freeze_seconds: float | None = None) -> int:
+    with router.primary_sessions() as session:
+        pins = [(row.owner_id, row.shard) for row in session.query(models.TodoShardPlacements)]
+    moved = 0
+    for owner_id, shard in pins:
+        target = router.ring.node_for(owner_id)
+        if shard != target:
+            move_owner(router, owner_id, target, freeze_seconds)
+            moved += 1
+    return moved
+
+
+# Explicit id for a new todo when there are shards, None (autoincrement of the table) without them
+def new_todo_id(request: Request) -> int | None:
+    router: ShardRouter | None = request.app.state.shard_router
+    return None if router is None else router.todo_ids.next_id()
+
+
+### DEPENDENCY FUNCTIONS ###
+# Without shards, they are the same as db.get_db and db.get_read_db
+db_dependency: type[Session] = Annotated[Session, Depends(db.get_db)]
+read_db_dependency: type[Session] = Annotated[Session, Depends(db.get_read_db)]
+user_dependency: type[dict] = Annotated[dict, Depends(get_logged_in_user)]
+
+
+def shard_session(router: ShardRouter, user_data: dict, db_session: Session, writing: bool) -> Session:
+    shard, moving = router.placement(user_data.get("user_id"), db_session)
+    if moving and writing:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Your todos are being moved, try again later",
+                            headers={"Retry-After": str(max(1, int(router.placements.ttl) + 1))})
+    return router.sessions[shard]()
+
+
+# Session on the shard of the logged in user
+def get_todo_db(request: Request, user_data: user_dependency, db_session: db_dependency):
+    router: ShardRouter | None = request.app.state.shard_router
+    if router is None:
+        yield db_session
+        return
+    shard_db_session = shard_session(router, user_data, db_session, writing=True)
+    try:
+        yield shard_db_session
+    finally:
+        shard_db_session.close()
+
+
+# Read-only routes: a replica without shards, the shard of the user (also while it is being moved) with shards
+def get_todo_read_db(request: Request, user_data: user_dependency, db_session: db_dependency, read_db_session: read_db_dependency):
+    router: ShardRouter | None = request.app.state.shard_router
+    if router is None:
+        yield read_db_session
+        return
+    shard_db_session = shard_session(router, user_data, db_session, writing=False)
+    try:
+        yield shard_db_session
+    finally:
+        shard_db_session.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Moves the todos of the owners between shards")
+    parser.add_argument("--owner", type=int)
+    parser.add_argument("--to")
+    parser.add_argument("--pin", action="store_true")
+    parser.add_argument("--all", action="store_true")
+    parser.add_argument("--freeze-seconds", type=float)
+    args = parser.parse_args()
+
+    cli_settings = Settings.from_env()
+    engine = db.create_db_engine(cli_settings.database_uri)
+    cli_router = ShardRouter.from_settings(cli_settings, db.create_session_factory(engine))
+    if cli_router is None:
+        parser.error("TODO_SHARDS is not configured")
+
+    if args.pin:
+        print("Pinned owners:", pin_owners(cli_router))
+    elif args.all:
+        print("Moved owners:", rebalance(cli_router, args.freeze_seconds))
+    elif args.owner is not None and args.to:
+        print("Moved rows:", move_owner(cli_router, args.owner, args.to, args.freeze_seconds))
+    else:
+        parser.error("use --owner and --to, --pin or --all")
+    cli_router.dispose()
+    engine.dispose()
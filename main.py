@@ -1,43 +1,177 @@
-from fastapi import FastAPI, Request
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, APIRouter
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from database import db
-from routers import auth, todos, admin, users
+from database import db, shards
+from routers import auth, todos, admin, users, jwks
+from utils import archiver, idempotency, logs, ranks
+from utils.cache import TTLCache
+from utils.group_commit import TodoInsertBatcher
+from utils.single_flight import SingleFlight
+from utils.denylist import AccessTokenDenylist, DatabaseDenylistBackend
+from utils.keyring import KeyRing
+from utils.passwords import PasswordPolicy
+from utils.quotas import QuotaTracker
+from utils.scheduler import DueScheduler
+from utils.settings import Settings
 
-app = FastAPI()
 
-# This creates $DATABASE_URI database (todosapp.db), using the configuration of db.py & models.py
-db.Base.metadata.create_all(bind=db.engine)
+# Code before the yield runs once at startup, code after the yield runs once at shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings: Settings = app.state.settings
+    # The thread that writes the logs (see utils/logs.py), first started and last stopped
+    app.state.log_shipper.start()
 
-# Frontend Setup
-templates = Jinja2Templates(directory="templates")
-# "Mounting" means adding a complete "independent" application in a specific path. The OpenAPI and docs won't include anything from here
-app.mount(path="/static", app=StaticFiles(directory="static"), name="static_files")
+    if settings.create_tables:
+        create_tables(app)
 
-@app.get("/")
+    # Background job that moves old completed/deleted todos to the todos_archive table
+    # With shards, each shard archives its own todos
+    session_factories = [app.state.session_factory] if app.state.shard_router is None else app.state.shard_router.sessions.values()
+    background_tasks = []
+    if settings.todos_archive_after_days > 0:
+        background_tasks += [asyncio.create_task(archiver.run_periodically(factory, settings)) for factory in session_factories]
+    # Background job that shortens the positions of the manual ordering (see utils/ranks.py), also one per shard
+    if settings.todo_position_rebalance_seconds > 0:
+        background_tasks += [asyncio.create_task(ranks.run_periodically(factory, settings)) for factory in session_factories]
+
+    # Scheduler of the due events of the todos (see utils/scheduler.py)
+    if app.state.due_scheduler is not None:
+        background_tasks.append(asyncio.create_task(app.state.due_scheduler.run()))
+
+    if app.state.todo_batcher is not None:
+        app.state.todo_batcher.start()
+
+    yield
+
+    if app.state.todo_batcher is not None:
+        await app.state.todo_batcher.close()
+    for background_task in background_tasks:
+        background_task.cancel()
+    if app.state.hash_pool is not None:
+        app.state.hash_pool.shutdown(wait=False, cancel_futures=True)
+        app.state.hash_pool = None
+    dispose_engines(app)
+    app.state.log_shipper.stop()
+
+
+# This creates the database tables of the app engine, using the configuration of db.py & models.py
+# Also called once by the master process of serve.py, before the workers are forked
+def create_tables(app: FastAPI):
+    db.Base.metadata.create_all(bind=app.state.engine)
+    if app.state.shard_router is not None:
+        app.state.shard_router.create_tables()
+
+
+def dispose_engines(app: FastAPI):
+    app.state.db_router.dispose()
+    if app.state.shard_router is not None:
+        app.state.shard_router.dispose()
+
+
+# Frontend pages. The templates of each app are in app.state.templates
+pages = APIRouter()
+
+def render_template(req: Request, name: str):
+    # Jinja2 is imported and its environment created when the first page is rendered, not at startup.
+    # Workers that only serve the API never pay for it
+    templates = req.app.state.templates
+    if templates is None:
+        from fastapi.templating import Jinja2Templates
+        templates = req.app.state.templates = Jinja2Templates(directory="templates")
+    return templates.TemplateResponse(name, {"request": req})
+
+@pages.get("/")
 def test(req: Request):
-    return templates.TemplateResponse("home.html" , {"request": req})
+    return render_template(req, "home.html")
 
-@app.get("/login-page")
+@pages.get("/login-page")
 def render_login_page(req: Request):
-    return templates.TemplateResponse("login.html", {"request": req})
+    return render_template(req, "login.html")
 
-@app.get("/register-page")
+@pages.get("/register-page")
 def render_register_page(req: Request):
-    return templates.TemplateResponse("register.html", {"request": req})
+    return render_template(req, "register.html")
 
 # Health check
-@app.get("/healthy")
+@pages.get("/healthy")
 def health_check():
     return {"status": "Healthy"}
 
-@app.get("/todos-page")
+@pages.get("/todos-page")
 def render_todos_page(req: Request):
-    return templates.TemplateResponse("todos.html", {"request": req})
+    return render_template(req, "todos.html")
+
+
+# APPLICATION FACTORY
+# Everything that depends on the configuration (engine, sessions, keyring, caches) belongs to the app instance (app.state),
+# so several apps with different settings can coexist in the same process (e.g. tests), and nothing is created at import time.
+# Production servers can preload the app in the master process and fork the workers: uvicorn main:create_app --factory
+def create_app(settings: Settings | None = None) -> FastAPI:
+    settings = settings or Settings.from_env()
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.settings = settings
+
+    # The engines do not connect until the first query
+    app.state.engine = db.create_app_engine(settings.database_uri, settings)
+    replicas = [db.create_app_engine(uri.strip(), settings) for uri in settings.read_replica_uris.split(",") if uri.strip()]
+    app.state.db_router = db.DatabaseRouter(app.state.engine, replicas, settings.replica_routing, settings.read_your_writes_seconds)
+    app.state.session_factory = app.state.db_router.primary_sessions
+    if replicas:
+        app.middleware("http")(db.read_your_writes)
+    # None when TODO_SHARDS is empty: the todos are stored in the primary
+    app.state.shard_router = shards.ShardRouter.from_settings(settings, app.state.session_factory)
+
+    # Parsing the JWT keyring once, so a misconfigured key fails at startup instead of on the first login
+    app.state.keyring = KeyRing.from_settings(settings)
+    app.state.denylist = AccessTokenDenylist(DatabaseDenylistBackend(), sync_interval=settings.denylist_sync_seconds)
+    app.state.password_policy = PasswordPolicy.from_settings(settings)
+    app.state.profile_cache = TTLCache(ttl=settings.user_profile_cache_seconds)
+    app.state.single_flight = SingleFlight() if settings.single_flight_reads else None
+    app.state.idempotency = idempotency.IdempotencyStore(settings.idempotency_key_ttl_seconds, settings.idempotency_wait_seconds)
+    app.middleware("http")(idempotency.store_responses)
+    app.add_exception_handler(idempotency.IdempotentReplay, idempotency.replay_response)
+    # Parsing the role quotas once, so a misconfigured entry fails at startup
+    app.state.quotas = QuotaTracker.from_settings(settings)
+    app.state.todo_batcher = None
+    # Due events of the todos (see utils/scheduler.py). With shards, its heap is fed by all of them
+    app.state.due_scheduler = None
+    if settings.todo_due_window_seconds > 0:
+        todo_sessions = [app.state.session_factory] if app.state.shard_router is None else list(app.state.shard_router.sessions.values())
+        app.state.due_scheduler = DueScheduler.from_settings(settings, todo_sessions)
+    # JSON access and error logs (see utils/logs.py). Registered last: the outermost middleware, it times everything
+    app.state.access_log = logs.AccessLog.from_settings(settings)
+    app.state.log_shipper = logs.LogShipper(settings)
+    for engine in [app.state.engine, *replicas, *(app.state.shard_router.engines.values() if app.state.shard_router else [])]:
+        logs.instrument_engine(engine)
+    app.middleware("http")(logs.log_requests)
+    # Process pool of the bulk user import, created by the first import (see utils/bulk_users.py)
+    app.state.hash_pool = None
+    if settings.todo_group_commit:
+        app.state.todo_batcher = TodoInsertBatcher(settings.todo_group_commit_max_rows, settings.todo_group_commit_max_delay_ms)
+
+    # Frontend Setup (templates are created on the first render, see render_template)
+    app.state.templates = None
+    # "Mounting" means adding a complete "independent" application in a specific path. The OpenAPI and docs won't include anything from here
+    app.mount(path="/static", app=StaticFiles(directory="static"), name="static_files")
+
+    # Including frontend and backend routers
+    app.include_router(pages)
+    app.include_router(todos.router)
+    app.include_router(auth.router)
+    app.include_router(admin.router)
+    app.include_router(users.router)
+    app.include_router(jwks.router)
+
+    return app
 
 
-# Including backend routers
-app.include_router(todos.router)
-app.include_router(auth.router)
-app.include_router(admin.router)
-app.include_router(users.router)
\ No newline at end of file
+# "uvicorn main:app" keeps working: the default app (configured from the environment) is only created when it is
+# requested for the first time, not when this module is imported (PEP 562 module __getattr__)
+def __getattr__(name: str):
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Path
-from typing import Annotated
+import heapq, uuid
+from fastapi import APIRouter, Depends, HTTPException, Request, status, Path, Query
+from fastapi.responses import StreamingResponse
+from typing import Annotated, Literal
+from sqlalchemy import func, select, update
 from sqlalchemy.orm import Session
 from database import db, models
-from utils.tokens import get_logged_in_user
+from utils import bulk_users, todo_changes
+from utils.tokens import get_logged_in_user, revoke_token_family
 
 router = APIRouter(
     prefix="/admin",
@@ -13,34 +17,184 @@ router = APIRouter(
 # Annotated[Session, Depends(get_db)] indicates that the Session type should be resolved using the get_db dependency
 db_dependency: type[Session] = Annotated[Session, Depends(db.get_db)]
 
+# Read-only routes: the session may come from a read replica (see database/db.py)
+read_db_dependency: type[Session] = Annotated[Session, Depends(db.get_read_db)]
+
 # Every time this is used as a type, FastAPI will interpret it as a dependency, and will call the get_logged_in_user function.
 # The get_logged_in_user function gets the JWT in the Authorization header, validates it and returns the username, user_id and user_role if valid.
 # If something is wrong with the JWT, the function will raise an exception that is going to be handled by FastAPI.
 user_dependency: type[dict] = Annotated[dict, Depends(get_logged_in_user)]
 
 
-@router.get("/todo", status_code=status.HTTP_200_OK)
-async def get_all_todos(user_data: user_dependency, db_session: db_dependency):
+# Keyset pagination: the next page is requested with after_id=<id of the last todo of the current page>
+@router.get("/todo", status_code=status.HTTP_200_OK, response_model=list[models.TodoResponse])
+async def get_all_todos(request: Request, user_data: user_dependency, db_session: read_db_dependency,
+                        after_id: int | None = Query(default=None, gt=0),
+                        limit: int | None = Query(default=None, ge=1, le=1000)):
     if user_data.get("user_role") != "admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
 
-    return db_session.query(models.Todos).all()
+    def todos_page(session: Session) -> list[models.Todos]:
+        query = session.query(models.Todos).filter(models.Todos.deleted_at.is_(None))
+        if after_id is not None:
+            query = query.filter(models.Todos.id > after_id)
+        query = query.order_by(models.Todos.id)
+        return query.limit(limit).all() if limit is not None else query.all()
+
+    shard_router = request.app.state.shard_router
+    if shard_router is None:
+        return todos_page(db_session)
+
+    # SHARDS (see database/shards.py): every shard returns its first page, ordered by id, and the pages are merged
+    pages = await shard_router.fan_out(todos_page)
+    merged = list(heapq.merge(*pages, key=lambda todo: todo.id))
+    return merged[:limit] if limit is not None else merged
 
 @router.delete("/todo/{todo_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_todo(user_data: user_dependency, db_session: db_dependency, todo_id: int = Path(gt=0)):
+async def delete_todo(request: Request, user_data: user_dependency, db_session: db_dependency, todo_id: int = Path(gt=0)):
     if user_data.get("user_role") != "admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
 
-    todo_model = db_session.query(models.Todos).filter(models.Todos.id == todo_id).first()
-    if todo_model is None:
+    # SOFT DELETE (see routers/todos.py), with the next change number of the owner (see utils/todo_changes.py)
+    # Returns the owner of the deleted todo (None: not found)
+    def soft_delete(session: Session) -> int | None:
+        owner_id = session.scalar(select(models.Todos.owner_id).where(models.Todos.id == todo_id, models.Todos.deleted_at.is_(None)))
+        if owner_id is None:
+            return None
+        # The counter is locked BEFORE the todo row, like in routers/todos.py (the opposite order could deadlock)
+        deleted = session.execute(
+            update(models.Todos)
+            .where(models.Todos.id == todo_id, models.Todos.deleted_at.is_(None))
+            .values(deleted_at=models.utc_now(), change_seq=todo_changes.next_seq(session, owner_id))
+        ).rowcount
+        if not deleted:
+            session.rollback()
+            return None
+        session.commit()
+        return owner_id
+
+    # The ids are unique across the shards, so at most one of them has the todo
+    shard_router = request.app.state.shard_router
+    owners = [soft_delete(db_session)] if shard_router is None else await shard_router.fan_out(soft_delete)
+    owner_id = next((owner_id for owner_id in owners if owner_id is not None), None)
+    if owner_id is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Todo not found.")
+    # The cached todo count of the owner (see utils/quotas.py), like the delete of routers/todos.py
+    request.app.state.quotas.record_delete(owner_id)
+
+# Metrics of the group commit of todo inserts (see utils/group_commit.py)
+@router.get("/group-commit", status_code=status.HTTP_200_OK)
+async def get_group_commit_stats(request: Request, user_data: user_dependency):
+    if user_data.get("user_role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+
+    batcher = request.app.state.todo_batcher
+    if batcher is None:
+        return {"enabled": False}
+    return {"enabled": True, **batcher.stats.as_dict()}
 
-    db_session.delete(todo_model)
+# Counters of the read coalescing (see utils/single_flight.py)
+@router.get("/single-flight", status_code=status.HTTP_200_OK)
+async def get_single_flight_stats(request: Request, user_data: user_dependency):
+    if user_data.get("user_role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+
+    flights = request.app.state.single_flight
+    if flights is None:
+        return {"enabled": False}
+    return {"enabled": True, **flights.stats()}
+
+# TOP CONSUMERS of the todo quotas (see utils/quotas.py):
+# - owners: the owners with the most changes ever (their change counter, one row per owner: no scan of the todos),
+#   with their live todos (one indexed count per owner). Every shard, merged
+# - recent: the owners with the most writes in THIS worker since it started, with the writes rejected by their quota
+@router.get("/quotas/top", status_code=status.HTTP_200_OK)
+async def get_top_consumers(request: Request, user_data: user_dependency, db_session: read_db_dependency,
+                            limit: int = Query(default=10, ge=1, le=100)):
+    if user_data.get("user_role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+
+    def top_owners(session: Session) -> list[dict]:
+        counters = models.TodoChangeCounters
+        rows = session.execute(select(counters.owner_id, counters.last_seq).order_by(counters.last_seq.desc()).limit(limit)).all()
+        return [{
+            "owner_id": row.owner_id,
+            "changes": row.last_seq,
+            "todos": session.scalar(select(func.count()).select_from(models.Todos)
+                                    .where(models.Todos.owner_id == row.owner_id, models.Todos.deleted_at.is_(None))),
+        } for row in rows]
+
+    shard_router = request.app.state.shard_router
+    pages = [top_owners(db_session)] if shard_router is None else await shard_router.fan_out(top_owners)
+    owners = heapq.nlargest(limit, (owner for page in pages for owner in page), key=lambda owner: owner["changes"])
+    return {"owners": owners, "recent": request.app.state.quotas.top_writers(limit)}
+
+# Per-user quota, on top of the quota of their role. null: the value of the role. 0: unlimited
+@router.put("/user/{user_id}/quota", status_code=status.HTTP_204_NO_CONTENT)
+async def set_user_quota(request: Request, user_data: user_dependency, db_session: db_dependency,
+                         quota_validator: models.UserQuotaValidator, user_id: int = Path(gt=0)):
+    if user_data.get("user_role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+
+    if db_session.get(models.Users, user_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found.")
+    db_session.merge(models.UserQuotas(owner_id=user_id, **quota_validator.model_dump()))
     db_session.commit()
+    # The other workers read it again after todo_quota_cache_seconds
+    request.app.state.quotas.forget(user_id)
 
 @router.get("/user", status_code=status.HTTP_200_OK)
-async def get_all_users(user_data: user_dependency, db_session: db_dependency):
+async def get_all_users(user_data: user_dependency, db_session: read_db_dependency):
     if user_data.get("user_role") != "admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
 
     return db_session.query(models.Users).all()
+
+# BULK IMPORT (see utils/bulk_users.py): the body is a CSV (with header) or NDJSON stream, one user per line
+# Every row has username, email, first_name, last_name, phone_number, role, and password or hashed_password
+@router.post("/user/import", status_code=status.HTTP_200_OK)
+async def import_users(request: Request, user_data: user_dependency, db_session: db_dependency,
+                       file_format: Literal["csv", "ndjson"] = Query(default="ndjson", alias="format")):
+    if user_data.get("user_role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+
+    pool = bulk_users.get_hash_pool(request.app)
+    report = await bulk_users.import_users(db_session, pool, request.app.state.password_policy, request.stream(), file_format)
+    # Created users, and the line of every conflict (existing username/email) and invalid row
+    return report.as_dict()
+
+# BULK EXPORT: streamed from a server-side cursor. The password hashes are only exported on request
+@router.get("/user/export", status_code=status.HTTP_200_OK)
+async def export_users(user_data: user_dependency, db_session: read_db_dependency,
+                       file_format: Literal["csv", "ndjson"] = Query(default="ndjson", alias="format"),
+                       include_password_hashes: bool = Query(default=False)):
+    if user_data.get("user_role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+
+    media_type = "text/csv" if file_format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        bulk_users.export_users(db_session, file_format, include_password_hashes),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="users.{file_format}"'},
+    )
+
+@router.get("/session", status_code=status.HTTP_200_OK, response_model=list[models.SessionResponse])
+async def get_all_sessions(user_data: user_dependency, db_session: read_db_dependency, user_id: int | None = Query(default=None, gt=0)):
+    if user_data.get("user_role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+
+    # The jti of the current refresh tokens is not exposed (SessionResponse)
+    query = db_session.query(models.RefreshTokens)
+    if user_id is not None:
+        query = query.filter(models.RefreshTokens.user_id == user_id)
+    return query.order_by(models.RefreshTokens.created_at).all()
+
+@router.delete("/session/{family_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_session(user_data: user_dependency, db_session: db_dependency, family_id: uuid.UUID):
+    if user_data.get("user_role") != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to perform this action")
+
+    if db_session.get(models.RefreshTokens, family_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found.")
+
+    revoke_token_family(db_session, family_id)
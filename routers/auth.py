@@ -1,12 +1,13 @@
 from datetime import timedelta
-from fastapi import APIRouter, status, Depends, HTTPException, Response, Cookie
+from fastapi import APIRouter, status, Depends, HTTPException, Request, Response, Cookie
 from fastapi.security import OAuth2PasswordRequestForm
-from passlib.context import CryptContext
 from typing import Annotated, Union
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 from database import models, db
-from utils import  tokens
+from utils import  tokens, passwords, idempotency, logs
+from utils.keyring import keyring_dependency
+from utils.denylist import denylist_dependency
 
 router = APIRouter(
     prefix=tokens.PREFIX,
@@ -17,8 +18,6 @@ router = APIRouter(
 ACCESS_TOKEN_EXPIRE_MINUTES = 10
 REFRESH_TOKEN_EXPIRE_DAYS = 2
 
-bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 # Annotated[T, x]: T is the base type, x is the metadata. If the tool do not have logic to interpret x, it is treated simply as T
 # Annotated[Session, Depends(get_db)] indicates that the Session type should be resolved using the get_db dependency
 db_dependency: type[Session] = Annotated[Session, Depends(db.get_db)]
@@ -27,24 +26,40 @@ db_dependency: type[Session] = Annotated[Session, Depends(db.get_db)]
 # Every time this is used as a type, FastAPI will interpret it as a dependency, and will call the get_user_from_refresh_token function.
 # The get_user_from_refresh_token function do the following things:
 # - Gets the JWT in the Authorization header
-# - Validates it and deletes it from the database
-# - Returns the JWT user_data
-# - If the refresh token is not in the database, it is considered INVALID
+# - Validates it against its session (refresh token family) in the database
+# - Returns the JWT payload
+# - If the refresh token is not the current one of its session, it is considered INVALID (a reused token revokes the session)
 # If something is wrong with the JWT, the function will raise an exception that is going to be handled by FastAPI.
 token_dependency: type[dict] = Annotated[dict, Depends(tokens.get_payload_from_refresh_token)]
 
+# The access token in the Authorization header
+user_dependency: type[dict] = Annotated[dict, Depends(tokens.get_logged_in_user)]
+
+# Optional access token in the Authorization header (no 401 response if it is missing)
+optional_token_dependency: type[str | None] = Annotated[Union[str, None], Depends(tokens.optional_oauth2_bearer)]
 
-def authenticate_user(username: str, password: str, db_session: Session) -> models.Users | None:
+
+def authenticate_user(username: str, password: str, db_session: Session,
+                      policy: passwords.PasswordPolicy = passwords.DEFAULT_POLICY) -> models.Users | None:
     user: models.Users | None = db_session.query(models.Users).filter(models.Users.username == username).first()
-    if user is None or not bcrypt_context.verify(password, user.hashed_password):
+    if user is None:
         return None
+
+    valid, new_hash = passwords.verify_and_update(password, user.hashed_password, policy)
+    if not valid:
+        return None
+    # The hash does not follow the current policy (scheme or cost): the password is known now, so it is upgraded
+    if new_hash is not None:
+        user.hashed_password = new_hash
+        db_session.commit()
     return user
 
-@router.post("/", status_code=status.HTTP_201_CREATED)
-async def create_user(db_session: db_dependency, user_validator: models.UserValidator):
+# Retries with the same Idempotency-Key header get the first response, without hashing the password again (see utils/idempotency.py)
+@router.post("/", status_code=status.HTTP_201_CREATED, dependencies=[Depends(idempotency.anonymous_idempotency_key)])
+async def create_user(req: Request, db_session: db_dependency, user_validator: models.UserValidator):
     user_model = models.Users(
         is_active=True, # added attribute that does not exist in UserValidator
-        hashed_password=bcrypt_context.hash(user_validator.password), # added attribute that does not exist in UserValidator
+        hashed_password=passwords.hash_password(user_validator.password, req.app.state.password_policy), # added attribute that does not exist in UserValidator
         **user_validator.model_dump(exclude={'password'}) # excluding password, because 'Users' do not have a password attribute
         # role attribute is assigned to 'user' by default
         # TODO: Admins creation only by other admins.
@@ -58,7 +73,8 @@ async def create_user(db_session: db_dependency, user_validator: models.UserVali
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="User already exists!")
     except Exception as err:
         db_session.rollback()
-        print('Unexpected Error:', str(err))
+        # JSON error log, with the request id of the access log line (see utils/logs.py)
+        logs.error_logger.exception("Unexpected error creating user", extra={"fields": {"username": user_validator.username}})
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(err))
 
 
@@ -72,13 +88,15 @@ async def create_user(db_session: db_dependency, user_validator: models.UserVali
 # OAuth2PasswordRequestForm is a CLASS DEPENDENCY provided in FastAPI, for handling form-based authentication. That's why we use Depends(). It declares a FastAPI dependency.
 # The response_model allows Swagger to add documentation of the endpoint response
 @router.post(tokens.TOKEN_URL, response_model=models.TokenResponse, status_code=status.HTTP_200_OK)
-async def login_for_access_token(response: Response,
+async def login_for_access_token(req: Request,
+                                 response: Response,
                                  db_session: db_dependency,
+                                 keyring: keyring_dependency,
                                  form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
                                  refresh_token: Annotated[Union[str, None], Cookie()] = None):
     # form_data: {'grant_type', 'username', 'password', 'scopes', 'client_id', 'client_secret'}
 
-    user = authenticate_user(form_data.username, form_data.password, db_session)
+    user = authenticate_user(form_data.username, form_data.password, db_session, req.app.state.password_policy)
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Failed authentication")
 
@@ -95,12 +113,14 @@ async def login_for_access_token(response: Response,
     access_token = tokens.create_jwt(
         user_data=user_data,
         expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
-        db_session=db_session
+        db_session=db_session,
+        keyring=keyring,
     )
     new_ref_token, exp_datetime = tokens.create_jwt(
         user_data=user_data,
         expires_delta=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
         db_session=db_session,
+        keyring=keyring,
         is_refresh_token=True
     )
 
@@ -109,7 +129,7 @@ async def login_for_access_token(response: Response,
     #   - If the cookie is present, it belongs to a previous session
     #   - Here, we are invaliding the previous Refresh Token server-side before we extend another one
     if refresh_token is not None:
-        tokens.delete_jwt_from_db(db_session, refresh_token)
+        tokens.delete_jwt_from_db(db_session, refresh_token, keyring)
 
     # The REFRESH TOKEN will be sent via an http-only cookie. Parameters explanation:
     #   * samesite: Controls when cookies are included in requests. The options are:
@@ -139,21 +159,24 @@ async def login_for_access_token(response: Response,
     }
 
 @router.get(tokens.REFRESH_URL, response_model=models.TokenResponse, status_code=status.HTTP_200_OK)
-async def get_new_access_token(response: Response, rt_payload: token_dependency, db_session: db_dependency):
+async def get_new_access_token(response: Response, rt_payload: token_dependency, db_session: db_dependency, keyring: keyring_dependency):
     # If the code enters here, the app was able to obtain the payload from a valid refresh JWT, thanks to the token_dependency
-    # REFRESH TOKENS ROTATION: At this point, the used refresh token is already deleted from the database
+    # REFRESH TOKENS ROTATION: The new refresh token replaces the used one in its session (same family, new jti)
 
     new_access_token = tokens.create_jwt(
         user_data=rt_payload.get('user'),
         expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
-        db_session=db_session
+        db_session=db_session,
+        keyring=keyring,
     )
 
     # Preventing refresh token's lifetime extension beyond the lifetime of the initial refresh token
     new_refresh_token, exp_datetime = tokens.create_jwt(
         user_data=rt_payload.get('user'),
         previous_expiry=rt_payload.get('exp'),
+        previous_payload=rt_payload,
         db_session=db_session,
+        keyring=keyring,
         is_refresh_token=True
     )
 
@@ -175,10 +198,28 @@ async def get_new_access_token(response: Response, rt_payload: token_dependency,
 
 # FIXME! If the refresh_token cookie is not found, this will raise an HTTPException with 401 code. Is this ok?
 @router.delete(tokens.REFRESH_URL, status_code=status.HTTP_200_OK)
-async def logout(response: Response, rt_payload: token_dependency):
+async def logout(response: Response, rt_payload: token_dependency, db_session: db_dependency,
+                 keyring: keyring_dependency, denylist: denylist_dependency, access_token: optional_token_dependency = None):
     # If the code enters here, the app was able to obtain the payload from a valid refresh JWT, thanks to the token_dependency
-    # At this point, the used refresh token is already deleted from the database
+    # Revoking the session (the whole refresh token family) with a single DELETE
+    family_id, _ = tokens.get_token_ids(rt_payload)
+    tokens.revoke_token_family(db_session, family_id)
+
+    # If the access token is sent in the Authorization header, it is revoked as well (denylist)
+    tokens.revoke_access_token(access_token, db_session, keyring, denylist)
+
+    response.delete_cookie(key='refresh_token', path="/")
+
+    return {'detail': 'Logged out'}
+
+# Logout from all devices: every session of the user is revoked, as well as the access token used for this request.
+# The rest of the access tokens that were already issued remain valid until they expire (ACCESS_TOKEN_EXPIRE_MINUTES)
+@router.delete("/sessions", status_code=status.HTTP_200_OK)
+async def logout_all_devices(response: Response, user_data: user_dependency, db_session: db_dependency,
+                             keyring: keyring_dependency, denylist: denylist_dependency, access_token: optional_token_dependency = None):
+    revoked_sessions = tokens.revoke_user_sessions(db_session, user_data.get('user_id'))
+    tokens.revoke_access_token(access_token, db_session, keyring, denylist)
 
     response.delete_cookie(key='refresh_token', path="/")
 
-    return {'detail': 'Logged out'}
\ No newline at end of file
+    return {'detail': 'Logged out from all devices', 'revoked_sessions': revoked_sessions}
\ No newline at end of file
@@ -0,0 +1,26 @@
+from fastapi import APIRouter, Request, Response, status
+from utils.keyring import keyring_dependency
+
+router = APIRouter(
+    prefix="/.well-known",
+    tags=["jwks"]
+)
+
+# Verifiers are expected to cache the key set and download it again when they find an unknown 'kid'.
+# When rotating keys, the new key should be published (as a verification-only key) at least JWKS_MAX_AGE seconds
+# before it starts signing tokens.
+JWKS_MAX_AGE = 3600
+
+
+# JSON Web Key Set: the PUBLIC keys that other services use to verify our JWTs locally, without calling this app
+@router.get("/jwks.json", status_code=status.HTTP_200_OK)
+async def get_jwks(req: Request, response: Response, keyring: keyring_dependency):
+    etag = keyring.jwks_etag()
+    cache_headers = {"Cache-Control": f"public, max-age={JWKS_MAX_AGE}", "ETag": etag}
+
+    # Conditional request: the client already has this key set
+    if req.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+
+    response.headers.update(cache_headers)
+    return keyring.jwks()
@@ -1,8 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Path
-from typing import Annotated
-from sqlalchemy import and_
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status, Path, Query
+from typing import Annotated, Literal
+from sqlalchemy import and_, tuple_
 from sqlalchemy.orm import Session
-from database import db, models
+from database import models, shards
+from utils import idempotency, quotas, ranks, recurrence, scheduler, todo_changes
+from utils.single_flight import coalesce, forget_owner
 from utils.tokens import get_logged_in_user
 
 router = APIRouter(
@@ -15,52 +17,158 @@ router = APIRouter(
 # FastAPI use Annotated to specify dependencies for function parameters.
 # Annotated[Session, Depends(get_db)] indicates that the Session type should be resolved using the get_db dependency
 # FastAPI is able to call "next(get_db())" in order to get the Session object, and getting to the StopIteration exception, so that it can continue to execute dataB.close()
-db_dependency: type[Session] = Annotated[Session, Depends(db.get_db)]
+# The todos are stored in the shard of their owner (see database/shards.py). Without shards, get_todo_db is db.get_db
+db_dependency: type[Session] = Annotated[Session, Depends(shards.get_todo_db)]
+
+# Read-only routes: the session may come from a read replica (see database/db.py), or from the shard of the owner
+read_db_dependency: type[Session] = Annotated[Session, Depends(shards.get_todo_read_db)]
 
 # Every time this is used as a type, FastAPI will interpret it as a dependency, and will call the get_logged_in_user function.
 # The get_logged_in_user function gets the JWT in the Authorization header, validates it and returns the username, user_id and user_role if valid.
 # If something is wrong with the JWT, the function will raise an exception that is going to be handled by FastAPI.
 user_dependency: type[dict] = Annotated[dict, Depends(get_logged_in_user)]
 
-@router.get("/", status_code=status.HTTP_200_OK)
-async def read_all(user_data: user_dependency, db_session: db_dependency):
+# Soft-deleted todos (tombstones) are ignored by every query, until the archival job moves them to todos_archive
+def owned_todo(todo_id: int, user_id: int):
+    return and_(models.Todos.id == todo_id, models.Todos.owner_id == user_id, models.Todos.deleted_at.is_(None))
+
+# Keyset pagination (optional, every todo without limit): the next page is requested with after_id=<id of the last todo
+# of the current page>. A page shorter than limit is the last one.
+# order=position: the manual order of the user (see utils/ranks.py and PATCH /todo/{todo_id}/move), same after_id cursor
+# (the page starts after the current position of that todo, so a rebalance between two pages changes nothing)
+# Sync-Token header: the token of GET /todo/changes, read BEFORE the page. The changes made after it are not lost
+@router.get("/", status_code=status.HTTP_200_OK, response_model=list[models.TodoResponse])
+async def read_all(request: Request, response: Response, user_data: user_dependency, db_session: read_db_dependency,
+                   after_id: int | None = Query(default=None, gt=0),
+                   limit: int | None = Query(default=None, ge=1, le=500),
+                   order: Literal["id", "position"] = Query(default="id")):
     # If the code enters here, the app was able to obtain the user data from a valid JWT, thanks to the user_dependency
     # user_data { 'username', 'user_id', 'user_role' }
-    return db_session.query(models.Todos).filter(models.Todos.owner_id == user_data.get("user_id")).all()
+    owner_id = user_data.get("user_id")
+
+    def query_todos() -> tuple[int, list[dict]] | None:
+        token = todo_changes.current_token(db_session, owner_id)
+        query = (db_session.query(models.Todos)
+                 .filter(models.Todos.owner_id == owner_id, models.Todos.deleted_at.is_(None)))
+        if order == "position":
+            if after_id is not None:
+                # The cursor todo may have been deleted since the previous page: its row (tombstone) is still there
+                cursor = (db_session.query(models.Todos.position, models.Todos.id)
+                          .filter(models.Todos.owner_id == owner_id, models.Todos.id == after_id).first())
+                if cursor is None:
+                    return None
+                query = query.filter(tuple_(models.Todos.position, models.Todos.id) > tuple_(cursor.position, cursor.id))
+            query = query.order_by(models.Todos.position, models.Todos.id)
+        else:
+            if after_id is not None:
+                query = query.filter(models.Todos.id > after_id)
+            query = query.order_by(models.Todos.id)
+        todos = query.limit(limit).all() if limit is not None else query.all()
+        return token, [models.TodoResponse.model_validate(todo).model_dump() for todo in todos]
+
+    # SINGLE-FLIGHT: identical concurrent reads of the same owner share one query (see utils/single_flight.py)
+    page = await coalesce(request, (owner_id, "todos", order, after_id, limit), query_todos)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Todo not found")
+    token, todos = page
+    response.headers["Sync-Token"] = str(token)
+    return todos
+
+# Declared before "/{todo_id}", otherwise "archive" would be parsed as a todo_id
+# Keyset pagination: the next page is requested with before_id=<id of the last todo of the current page>
+@router.get("/archive", status_code=status.HTTP_200_OK, response_model=list[models.TodoResponse])
+async def read_archive(request: Request, user_data: user_dependency, db_session: read_db_dependency,
+                       before_id: int | None = Query(default=None, gt=0),
+                       limit: int = Query(default=20, ge=1, le=100)):
+    owner_id = user_data.get("user_id")
+
+    def query_archive() -> list[dict]:
+        query = (db_session.query(models.TodosArchive)
+                 .filter(models.TodosArchive.owner_id == owner_id, models.TodosArchive.deleted_at.is_(None)))
+        if before_id is not None:
+            query = query.filter(models.TodosArchive.id < before_id)
+        todos = query.order_by(models.TodosArchive.id.desc()).limit(limit).all()
+        return [models.TodoResponse.model_validate(todo).model_dump() for todo in todos]
+
+    return await coalesce(request, (owner_id, "archive", before_id, limit), query_archive)
+
+# DELTA SYNC (see utils/todo_changes.py): the todos created, updated or deleted since the token of the previous sync.
+# The first sync is since=0. While has_more is true, the next page is requested with since=<token>
+@router.get("/changes", status_code=status.HTTP_200_OK, response_model=models.TodoChangesResponse)
+async def read_changes(request: Request, user_data: user_dependency, db_session: read_db_dependency,
+                       since: int = Query(default=0, ge=0),
+                       limit: int = Query(default=todo_changes.DEFAULT_PAGE_SIZE, ge=1, le=1000)):
+    owner_id = user_data.get("user_id")
+
+    def query_changes() -> dict:
+        return todo_changes.read_changes(db_session, owner_id, since, limit)
+
+    return await coalesce(request, (owner_id, "changes", since, limit), query_changes)
 
-@router.get("/{todo_id}", status_code=status.HTTP_200_OK)
-async def read_one(user_data: user_dependency, db_session: db_dependency, todo_id: int = Path(gt=0)):
+@router.get("/{todo_id}", status_code=status.HTTP_200_OK, response_model=models.TodoResponse)
+async def read_one(request: Request, user_data: user_dependency, db_session: read_db_dependency, todo_id: int = Path(gt=0)):
     # If the code enters here, the app was able to obtain the user data from a valid JWT, thanks to the user_dependency
     # user_data { 'username', 'user_id', 'user_role' }
-    todo_model = (db_session.query(models.Todos)
-                  .filter(and_(models.Todos.id == todo_id, models.Todos.owner_id == user_data.get("user_id")))
-                  .first())
-    if todo_model is not None:
-        return todo_model
+    owner_id = user_data.get("user_id")
+
+    def query_todo() -> dict | None:
+        todo_model = db_session.query(models.Todos).filter(owned_todo(todo_id, owner_id)).first()
+        return None if todo_model is None else models.TodoResponse.model_validate(todo_model).model_dump()
+
+    todo = await coalesce(request, (owner_id, "todo", todo_id), query_todo)
+    if todo is not None:
+        return todo
     raise HTTPException(status_code=404, detail="Todo not found")
 
-@router.post("/", status_code=status.HTTP_201_CREATED)
-async def create_todo(db_session: db_dependency, user_data: user_dependency,
+# QUOTAS (see utils/quotas.py): the write routes check the quota of the owner, and send its headers.
+# After the idempotency key, so a replayed response does not use the quota again
+@router.post("/", status_code=status.HTTP_201_CREATED, response_model=models.TodoCreatedResponse,
+             dependencies=[Depends(idempotency.user_idempotency_key), Depends(quotas.todo_create_quota)])
+async def create_todo(request: Request, db_session: db_dependency, user_data: user_dependency,
                       todo_validator: models.TodoValidator):
     # If the code enters here, it means that the app was able to obtain the user data from a valid JWT, thanks to the user_dependency
     # user_data { 'username', 'user_id', 'user_role' }
     # **: passing key-values to Todos as parameters
+    # With shards, the id comes from the primary, so it is unique in every shard
     todo_model = models.Todos(
+        id=shards.new_todo_id(request),
         owner_id=user_data.get("user_id"),
         **todo_validator.model_dump()
     )
+
+    # GROUP COMMIT (opt-in, see utils/group_commit.py): the row is inserted with the rows of other requests, in one commit
+    batcher = request.app.state.todo_batcher
+    if batcher is not None and batcher.running:
+        values = {"owner_id": todo_model.owner_id, **todo_validator.model_dump()}
+        if todo_model.id is not None:
+            values["id"] = todo_model.id
+        todo_id = await batcher.submit(db_session.get_bind(), values)
+        forget_owner(request, todo_model.owner_id)
+        scheduler.notify_due(request, todo_validator.due_at)
+        return {"id": todo_id}
+
+    # DELTA SYNC: the change number is taken in the transaction of the insert
+    todo_model.change_seq = todo_changes.next_seq(db_session, todo_model.owner_id)
+    # MANUAL ORDERING: at the end of the list. The counter lock above serializes the creates and moves of the owner
+    todo_model.position = ranks.next_position(db_session, todo_model.owner_id)
     db_session.add(todo_model)
+    # The id (autoincrement without shards) is known after the flush: read before the commit expires the object
+    db_session.flush()
+    todo_id = todo_model.id
     db_session.commit()
+    # The next reads of the owner must not join a query that started before this write
+    forget_owner(request, todo_model.owner_id)
+    # A todo due in the next minutes gets into the heap of the due-time scheduler now, not at its next scan
+    scheduler.notify_due(request, todo_validator.due_at)
+    return {"id": todo_id}
 
-@router.put("/{todo_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def update_todo(user_data: user_dependency, db_session: db_dependency,
+@router.put("/{todo_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(quotas.todo_write_quota)])
+async def update_todo(request: Request, user_data: user_dependency, db_session: db_dependency,
                       todo_validator: models.TodoValidator,
                       todo_id: int = Path(gt=0)):
     # If the code enters here, the app was able to obtain the user data from a valid JWT, thanks to the user_dependency
     # user_data { 'username', 'user_id', 'user_role' }
-    todo_model = (db_session.query(models.Todos)
-                  .filter(and_(models.Todos.id == todo_id, models.Todos.owner_id == user_data.get("user_id")))
-                  .first())
+    todo_model = db_session.query(models.Todos).filter(owned_todo(todo_id, user_data.get("user_id"))).first()
     if todo_model is None:
         raise HTTPException(status_code=404, detail="Todo not found")
 
@@ -70,23 +178,62 @@ async def update_todo(user_data: user_dependency, db_session: db_dependency,
     todo_model.description = todo_validator.description
     todo_model.priority = todo_validator.priority
     todo_model.completed = todo_validator.completed
+    todo_model.due_at = todo_validator.due_at
+    todo_model.recurrence = todo_validator.recurrence
+    # RECURRING TODO (see utils/recurrence.py): completing it completes its current occurrence. It stays open, due at
+    # the next occurrence after now. After the last occurrence, it is completed
+    if todo_validator.completed and todo_validator.recurrence is not None:
+        following = recurrence.next_occurrence(todo_validator.recurrence, todo_validator.due_at, models.utc_now())
+        if following is not None:
+            todo_model.completed = False
+            todo_model.due_at, todo_model.recurrence = following
+    todo_model.change_seq = todo_changes.next_seq(db_session, todo_model.owner_id)
+    due_at = todo_model.due_at
 
     # We have to use the same object, so our ORM understands that we are updating a record
     db_session.add(todo_model)
     db_session.commit()
+    forget_owner(request, user_data.get("user_id"))
+    scheduler.notify_due(request, due_at)
+
+# MANUAL ORDERING (see utils/ranks.py): only the moved todo is updated, it gets a position between its new neighbours
+@router.patch("/{todo_id}/move", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(quotas.todo_write_quota)])
+async def move_todo(request: Request, user_data: user_dependency, db_session: db_dependency,
+                    move_validator: models.TodoMoveValidator,
+                    todo_id: int = Path(gt=0)):
+    owner_id = user_data.get("user_id")
+    anchor_id = move_validator.after_id or move_validator.before_id
+    if anchor_id == todo_id:
+        raise HTTPException(status_code=422, detail="A todo can not be moved next to itself")
 
-@router.delete("/{todo_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_todo(user_data: user_dependency, db_session: db_dependency, todo_id: int = Path(gt=0)):
+    # The counter lock first (same order as the other writes): two moves of the owner can not pick the same gap
+    change_seq = todo_changes.next_seq(db_session, owner_id)
+    todo_model = db_session.query(models.Todos).filter(owned_todo(todo_id, owner_id)).first()
+    anchor_model = db_session.query(models.Todos).filter(owned_todo(anchor_id, owner_id)).first()
+    if todo_model is None or anchor_model is None:
+        raise HTTPException(status_code=404, detail="Todo not found")
+
+    ranks.move_next_to(db_session, todo_model, anchor_model, after=move_validator.after_id is not None)
+    todo_model.change_seq = change_seq
+    db_session.add(todo_model)
+    db_session.commit()
+    forget_owner(request, owner_id)
+
+@router.delete("/{todo_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(quotas.todo_write_quota)])
+async def delete_todo(request: Request, user_data: user_dependency, db_session: db_dependency, todo_id: int = Path(gt=0)):
     # If the code enters here, the app was able to obtain the user data from a valid JWT, thanks to the user_dependency
     # user_data { 'username', 'user_id', 'user_role' }
-    todo_model = (db_session.query(models.Todos)
-                  .filter(and_(models.Todos.id == todo_id, models.Todos.owner_id == user_data.get("user_id")))
-                  .first())
+    todo_model = db_session.query(models.Todos).filter(owned_todo(todo_id, user_data.get("user_id"))).first()
     if todo_model is None:
         raise HTTPException(status_code=404, detail="Todo not found")
 
-    db_session.delete(todo_model)
+    # SOFT DELETE: the row stays in the table as a tombstone, the archival job moves it to todos_archive later
+    todo_model.deleted_at = models.utc_now()
+    todo_model.change_seq = todo_changes.next_seq(db_session, todo_model.owner_id)
+    db_session.add(todo_model)
     db_session.commit()
+    request.app.state.quotas.record_delete(todo_model.owner_id)
+    forget_owner(request, user_data.get("user_id"))
 
 
 """
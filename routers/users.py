@@ -1,17 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Body
+from fastapi import APIRouter, Depends, HTTPException, status, Body, Request
 from typing import Annotated
-from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 from database import db, models
+from utils import passwords
 from utils.tokens import get_logged_in_user
+from utils.user_loader import profile_dependency, invalidate_user_profile
 
 router = APIRouter(
     prefix="/user",
     tags=["user"]
 )
 
-bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 # Annotated[T, x]: T is the base type, x is the metadata. If the tool do not have logic to interpret x, it is treated simply as T
 # Annotated[Session, Depends(get_db)] indicates that the Session type should be resolved using the get_db dependency
 db_dependency: type[Session] = Annotated[Session, Depends(db.get_db)]
@@ -23,35 +22,40 @@ user_dependency: type[dict] = Annotated[dict, Depends(get_logged_in_user)]
 
 
 @router.get("/", status_code=status.HTTP_200_OK)
-async def get_user(user_data: user_dependency, db_session: db_dependency):
-    user_model = db_session.query(models.Users).filter(models.Users.id == user_data.get("user_id")).first()
-
-    if user_model is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-
-    return user_model
+async def get_user(profile: profile_dependency):
+    # If the code enters here, the user exists. The profile was loaded (or taken from the cache) by the profile_dependency
+    return profile
 
 @router.put("/change_password", status_code=status.HTTP_204_NO_CONTENT)
-async def change_password(user_data: user_dependency, db_session: db_dependency, pass_body: models.UserVerification):
-    user_model: models.Users | None = db_session.query(models.Users).filter(models.Users.id == user_data.get("user_id")).first()
+async def change_password(req: Request, user_data: user_dependency, db_session: db_dependency, pass_body: models.UserVerification):
+    # Only the column that is needed to verify the old password
+    hashed_password: str | None = (db_session.query(models.Users.hashed_password)
+                                   .filter(models.Users.id == user_data.get("user_id"))
+                                   .scalar())
 
-    if user_model is None:
+    if hashed_password is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    if not bcrypt_context.verify(pass_body.old_password, user_model.hashed_password):
+    policy: passwords.PasswordPolicy = req.app.state.password_policy
+    if not passwords.verify_password(pass_body.old_password, hashed_password, policy):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Error on password change")
 
-    user_model.hashed_password = bcrypt_context.hash(pass_body.new_password)
-    db_session.add(user_model)
+    (db_session.query(models.Users)
+     .filter(models.Users.id == user_data.get("user_id"))
+     .update({models.Users.hashed_password: passwords.hash_password(pass_body.new_password, policy)}, synchronize_session=False))
     db_session.commit()
+    invalidate_user_profile(req, user_data.get("user_id"))
 
 @router.put("/change_phone_number", status_code=status.HTTP_204_NO_CONTENT)
-async def change_phone_number(user_data: user_dependency, db_session: db_dependency, body_request: models.UserPhoneValidator):
-    user_model: models.Users | None = db_session.query(models.Users).filter(models.Users.id == user_data.get("user_id")).first()
-
-    if user_model is None:
+async def change_phone_number(req: Request, user_data: user_dependency, db_session: db_dependency, body_request: models.UserPhoneValidator):
+    # A single UPDATE statement. If no row was updated, the user does not exist
+    updated_rows = (db_session.query(models.Users)
+                    .filter(models.Users.id == user_data.get("user_id"))
+                    .update({models.Users.phone_number: body_request.phone_number}, synchronize_session=False))
+
+    if updated_rows == 0:
+        db_session.rollback()
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    user_model.phone_number = body_request.phone_number
-    db_session.add(user_model)
     db_session.commit()
+    invalidate_user_profile(req, user_data.get("user_id"))
@@ -0,0 +1,380 @@
+"""
+MULTI-PROCESS SERVER (pre-fork master + uvicorn workers)
+    python serve.py [--workers N] [--host 0.0.0.0] [--port 8000] [--max-requests 10000] [--max-memory-mb 512]
+
+- WORKERS: one per CPU that this process may use (or WEB_CONCURRENCY, or --workers). They all accept connections
+  from the same listening socket, opened by the master
+- PRELOAD: the master imports main and creates the app (and the database tables, once) BEFORE forking, so the workers
+  start in milliseconds and share the memory of the imported modules (copy-on-write). The master never opens a
+  database connection that the workers could inherit: its engines are disposed before the first fork
+- Each worker runs uvicorn with uvloop and httptools when they are installed (loop="auto", http="auto"), and runs the
+  lifespan of the app (log shipper, background jobs, group commit batcher): the background jobs run in every worker
+- GRACEFUL RELOAD (kill -HUP <master pid>): the workers are replaced one by one. A new worker is started, and the old
+  one is only stopped (SIGTERM: it stops accepting, finishes its requests) when the new one is ready. A new worker
+  that fails to start stops the reload, the old workers keep serving
+- RECYCLING: a worker exits gracefully after --max-requests requests (plus a random --max-requests-jitter, so they
+  don't all restart at once) or when its resident memory goes over --max-memory-mb. The master starts another one
+- STOP (SIGTERM / SIGINT / Ctrl+C): the workers get --graceful-timeout seconds to finish their requests
+- CONNECTION POOLS: with DB_MAX_CONNECTIONS set, the pool of each worker is lowered so that all of them together
+  (plus the extra worker of a reload) stay under it (see size_pools)
+
+With preloading, a reload starts the workers from the code that the master imported. To run new code, restart the
+master, or run it with --no-preload (each worker imports main itself; only utils/settings.py stays the master's).
+"""
+import argparse, asyncio, os, random, select, signal, socket, sys, time
+from utils.settings import Settings
+
+MASTER_SIGNALS = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+# How often the workers check their memory (uvicorn ticks every 0.1 second)
+MEMORY_CHECK_TICKS = 50
+# A stopping worker stops accepting first, and gives this time to the connections it has just accepted to send their
+# request (uvicorn closes the connections without a request in progress: the client would get an empty reply)
+ACCEPTED_GRACE_SECONDS = 0.5
+# A worker that exits before it is ready is not restarted sooner than this (a broken app would fork in a loop)
+RESPAWN_DELAY_SECONDS = 1.0
+
+
+def default_workers() -> int:
+    if os.getenv("WEB_CONCURRENCY"):
+        return int(os.environ["WEB_CONCURRENCY"])
+    # The CPUs this process may run on (containers, taskset), not the ones of the machine
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def size_pools(settings: Settings, workers: int) -> Settings:
+    # Every engine of every worker may open pool_size + max_overflow connections. With db_max_connections, they are
+    # lowered so that (workers + 1) processes fit: during a graceful reload, a new worker runs next to the old ones
+    if settings.db_max_connections <= 0:
+        return settings
+    per_worker = min(settings.db_max_connections // (workers + 1), settings.db_pool_size + settings.db_max_overflow)
+    if per_worker < 1:
+        raise ValueError(f"DB_MAX_CONNECTIONS={settings.db_max_connections} is not enough for {workers} workers "
+                         f"(at least {workers + 1} connections)")
+    pool_size = min(settings.db_pool_size, per_worker)
+    return settings.model_copy(update={"db_pool_size": pool_size, "db_max_overflow": per_worker - pool_size})
+
+
+def resident_memory_mb() -> float:
+    # Current RSS (Linux). Elsewhere 0: memory recycling is disabled
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def log(message: str):
+    print(f"[serve {os.getpid()}] {message}", file=sys.stderr, flush=True)
+
+
+def load_app(settings: Settings):
+    from main import create_app
+    return create_app(settings)
+
+
+def prepare(settings: Settings, create_tables: bool):
+    # The app of the workers. The tables are created once for all of them (the workers have create_tables=False)
+    import main
+    app = load_app(settings)
+    if create_tables:
+        main.create_tables(app)
+    main.dispose_engines(app)
+    return app
+
+
+### WORKER PROCESS ###
+def worker_server_class():
+    import uvicorn
+
+    class WorkerServer(uvicorn.Server):
+        def __init__(self, config: uvicorn.Config, ready_fd: int, max_requests: int, max_memory_mb: float):
+            super().__init__(config)
+            self.ready_fd = ready_fd
+            self.max_requests = max_requests
+            self.max_memory_mb = max_memory_mb
+            # Counted here: uvicorn's limit_max_requests misses the requests sent with "Connection: close"
+            self.requests = 0
+
+        async def startup(self, sockets=None):
+            await super().startup(sockets)
+            if not self.should_exit:
+                # The lifespan ran and the socket is served: the master can stop the worker this one replaces
+                os.write(self.ready_fd, b"1")
+            os.close(self.ready_fd)
+
+        async def shutdown(self, sockets=None):
+            for server in self.servers:
+                server.close()
+            await asyncio.sleep(ACCEPTED_GRACE_SECONDS)
+            await super().shutdown(sockets)
+
+        async def on_tick(self, counter: int) -> bool:
+            if await super().on_tick(counter):
+                return True
+            if self.max_requests and self.requests >= self.max_requests:
+                log(f"{self.requests} requests served, recycling the worker")
+                return True
+            if self.max_memory_mb and counter % MEMORY_CHECK_TICKS == 0:
+                memory_mb = resident_memory_mb()
+                if memory_mb > self.max_memory_mb:
+                    log(f"Memory {memory_mb:.0f} MB > {self.max_memory_mb:.0f} MB, recycling the worker")
+                    return True
+            return False
+
+    return WorkerServer
+
+
+def run_worker(listener: socket.socket, ready_fd: int, app, settings: Settings, options: argparse.Namespace):
+    import uvicorn
+    if app is None:
+        app = load_app(settings)
+
+    async def counting_app(scope, receive, send):
+        if scope["type"] == "http":
+            server.requests += 1
+        await app(scope, receive, send)
+
+    max_requests = options.max_requests + random.randint(0, options.max_requests_jitter) if options.max_requests else 0
+    config = uvicorn.Config(
+        counting_app, loop="auto", http="auto", lifespan="on",
+        # The JSON access log of the app (utils/logs.py) replaces the one of uvicorn
+        access_log=False,
+        timeout_graceful_shutdown=options.graceful_timeout,
+    )
+    server = worker_server_class()(config, ready_fd, max_requests, options.max_memory_mb)
+    server.run(sockets=[listener])
+
+
+### MASTER PROCESS ###
+class Worker:
+    def __init__(self, pid: int, ready_fd: int):
+        self.pid = pid
+        self.ready_fd: int | None = ready_fd
+        self.ready = False
+        # Stopped by the master (reload or shutdown): not replaced when it exits
+        self.retiring = False
+
+
+class Supervisor:
+    def __init__(self, listener: socket.socket, app, settings: Settings, options: argparse.Namespace):
+        self.listener = listener
+        self.app = app
+        self.settings = settings
+        self.options = options
+        self.workers: dict[int, Worker] = {}
+        self.stopping = False
+        self.reload_requested = False
+        # Graceful reload: the old workers that still have to be replaced, and the new worker that replaces the first one
+        self.to_replace: list[int] = []
+        self.replacement: int | None = None
+        self.next_spawn_at = 0.0
+
+    def spawn(self) -> Worker:
+        read_fd, write_fd = os.pipe()
+        # Blocked until the child has its own handlers: a SIGTERM sent right after the fork must not run the handler
+        # of the master in the child (it would be lost)
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                # Ctrl+C reaches the whole process group: the master stops the workers itself. SIGHUP is only for the master
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+                os.close(read_fd)
+                for worker in self.workers.values():
+                    if worker.ready_fd is not None:
+                        os.close(worker.ready_fd)
+                run_worker(self.listener, write_fd, self.app, self.settings, self.options)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                # Never back in the loop of the master
+                os._exit(exit_code)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+        os.close(write_fd)
+        worker = self.workers[pid] = Worker(pid, read_fd)
+        return worker
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reload_requested = True
+        else:
+            self.stopping = True
+
+    def run(self) -> int:
+        for signum in MASTER_SIGNALS:
+            signal.signal(signum, self.handle_signal)
+        log(f"Listening on {self.options.host}:{self.listener.getsockname()[1]} with {self.options.workers} workers")
+
+        while not self.stopping:
+            self.start_reload()
+            self.read_ready_pipes(timeout=0.2)
+            self.reap()
+            self.continue_reload()
+            self.keep_workers()
+        return self.shutdown()
+
+    def read_ready_pipes(self, timeout: float):
+        fds = {worker.ready_fd: worker for worker in self.workers.values() if worker.ready_fd is not None}
+        if not fds:
+            time.sleep(timeout)
+            return
+        try:
+            readable, _, _ = select.select(list(fds), [], [], timeout)
+        except InterruptedError:
+            return
+        for fd in readable:
+            worker = fds[fd]
+            # b"1": ready. Empty: the worker closed the pipe without being ready (it is exiting)
+            worker.ready = os.read(fd, 1) == b"1"
+            os.close(fd)
+            worker.ready_fd = None
+            if worker.ready:
+                log(f"Worker {worker.pid} ready")
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, wait_status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.ready_fd is not None:
+                os.close(worker.ready_fd)
+            log(f"Worker {pid} exited ({self.describe(wait_status)})")
+            if not worker.ready:
+                self.next_spawn_at = time.monotonic() + RESPAWN_DELAY_SECONDS
+
+    @staticmethod
+    def describe(wait_status: int) -> str:
+        if os.WIFSIGNALED(wait_status):
+            return signal.Signals(os.WTERMSIG(wait_status)).name
+        return f"exit code {os.waitstatus_to_exitcode(wait_status)}"
+
+    def keep_workers(self):
+        # Replaces the workers that exited (recycled or crashed). During a reload, the replacement is the extra one
+        active = [worker for worker in self.workers.values() if not worker.retiring and worker.pid != self.replacement]
+        if len(active) < self.options.workers and time.monotonic() >= self.next_spawn_at:
+            self.spawn()
+
+    def start_reload(self):
+        if not self.reload_requested:
+            return
+        self.reload_requested = False
+        if self.to_replace:
+            log("Reload already in progress")
+            return
+        log("Reloading the workers")
+        self.to_replace = [pid for pid, worker in self.workers.items() if not worker.retiring]
+
+    def continue_reload(self):
+        if self.replacement is not None:
+            worker = self.workers.get(self.replacement)
+            if worker is None:
+                log("A new worker failed to start, the reload is stopped (the old workers keep serving)")
+                self.to_replace, self.replacement = [], None
+                return
+            if not worker.ready:
+                return
+            old = self.workers.get(self.to_replace.pop(0))
+            if old is not None:
+                old.retiring = True
+                os.kill(old.pid, signal.SIGTERM)
+            self.replacement = None
+
+        # The next old worker (the ones that already exited, recycled meanwhile, have been replaced by keep_workers)
+        while self.to_replace and self.to_replace[0] not in self.workers:
+            self.to_replace.pop(0)
+        if self.to_replace:
+            self.replacement = self.spawn().pid
+
+    def shutdown(self) -> int:
+        log("Stopping the workers")
+        for worker in self.workers.values():
+            worker.retiring = True
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.options.graceful_timeout + 5
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        for worker in self.workers.values():
+            log(f"Worker {worker.pid} did not stop in time, killing it")
+            os.kill(worker.pid, signal.SIGKILL)
+        while self.workers:
+            self.reap()
+            time.sleep(0.05)
+        self.listener.close()
+        return 0
+
+
+def bind(host: str, port: int) -> socket.socket:
+    listener = socket.create_server((host, port), family=socket.AF_INET6 if ":" in host else socket.AF_INET, backlog=2048)
+    listener.set_inheritable(True)
+    return listener
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-requests", type=int, default=0, help="Recycle a worker after this many requests (0: never)")
+    parser.add_argument("--max-requests-jitter", type=int, default=0)
+    parser.add_argument("--max-memory-mb", type=float, default=0, help="Recycle a worker above this RSS (0: never)")
+    parser.add_argument("--graceful-timeout", type=int, default=30, help="Seconds given to a worker to finish its requests")
+    parser.add_argument("--no-preload", dest="preload", action="store_false",
+                        help="Import the app in each worker (a reload runs the new code)")
+    options = parser.parse_args(argv)
+    if options.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    settings = Settings.from_env()
+    try:
+        worker_settings = size_pools(settings, options.workers)
+    except ValueError as err:
+        raise SystemExit(str(err))
+    if worker_settings.db_max_connections > 0:
+        log(f"Database pool per worker: {worker_settings.db_pool_size} + {worker_settings.db_max_overflow} overflow")
+
+    if not hasattr(os, "fork"):
+        # No fork (Windows): a single uvicorn process
+        import uvicorn
+        uvicorn.run(load_app(worker_settings), host=options.host, port=options.port, access_log=False)
+        return 0
+
+    listener = bind(options.host, options.port)
+    worker_settings = worker_settings.model_copy(update={"create_tables": False})
+    if options.preload:
+        app = prepare(worker_settings, settings.create_tables)
+    else:
+        app = None
+        # In a short-lived child, so that the master does not import main
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                prepare(worker_settings, settings.create_tables)
+                exit_code = 0
+            finally:
+                os._exit(exit_code)
+        if os.waitpid(pid, 0)[1] != 0:
+            raise SystemExit("The app could not be created")
+    return Supervisor(listener, app, worker_settings, options).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+/*
+* SHARED FETCH CLIENT (every page uses apiFetch instead of fetch for the API)
+ - Access token in sessionStorage, sent in the Authorization header. Refresh token in an HTTP-only cookie
+ - SINGLE-FLIGHT REFRESH: the refresh token is rotated on every use, and reusing an old one revokes the whole session
+   (see get_payload_from_refresh_token). So there is only ONE /auth/refresh in flight: the calls that need a new access
+   token at the same time wait for it, instead of sending their own refresh with the same (soon invalid) cookie.
+   Between tabs, the Web Locks API does the same (the cookie is shared, a tab refreshes after the other one finished)
+ - PROACTIVE REFRESH: a token that expires in less than REFRESH_MARGIN_SECONDS is refreshed before the request,
+   so most requests never get a 401. A 401 still triggers one refresh and one retry
+ - DEDUPLICATION: identical GET requests that are in flight at the same time share one network request
+ - POST requests get an Idempotency-Key, so the retry after a refresh can never create a second todo
+* */
+
+const ACCESS_TOKEN_KEY = 'access_token';
+const REFRESH_URL = '/auth/refresh';
+const REFRESH_MARGIN_SECONDS = 30;
+const REFRESH_LOCK = 'todoapp-auth-refresh';
+
+let refreshInFlight = null; // Promise<boolean> of the refresh that is running, shared by every caller
+const getsInFlight = new Map(); // url -> Promise<Response> of the GET that is running
+
+export const getAccessToken = () => window.sessionStorage.getItem(ACCESS_TOKEN_KEY);
+
+export const setAccessToken = (accessToken) => window.sessionStorage.setItem(ACCESS_TOKEN_KEY, accessToken);
+
+export const clearAccessToken = () => window.sessionStorage.removeItem(ACCESS_TOKEN_KEY);
+
+// Seconds since the epoch (JWT "exp" claim), or null if the token can not be read. The signature is the server's business
+const tokenExpiry = (accessToken) => {
+    try {
+        const payload = accessToken.split('.')[1].replace(/-/g, '+').replace(/_/g, '/');
+        return JSON.parse(atob(payload)).exp ?? null;
+    } catch (error) {
+        return null;
+    }
+}
+
+const expiresSoon = (accessToken) => {
+    const exp = tokenExpiry(accessToken);
+    return exp !== null && exp - Date.now() / 1000 < REFRESH_MARGIN_SECONDS;
+}
+
+const requestNewAccessToken = async () => {
+    const response = await fetch(REFRESH_URL, {method: 'GET', credentials: 'same-origin'});
+    if (!response.ok) {
+        return false;
+    }
+    const responseData = await response.json();
+    if (!('access_token' in responseData)) {
+        return false;
+    }
+    setAccessToken(responseData.access_token);
+    return true;
+}
+
+/*
+* Every caller gets the promise of the refresh that is already running, if any. It is forgotten when it ends,
+* so the next expiry starts a new one
+* */
+export const refreshAccessToken = () => {
+    if (refreshInFlight === null) {
+        const refresh = navigator.locks
+            ? navigator.locks.request(REFRESH_LOCK, requestNewAccessToken)
+            : requestNewAccessToken();
+        refreshInFlight = refresh
+            .catch((error) => {
+                console.log(`Error: ${error}`);
+                return false;
+            })
+            .finally(() => { refreshInFlight = null; });
+    }
+    return refreshInFlight;
+}
+
+const redirectToLogin = () => {
+    clearAccessToken();
+    window.location.href = '/login-page';
+}
+
+const sendWithToken = (url, options) => {
+    const headers = new Headers(options.headers || {});
+    const accessToken = getAccessToken();
+    if (accessToken) {
+        headers.set('Authorization', `Bearer ${accessToken}`);
+    }
+    return fetch(url, {...options, headers});
+}
+
+const send = async (url, options) => {
+    const accessToken = getAccessToken();
+    if (accessToken && expiresSoon(accessToken)) {
+        // Not an error if it fails: the request is sent anyway, and its 401 is handled below
+        await refreshAccessToken();
+    }
+
+    const sentToken = getAccessToken();
+    const response = await sendWithToken(url, options);
+    if (response.status !== 401) {
+        return response;
+    }
+
+    // The access token expired (or was revoked): one refresh, shared with the other requests, and one retry.
+    // If another request already replaced the token that was sent, the retry just uses the new one
+    if (getAccessToken() === sentToken && !(await refreshAccessToken())) {
+        redirectToLogin();
+        return response;
+    }
+    return await sendWithToken(url, options);
+}
+
+/*
+* fetch() for the API. Returns a Response, as fetch does.
+* Options: the ones of fetch. JSON bodies can be passed as "json" (Content-Type and stringify are done here)
+* */
+export const apiFetch = (url, {json, ...options} = {}) => {
+    const method = (options.method || 'GET').toUpperCase();
+    if (json !== undefined) {
+        options.headers = {'Content-Type': 'application/json', ...(options.headers || {})};
+        options.body = JSON.stringify(json);
+    }
+    // crypto.randomUUID only exists in secure contexts (https, localhost)
+    if (method === 'POST' && window.crypto?.randomUUID) {
+        options.headers = {'Idempotency-Key': window.crypto.randomUUID(), ...(options.headers || {})};
+    }
+    options.method = method;
+
+    if (method !== 'GET') {
+        return send(url, options);
+    }
+
+    // Every caller of the same GET gets its own copy of the shared response (a body can only be read once)
+    let shared = getsInFlight.get(url);
+    if (!shared) {
+        shared = send(url, options).finally(() => getsInFlight.delete(url));
+        getsInFlight.set(url, shared);
+    }
+    return shared.then((response) => response.clone());
+}
+
+/* Logout: revokes the session (refresh token family) and the access token */
+export const logout = async () => {
+    try {
+        await sendWithToken(REFRESH_URL, {method: 'DELETE'});
+    } catch (error) {
+        console.error(`Couldn't call logout endpoint. Error: ${error}`);
+    }
+    redirectToLogin();
+}
@@ -1,4 +1,6 @@
 
+import { apiFetch } from './api.js';
+
 /*
 * CREATE A NEW TODO
 * */
@@ -23,17 +25,8 @@ if (todoForm) {
         };
         
         try {
-            // Will throw an exception if the cookie is not found
-            const accessToken = getCookie('access_token', 'Authentication token not found');
-            
-            const response = await fetch('/todo/', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${accessToken}`
-                },
-                body: JSON.stringify(payload)
-            });
+            // The access token (and its refresh) is handled by apiFetch, see api.js
+            const response = await apiFetch('/todo/', {method: 'POST', json: payload});
             
             if (response.ok){
                 form.reset(); // Clearing the form
@@ -74,17 +67,7 @@ if(editTodoForm){
         };
         
         try {
-            // Will throw an exception if the cookie is not found
-            const accessToken = getCookie('access_token', 'Authentication token not found');
-            
-            const response = await fetch(`/todo/${todoId}`, {
-                method: 'PUT',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${accessToken}`
-                },
-                body: JSON.stringify(payload)
-            });
+            const response = await apiFetch(`/todo/${todoId}`, {method: 'PUT', json: payload});
             
             if (response.ok){
                 // Redirecting to the TODO page
@@ -116,33 +99,4 @@ if (deleteTodoButton) {
     })
 }
 
-
-/*
-* HELPERS
-* */
-const getCookie = (cookieName, errorMessage = 'Cookie not found') => {
-    const cookie = 'FIXME: tempCookie';
-    
-    if(!cookie) {
-        throw new Error(errorMessage);
-    }
-    return cookie;
-}
-
-
-/* LOGOUT */
-
-const logout = async () => {
-    try{
-        const response = await fetch('/auth/refresh', {
-            method: 'DELETE'
-        });
-        // TODO: Delete access_token from sessionStorage
-        const responseData = await response.json();
-        console.log(responseData);
-    } catch (error){
-        console.error(`Couldn't call logout endpoint. Error: ${error}`)
-    }
-}
-
-// TODO: DELETE access_token from sessionStorage
+/* LOGOUT: see logout in api.js (it also deletes the access token from sessionStorage) */
@@ -1,3 +1,5 @@
+import { logout } from './api.js';
+
 /*
 * Validating Error Schema:
  {
@@ -45,7 +47,7 @@ export const loggedInNavbar = () => {
     const a2 = document.createElement('a');
     a2.className = 'btn btn-outline-light text-white';
     a2.type = 'button';
-    a2.onclick = console.log;
+    a2.onclick = logout;
     a2.textContent = 'Logout';
     const li2 = document.createElement('li');
     li2.className = 'nav-item m-1';
@@ -1,4 +1,5 @@
 import { validErrorData } from './helpers.js';
+import { setAccessToken } from './api.js';
 
 /*
  - Access token in the Authorization Header (stored in the browser's memory)
@@ -51,7 +52,7 @@ if(loginForm) {
 
             if (response.ok && 'access_token' in responseData) {
                 // FIXME! This is not the best solution to store the access token. Consider using Redux
-                window.sessionStorage.setItem('access_token', responseData.access_token);
+                setAccessToken(responseData.access_token);
                 // Redirecting to the TODOs page
                 window.location.href = '/todos-page';
             } else if (response.ok){
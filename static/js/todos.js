@@ -1,97 +1,270 @@
 import {loggedInNavbar} from "./helpers.js";
+import {apiFetch} from "./api.js";
+
+/*
+* VIRTUALIZED TODO TABLE
+ - Only the rows that are visible in the scrollable viewport (plus OVERSCAN_ROWS above and below) are in the DOM.
+   Two spacer rows (top and bottom) keep the height of the whole list, so the scrollbar is right
+ - The todos are fetched in pages of PAGE_SIZE (GET /todo/?after_id=<last id>&limit=<PAGE_SIZE>), when the user
+   scrolls near the end of the loaded ones
+ - Changes are applied IN PLACE: an updated todo only rewrites the cells of its row (if it is rendered). They come from
+   the delta sync (GET /todo/changes?since=<token>), every SYNC_INTERVAL_MS and when the tab becomes visible again.
+   The first token is the Sync-Token header of the first page
+* */
+
+const PAGE_SIZE = 100;
+const ROW_HEIGHT = 48; // px, same as .todo-row in base.css
+const OVERSCAN_ROWS = 10;
+const SYNC_INTERVAL_MS = 30000;
+
+const state = {
+    todos: [], // loaded todos, ordered by id (the order of the pages)
+    indexById: new Map(), // todo id -> position in todos
+    rendered: new Map(), // todo id -> <tr> that is in the DOM
+    firstRow: 0, // rendered window [firstRow, lastRow]
+    lastRow: -1,
+    hasMore: true,
+    loading: null, // Promise of the page that is being fetched
+    syncToken: null,
+    syncing: false,
+};
 
 window.addEventListener('DOMContentLoaded', async (e) => {
     try {
-        let response = await getUserTodos();
-        let responseData = await response.json();
+        // apiFetch refreshes the access token when needed (before it expires, or after a 401), see api.js.
+        // If the refresh token is not valid anymore, it redirects to the login page
+        await loadNextPage();
+        loggedInNavbar();
 
-        if(response.status === 401){
-            // Trying to get a new access token
-            const newTokenSuccessful = await getNewAccessToken();
+        let frameRequested = false;
+        document.getElementById('todosViewport').addEventListener('scroll', () => {
+            // At most one render per frame, however many scroll events there are
+            if (frameRequested) return;
+            frameRequested = true;
+            window.requestAnimationFrame(() => {
+                frameRequested = false;
+                renderWindow();
+                loadMoreIfNeeded();
+            });
+        }, {passive: true});
 
-            if(!newTokenSuccessful){
-                // Refresh token is not valid. Redirecting to login page
-                window.sessionStorage.removeItem('access_token');
-                window.location.href = '/login-page';
-                return;
+        window.setInterval(syncChanges, SYNC_INTERVAL_MS);
+        document.addEventListener('visibilitychange', syncChanges);
+    } catch (error){
+        console.log(`Error: ${error}`);
+        alert(error.message || 'An unexpected error occurred while trying to get todos. Please try again.');
+    }
+});
+
+
+/*
+* PAGES
+* */
+
+const loadNextPage = () => {
+    if (state.loading || !state.hasMore) {
+        return state.loading;
+    }
+    state.loading = (async () => {
+        try {
+            const params = new URLSearchParams({limit: PAGE_SIZE});
+            if (state.todos.length > 0) {
+                params.set('after_id', state.todos[state.todos.length - 1].id);
+            }
+            const response = await apiFetch(`/todo/?${params}`);
+            const responseData = await response.json();
+            if (!response.ok) {
+                // Something went wrong with the GET Todos request
+                throw new Error(responseData.detail || 'An error occurred while trying to get todos. Please try again.');
             }
 
-            // Refresh token is valid, so we updated the access token successfully
-            // Trying to get user's todos again
-            response = await getUserTodos();
-            responseData = await response.json();
+            if (state.syncToken === null) {
+                state.syncToken = Number(response.headers.get('Sync-Token') || 0);
+            }
+            responseData.forEach((todo) => {
+                // Already added by the delta sync
+                if (!state.indexById.has(todo.id)) {
+                    state.indexById.set(todo.id, state.todos.length);
+                    state.todos.push(todo);
+                }
+            });
+            state.hasMore = responseData.length === PAGE_SIZE;
+            renderWindow(true);
+        } finally {
+            state.loading = null;
         }
+        // The viewport may not be full yet (first page, tall screens)
+        loadMoreIfNeeded();
+    })();
+    return state.loading;
+}
 
-        if (response.ok){
-            // Valid access Token (either and old token or a new one). We were able to get user's todos
-            createTodosTable(responseData);
-            loggedInNavbar();
-            return;
-        }
+const loadMoreIfNeeded = () => {
+    if (state.hasMore && state.lastRow >= state.todos.length - OVERSCAN_ROWS) {
+        loadNextPage()?.catch((error) => console.log(`Error: ${error}`));
+    }
+}
 
-        // Something went wrong with the GET Todos request
-        if('detail' in responseData) {
-            alert(responseData.detail)
-        } else {
-            alert('An error occurred while trying to get todos. Please try again.');
-        }
-    } catch (error){
-        console.log(`Error: ${error}`);
-        alert('An unexpected error occurred while trying to get todos. Please try again.');
+
+/*
+* RENDERING
+* */
+
+const renderWindow = (force = false) => {
+    const viewport = document.getElementById('todosViewport');
+    const firstRow = Math.max(0, Math.floor(viewport.scrollTop / ROW_HEIGHT) - OVERSCAN_ROWS);
+    const visibleRows = Math.ceil(viewport.clientHeight / ROW_HEIGHT);
+    const lastRow = Math.min(state.todos.length - 1, firstRow + visibleRows + 2 * OVERSCAN_ROWS);
+    if (!force && firstRow === state.firstRow && lastRow === state.lastRow) {
+        return;
     }
-});
+    state.firstRow = firstRow;
+    state.lastRow = lastRow;
+
+    // One DOM update: the rows that stay visible are reused, only the new ones are created
+    const fragment = document.createDocumentFragment();
+    const rendered = new Map();
+    fragment.appendChild(createSpacerRow(firstRow * ROW_HEIGHT));
+    for (let index = firstRow; index <= lastRow; index++) {
+        const todo = state.todos[index];
+        const row = state.rendered.get(todo.id) || createTodoRow();
+        fillTodoRow(row, todo, index);
+        rendered.set(todo.id, row);
+        fragment.appendChild(row);
+    }
+    fragment.appendChild(createSpacerRow(Math.max(0, state.todos.length - 1 - lastRow) * ROW_HEIGHT));
+
+    document.getElementById('todosBody').replaceChildren(fragment);
+    state.rendered = rendered;
+}
+
+const createSpacerRow = (height) => {
+    const row = document.createElement('tr');
+    const td = document.createElement('td');
+    row.className = 'spacer-row';
+    td.colSpan = 3;
+    td.style.height = `${height}px`;
+    row.appendChild(td);
+    return row;
+}
+
+const createTodoRow = () => {
+    const row = document.createElement('tr');
+    const td1 = document.createElement('td');
+    const td2 = document.createElement('td');
+    const td3 = document.createElement('td');
+    const editBtn = document.createElement('button');
+
+    editBtn.textContent = 'Edit';
+    editBtn.className = 'btn btn-info btn-sm';
+    td3.appendChild(editBtn);
+
+    row.appendChild(td1);
+    row.appendChild(td2);
+    row.appendChild(td3);
+    return row;
+}
+
+// Also used to update a row in place
+const fillTodoRow = (row, todo, index) => {
+    const [td1, td2] = row.children;
+    td1.textContent = index;
+    td2.textContent = todo.title;
+
+    if(todo.completed){
+        row.className = 'todo-row pointer alert alert-success';
+        td2.className = 'strike-through-td';
+    } else {
+        row.className = 'todo-row pointer';
+        td2.className = '';
+    }
+}
 
 
 /*
-* HELPERS
+* DELTA SYNC
 * */
 
-const getUserTodos = async () => {
-    return await fetch('/todo/', {
-        method: 'GET',
-        headers: {
-            // FIXME! sessionStorage is not the best solution
-            'Authorization': `Bearer ${window.sessionStorage.getItem('access_token')}`
+const syncChanges = async () => {
+    if (state.syncToken === null || state.syncing || document.visibilityState !== 'visible') {
+        return;
+    }
+    state.syncing = true;
+    try {
+        let hasMore = true;
+        while (hasMore) {
+            const response = await apiFetch(`/todo/changes?since=${state.syncToken}`);
+            if (!response.ok) {
+                return;
+            }
+            const page = await response.json();
+            applyChanges(page.changes, page.deleted);
+            state.syncToken = page.token;
+            hasMore = page.has_more;
         }
-    });
+    } catch (error) {
+        console.log(`Error: ${error}`);
+    } finally {
+        state.syncing = false;
+    }
 }
 
-const getNewAccessToken = async () => {
-    const refreshResponse = await fetch('auth/refresh');
-    const refreshData = await refreshResponse.json();
-    if (refreshResponse.ok && 'access_token' in refreshData) {
-        window.sessionStorage.setItem('access_token', refreshData.access_token)
-        return true;
+const applyChanges = (changes, deleted) => {
+    let moved = false;
+
+    deleted.forEach((todoId) => {
+        if (state.indexById.has(todoId)) {
+            state.todos.splice(state.indexById.get(todoId), 1);
+            state.indexById.delete(todoId);
+            moved = true;
+        }
+    });
+    if (moved) {
+        reindex();
+    }
+
+    changes.forEach((todo) => {
+        const index = state.indexById.get(todo.id);
+        if (index !== undefined) {
+            // IN PLACE: only the cells of its row, if it is rendered
+            state.todos[index] = todo;
+            const row = state.rendered.get(todo.id);
+            if (row) {
+                fillTodoRow(row, todo, index);
+            }
+            return;
+        }
+        const lastId = state.todos.length > 0 ? state.todos[state.todos.length - 1].id : 0;
+        if (state.hasMore && todo.id > lastId) {
+            // After the loaded pages: it will come with its page
+            return;
+        }
+        state.todos.splice(insertionIndex(todo.id), 0, todo);
+        reindex();
+        moved = true;
+    });
+
+    // Rows were added or removed: only the rendered window is built again
+    if (moved) {
+        renderWindow(true);
     }
-    return false;
 }
 
-const createTodosTable = (todos) => {
-    const tBody = document.getElementById('table');
-
-    todos.forEach((todo, index) => {
-        const row = document.createElement('tr');
-        const td1 = document.createElement('td');
-        const td2 = document.createElement('td');
-        const td3 = document.createElement('td');
-        const editBtn = document.createElement('button');
-
-        td1.textContent = index;
-        td2.textContent = todo.title;
-        editBtn.textContent = 'Edit';
-        editBtn.className = 'btn btn-info';
-        td3.appendChild(editBtn);
-
-        if(todo.completed){
-            row.className = 'pointer alert alert-success';
-            td2.className = 'strike-through-td';
+const insertionIndex = (todoId) => {
+    // Binary search: the todos are ordered by id
+    let low = 0;
+    let high = state.todos.length;
+    while (low < high) {
+        const middle = (low + high) >> 1;
+        if (state.todos[middle].id < todoId) {
+            low = middle + 1;
         } else {
-            row.className = 'pointer';
+            high = middle;
         }
+    }
+    return low;
+}
 
-        row.appendChild(td1);
-        row.appendChild(td2);
-        row.appendChild(td3);
-        tBody.appendChild(row);
-    })
-}
\ No newline at end of file
+const reindex = () => {
+    state.indexById = new Map(state.todos.map((todo, index) => [todo.id, index]));
+}
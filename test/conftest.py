@@ -1,11 +1,13 @@
 import os, pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.orm import Session
 from sqlalchemy.pool import StaticPool
 from starlette.testclient import TestClient
 from database import db
 from utils import tokens
-from main import app
+from utils.settings import Settings
+from main import create_app
 
 SQLITE_TEST_DATABASE_URI = os.getenv("SQLITE_TEST_DATABASE_URI")
 
@@ -29,73 +31,169 @@ def override_get_logged_in_admin():
 def override_get_logged_in_user():
     return {'username': 'evasq', 'user_id': 1, 'user_role': 'user'}
 
+# PARALLEL EXECUTION (pytest -n auto, with pytest-xdist)
+# - Every xdist worker (gw0, gw1, ...) is a different process, with its own test database:
+#     * SQLite in memory (default, SQLITE_TEST_DATABASE_URI not set): one private database per process
+#     * SQLite file: the worker id is added to the file name (test.db -> test_gw0.db)
+#     * PostgreSQL: the database is cloned per worker with CREATE DATABASE ... TEMPLATE <test database>
+# - The tables are created only once per worker. Each TEST FILE runs inside a transaction that is rolled back at the end
+#   of the file (instead of dropping the tables). Route commits only release SAVEPOINTs inside that transaction
+# - ISOLATION IS PER FILE, NOT PER TEST: the tests of a file see each other's writes, and depend on them (e.g. create,
+#   then read). So a whole file runs in the same worker (--dist=load becomes --dist=loadfile). Only the tests that use
+#   the db_session fixture get their own changes rolled back
+def pytest_configure(config):
+    if getattr(config.option, "dist", "no") == "load":
+        config.option.dist = "loadfile"
+
+
+def worker_database_uri(worker_id: str) -> str:
+    if not SQLITE_TEST_DATABASE_URI:
+        return "sqlite://"
+    url = make_url(SQLITE_TEST_DATABASE_URI)
+    if worker_id == "master" or url.database in (None, "", ":memory:"):
+        return SQLITE_TEST_DATABASE_URI
+    if url.get_backend_name() == "sqlite":
+        root, extension = os.path.splitext(url.database)
+        return url.set(database=f"{root}_{worker_id}{extension}").render_as_string(hide_password=False)
+    return url.set(database=f"{url.database}_{worker_id}").render_as_string(hide_password=False)
+
+
+def enable_sqlite_savepoints(engine):
+    # pysqlite does not emit BEGIN by itself (so SAVEPOINTs would not work inside our transaction). SQLAlchemy docs recipe
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+
+# Once per WORKER: engine and tables. xdist sets PYTEST_XDIST_WORKER in each worker process
+@pytest.fixture(scope="session")
+def test_engine():
+    uri = worker_database_uri(os.getenv("PYTEST_XDIST_WORKER", "master"))
+    url = make_url(uri)
+    template = make_url(SQLITE_TEST_DATABASE_URI) if SQLITE_TEST_DATABASE_URI else None
+    is_clone = url.get_backend_name() == "postgresql" and template is not None and template.database != url.database
+
+    if is_clone:
+        # Cloning the (already migrated) test database. CREATE DATABASE cannot run inside a transaction
+        admin_engine = create_engine(template, isolation_level="AUTOCOMMIT")
+        with admin_engine.connect() as conn:
+            conn.exec_driver_sql(f'DROP DATABASE IF EXISTS "{url.database}"')
+            conn.exec_driver_sql(f'CREATE DATABASE "{url.database}" TEMPLATE "{template.database}"')
+
+    if url.get_backend_name() == "sqlite":
+        engine = create_engine(uri, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        enable_sqlite_savepoints(engine)
+    else:
+        engine = create_engine(uri, poolclass=StaticPool)
+
+    db.Base.metadata.create_all(bind=engine)
+    try:
+        yield engine
+    finally:
+        engine.dispose()
+        if is_clone:
+            with admin_engine.connect() as conn:
+                conn.exec_driver_sql(f'DROP DATABASE IF EXISTS "{url.database}"')
+            admin_engine.dispose()
+        elif url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+            db.Base.metadata.drop_all(bind=engine)
+
+
+# Once per TEST FILE: a connection inside a transaction that is rolled back at the end of the file
+@pytest.fixture(scope="module")
+def db_connection(test_engine):
+    """
+    Isolation between TEST FILES only: the writes of a test (through override_get_db / logged_in_client) stay visible
+    to the next tests of the same file until this transaction is rolled back. For a test of its own, use db_session.
+    """
+    connection = test_engine.connect()
+    transaction = connection.begin()
+    try:
+        yield connection
+    finally:
+        transaction.rollback()
+        connection.close()
+
+
 # Every TEST FILE will have a fresh test database at the beginning of its execution
 @pytest.fixture(scope="module")
-def override_get_db():
-    engine = create_engine(
-        SQLITE_TEST_DATABASE_URI,
-        connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
-    )
-    testing_session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db.Base.metadata.create_all(bind=engine)
-    database_test_session= testing_session_local()
+def override_get_db(db_connection):
+    # join_transaction_mode="create_savepoint": commit() and rollback() of the routes only affect a SAVEPOINT,
+    # the data remains inside the transaction of the TEST FILE
+    database_test_session = Session(bind=db_connection, autoflush=False, join_transaction_mode="create_savepoint")
     try:
         yield database_test_session
     finally:
         database_test_session.close()
-        # Drop tables after the execution of a TEST FILE
-        db.Base.metadata.drop_all(bind=engine)
 
-# Every TEST FUNCTION will have a fresh logged in TestClient
+
+# Every TEST FUNCTION that uses this fixture sees the data of its TEST FILE, but its own changes are rolled back at the end
 @pytest.fixture(scope="function")
-def logged_in_client(override_get_db, override_get_logged_in_user):
-    # If we were to do this override outside the fixture, override_get_db is already a function, so we can do a direct override:
-    # > app.dependency_overrides[db.get_db] = override_get_db
+def db_session(db_connection, override_get_db):
+    override_get_db.commit() # Closing any SAVEPOINT left open by the file session
+    nested = db_connection.begin_nested()
+    database_test_session = Session(bind=db_connection, autoflush=False, join_transaction_mode="create_savepoint")
+    try:
+        yield database_test_session
+    finally:
+        database_test_session.close()
+        nested.rollback()
 
-    # Doing this inside the fixture, override_get_db and override_get_logged_in_user functions were already called
-    # We use lambda so we can override a function with another one
-    app.dependency_overrides[db.get_db] = lambda: override_get_db
-    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
 
-    # At this point, our application has the new references for its dependencies
+# Every TEST FILE has its own application instance (engine, keyring, caches, dependency overrides...)
+# The tables are managed by the test_engine fixture, and the sessions are provided by override_get_db
+@pytest.fixture(scope="module")
+def test_app():
+    settings = Settings(database_uri="sqlite://", secret_key="test-secret-key-test-secret-key!", create_tables=False)
+    return create_app(settings)
 
-    # Returning a test client
-    with TestClient(app) as cl:
-        yield cl
 
-    # Clear overrides after all tests in the MODULE (thanks to the scope)
-    app.dependency_overrides.clear()
+# Dependency overrides of a TEST FUNCTION, only for the app of its TEST FILE
+@contextmanager
+def dependency_overrides(app, overrides: dict):
+    # The overrides set before (by an enclosing fixture) are restored on exit, not cleared
+    previous = dict(app.dependency_overrides)
+    app.dependency_overrides.update(overrides)
+    try:
+        yield
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(previous)
 
 # Every TEST FUNCTION will have a fresh logged in TestClient
 @pytest.fixture(scope="function")
-def logged_in_admin_client(override_get_db, override_get_logged_in_admin):
-    # If we were to do this override outside the fixture, override_get_db is already a function, so we can do a direct override:
-    # > app.dependency_overrides[db.get_db] = override_get_db
-
-    # Doing this inside the fixture, override_get_db and override_get_logged_in_admin functions were already called
+def logged_in_client(test_app, override_get_db, override_get_logged_in_user):
+    # Doing this inside the fixture, override_get_db and override_get_logged_in_user functions were already called
     # We use lambda so we can override a function with another one
-    app.dependency_overrides[db.get_db] = lambda: override_get_db
-    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_admin
-
-    # At this point, our application has the new references for its dependencies
-
-    # Returning a test client
-    with TestClient(app) as cl:
+    overrides = {
+        db.get_db: lambda: override_get_db,
+        db.get_read_db: lambda: override_get_db,
+        tokens.get_logged_in_user: lambda: override_get_logged_in_user,
+    }
+
+    # Returning a test client. At this point, our application has the new references for its dependencies
+    with dependency_overrides(test_app, overrides), TestClient(test_app) as cl:
         yield cl
 
-    # Clear overrides after all tests in the MODULE (thanks to the scope)
-    app.dependency_overrides.clear()
-
 # Every TEST FUNCTION will have a fresh logged in TestClient
 @pytest.fixture(scope="function")
-def client(override_get_db):
-    app.dependency_overrides[db.get_db] = lambda: override_get_db
-
-    # At this point, our application has the new references for its dependencies
-    # Returning a test client
-    with TestClient(app) as cl:
+def logged_in_admin_client(test_app, override_get_db, override_get_logged_in_admin):
+    overrides = {
+        db.get_db: lambda: override_get_db,
+        db.get_read_db: lambda: override_get_db,
+        tokens.get_logged_in_user: lambda: override_get_logged_in_admin,
+    }
+
+    with dependency_overrides(test_app, overrides), TestClient(test_app) as cl:
         yield cl
 
-    # Clear overrides after all tests in the MODULE (thanks to the scope)
-    app.dependency_overrides.clear()
+# Every TEST FUNCTION will have a fresh TestClient
+@pytest.fixture(scope="function")
+def client(test_app, override_get_db):
+    overrides = {db.get_db: lambda: override_get_db, db.get_read_db: lambda: override_get_db}
+    with dependency_overrides(test_app, overrides), TestClient(test_app) as cl:
+        yield cl
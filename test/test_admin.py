@@ -1,5 +1,8 @@
+import csv, io, json
 from fastapi.testclient import TestClient
 from fastapi import status
+from datetime import timedelta
+from utils import passwords, tokens
 
 todo = {
     "title" : "Learn to code",
@@ -7,6 +10,8 @@ todo = {
     "priority" : 5,
     "completed" : False,
     "owner_id" : 1,
+    "due_at" : None,
+    "recurrence" : None,
 }
 
 def test_get_empty_todos(logged_in_admin_client: TestClient):
@@ -47,3 +52,67 @@ def test_get_users_unauthorized(logged_in_client: TestClient):
     response = logged_in_client.get("/admin/user")
     assert response.status_code == status.HTTP_403_FORBIDDEN
 
+
+def test_get_sessions_unauthorized(logged_in_client: TestClient):
+    response = logged_in_client.get("/admin/session")
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+def test_get_and_delete_sessions(logged_in_admin_client: TestClient, override_get_db, override_get_logged_in_admin):
+    keyring = logged_in_admin_client.app.state.keyring
+    tokens.create_jwt(override_get_db, keyring, override_get_logged_in_admin, expires_delta=timedelta(days=1), is_refresh_token=True)
+
+    response = logged_in_admin_client.get("/admin/session", params={"user_id": 1})
+    assert response.status_code == status.HTTP_200_OK
+    sessions = response.json()
+    assert len(sessions) == 1
+    assert sessions[0]["user_id"] == 1
+    assert "jti" not in sessions[0]
+
+    response = logged_in_admin_client.delete(f"/admin/session/{sessions[0]['family_id']}")
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+
+    response = logged_in_admin_client.delete(f"/admin/session/{sessions[0]['family_id']}")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+def test_import_users(logged_in_admin_client: TestClient):
+    pre_hashed = passwords.hash_password("imported-secret")
+    lines = [
+        {"username": "imported_1", "email": "imported_1@email.com", "first_name": "A", "last_name": "B", "password": "secret1"},
+        {"username": "imported_2", "email": "imported_2@email.com", "first_name": "C", "last_name": "D", "hashed_password": pre_hashed},
+        {"username": "imported_3", "email": "imported_1@email.com", "first_name": "E", "last_name": "F", "password": "secret3"},
+        {"username": "imported_4", "email": "imported_4@email.com", "first_name": "G", "last_name": "H"},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+    response = logged_in_admin_client.post("/admin/user/import", content=body, params={"format": "ndjson"})
+    assert response.status_code == status.HTTP_200_OK
+    report = response.json()
+    assert report["created"] == 2
+    assert report["conflicts"] == [{"line": 3, "field": "email", "value": "imported_1@email.com"}]
+    assert [error["line"] for error in report["errors"]] == [4, 5]
+
+    # The same users again, as CSV: everything conflicts, nothing is hashed
+    csv_body = "username,email,first_name,last_name,password\nimported_1,other@email.com,A,B,secret1\n"
+    report = logged_in_admin_client.post("/admin/user/import", content=csv_body, params={"format": "csv"}).json()
+    assert report == {"created": 0, "conflicts": [{"line": 2, "field": "username", "value": "imported_1"}], "errors": []}
+
+def test_imported_users_can_log_in(client: TestClient):
+    for username, password in (("imported_1", "secret1"), ("imported_2", "imported-secret")):
+        response = client.post("/auth/login", data={"username": username, "password": password})
+        assert response.status_code == status.HTTP_200_OK
+
+def test_export_users(logged_in_admin_client: TestClient):
+    response = logged_in_admin_client.get("/admin/user/export")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    users = [json.loads(line) for line in response.text.splitlines()]
+    assert {"imported_1", "imported_2"} <= {user["username"] for user in users}
+    assert all("hashed_password" not in user for user in users)
+
+    response = logged_in_admin_client.get("/admin/user/export", params={"format": "csv", "include_password_hashes": True})
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    imported = next(row for row in rows if row["username"] == "imported_2")
+    assert passwords.verify_password("imported-secret", imported["hashed_password"])
+
+def test_import_users_unauthorized(logged_in_client: TestClient):
+    response = logged_in_client.post("/admin/user/import", content="")
+    assert response.status_code == status.HTTP_403_FORBIDDEN
@@ -1,8 +1,13 @@
 from fastapi.testclient import TestClient
 from fastapi import status
+import jwt, pytest, time, uuid
+from datetime import datetime, timedelta, timezone
+from database import models
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
 from routers.auth import authenticate_user
-
-# TODO: Implement here "tokens" tests
+from utils.keyring import KeyRing, load_pem_key
+from utils.denylist import AccessTokenDenylist, DatabaseDenylistBackend, DenylistBackend
 
 user = {
     "email": "test@email.com",
@@ -61,4 +66,191 @@ def test_logout_(client: TestClient):
 
     response = client.delete("/auth/refresh")
     assert response.status_code == status.HTTP_200_OK
-    assert response.cookies.get("refresh_token") is None
\ No newline at end of file
+    assert response.cookies.get("refresh_token") is None
+
+def login(client: TestClient) -> str:
+    body = {"username": user.get("username"), "password": user.get("password")}
+    response = client.post("/auth/login", data=body)
+    assert response.status_code == status.HTTP_200_OK
+    return response.cookies.get("refresh_token")
+
+def refresh(client: TestClient, refresh_token: str):
+    client.cookies.clear()
+    return client.get("/auth/refresh", headers={"Cookie": f"refresh_token={refresh_token}"})
+
+def test_refresh_token_rotation(client: TestClient):
+    first_token = login(client)
+    response = refresh(client, first_token)
+    assert response.status_code == status.HTTP_200_OK
+    second_token = response.cookies.get("refresh_token")
+
+    # Same session (family), different token
+    first_payload = jwt.decode(first_token, options={"verify_signature": False})
+    second_payload = jwt.decode(second_token, options={"verify_signature": False})
+    assert first_payload["fid"] == second_payload["fid"]
+    assert first_payload["jti"] != second_payload["jti"]
+
+def test_refresh_token_reuse_revokes_family(client: TestClient):
+    first_token = login(client)
+    second_token = refresh(client, first_token).cookies.get("refresh_token")
+
+    # Reusing an already rotated refresh token revokes the whole session, including the newest refresh token
+    assert refresh(client, first_token).status_code == status.HTTP_401_UNAUTHORIZED
+    assert refresh(client, second_token).status_code == status.HTTP_401_UNAUTHORIZED
+
+def test_logout_all_devices(client: TestClient):
+    first_device, second_device = login(client), login(client)
+    client.cookies.clear()
+
+    response = client.delete("/auth/sessions", headers={"Authorization": f"Bearer {user['access_token']}"})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json().get("revoked_sessions") >= 2
+
+    assert refresh(client, first_device).status_code == status.HTTP_401_UNAUTHORIZED
+    assert refresh(client, second_device).status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_logout_revokes_access_token(client: TestClient):
+    body = {"username": user.get("username"), "password": user.get("password")}
+    response = client.post("/auth/login", data=body)
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    assert client.get("/user/", headers=headers).status_code == status.HTTP_200_OK
+
+    response = client.delete("/auth/refresh", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+
+    # The access token has not expired yet, but it is in the denylist
+    response = client.get("/user/", headers=headers)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+def test_incomplete_denylist_backend_is_rejected():
+    class PublishOnlyBackend(DenylistBackend):
+        def publish(self, entries, db_session):
+            pass
+
+    # Fails when it is created, not on the first revoked token
+    with pytest.raises(TypeError):
+        PublishOnlyBackend()
+
+def test_denylist_sync_between_workers(db_session):
+    worker_1 = AccessTokenDenylist(DatabaseDenylistBackend(), sync_interval=0)
+    worker_2 = AccessTokenDenylist(DatabaseDenylistBackend(), sync_interval=0)
+    revoked_jti, expired_jti, now = str(uuid.uuid4()), str(uuid.uuid4()), int(time.time())
+
+    worker_1.revoke([(revoked_jti, now + 60), (expired_jti, now - 1)], db_session)
+    assert worker_1.is_revoked(revoked_jti, db_session)
+
+    # The second worker gets the revocation from the shared backend. Expired tokens are never stored
+    assert worker_2.is_revoked(revoked_jti, db_session)
+    assert not worker_2.is_revoked(expired_jti, db_session)
+    assert not worker_2.is_revoked(str(uuid.uuid4()), db_session)
+
+    # A revocation stamped BEFORE the last fetch of the second worker, committed after it (with a lower id than the
+    # rows it already read): the next fetch reads the window again, and does not miss it
+    late_jti = uuid.uuid4()
+    db_session.add(models.RevokedAccessTokens(id=0, jti=late_jti, expires_at=datetime.now(timezone.utc) + timedelta(seconds=60),
+                                              revoked_at=datetime.now(timezone.utc) - timedelta(seconds=5)))
+    db_session.commit()
+    assert worker_2.is_revoked(str(late_jti), db_session)
+
+
+### KEYRING ###
+def private_pem(key) -> bytes:
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+def public_pem(key) -> bytes:
+    return key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+def test_keyring_asymmetric_keys():
+    for private_key, algorithm in ((rsa.generate_private_key(public_exponent=65537, key_size=2048), "RS256"),
+                                   (ed25519.Ed25519PrivateKey.generate(), "EdDSA")):
+        keyring = KeyRing([load_pem_key("current", private_pem(private_key))])
+        token = keyring.encode({"sub": "evasq"})
+
+        assert jwt.get_unverified_header(token) == {"alg": algorithm, "typ": "JWT", "kid": "current"}
+        assert keyring.decode(token) == {"sub": "evasq"}
+
+        # Other services only need the published JWK to verify the token
+        jwk = keyring.jwks()["keys"][0]
+        assert jwk["kid"] == "current" and jwk["alg"] == algorithm and "d" not in jwk
+        assert jwt.decode(token, jwt.PyJWK(jwk).key, algorithms=[algorithm]) == {"sub": "evasq"}
+
+def test_keyring_rotation():
+    old_key, new_key = ed25519.Ed25519PrivateKey.generate(), ed25519.Ed25519PrivateKey.generate()
+    old_token = KeyRing([load_pem_key("old", private_pem(old_key))]).encode({"sub": "evasq"})
+
+    # The new key signs, the retired key (public part only) still verifies tokens that have not expired
+    keyring = KeyRing([load_pem_key("new", private_pem(new_key)), load_pem_key("old", public_pem(old_key))])
+    assert keyring.active_key.kid == "new"
+    assert keyring.decode(old_token) == {"sub": "evasq"}
+    assert [key["kid"] for key in keyring.jwks()["keys"]] == ["new", "old"]
+
+    with pytest.raises(jwt.InvalidTokenError):
+        KeyRing([load_pem_key("new", private_pem(new_key))]).decode(old_token)
+
+def test_keyring_rejects_algorithm_confusion():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    keyring = KeyRing([load_pem_key("current", private_pem(private_key))], secret_key="secret")
+
+    # A token signed with HS256, using the PUBLIC key as secret, must not be accepted
+    forged = jwt.encode({"sub": "admin"}, "secret", algorithm="HS256", headers={"kid": "current"})
+    with pytest.raises(jwt.InvalidTokenError):
+        keyring.decode(forged)
+
+def test_jwks_endpoint(client: TestClient):
+    response = client.get("/.well-known/jwks.json")
+    assert response.status_code == status.HTTP_200_OK
+    assert "keys" in response.json()
+    assert "max-age" in response.headers.get("cache-control")
+
+    response = client.get("/.well-known/jwks.json", headers={"If-None-Match": response.headers.get("etag")})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+def test_registration_retry_with_idempotency_key(client: TestClient, monkeypatch):
+    other_user = {**user, "username": "retrying_user", "email": "retrying@email.com"}
+    headers = {"Idempotency-Key": "registration-1"}
+    response = client.post("/auth/", json=other_user, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+
+    # The retry gets the first response, without hashing the password again (nor answering 409)
+    from utils import passwords
+    monkeypatch.setattr(passwords, "hash_password", lambda password: pytest.fail("The handler was executed again"))
+    response = client.post("/auth/", json=other_user, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.headers["Idempotent-Replayed"] == "true"
+
+    # Without the key, it is a new registration of an existing user
+    monkeypatch.undo()
+    assert client.post("/auth/", json=other_user).status_code == status.HTTP_409_CONFLICT
+
+def test_login_upgrades_outdated_hashes(override_get_db):
+    from database import models
+    from utils import passwords
+    old_policy = passwords.PasswordPolicy(bcrypt_rounds=4)
+    new_policy = passwords.PasswordPolicy(bcrypt_rounds=5)
+    user_model = models.Users(username="outdated_hash", email="outdated@email.com", hashed_password=passwords.hash_password("test123", old_policy))
+    override_get_db.add(user_model)
+    override_get_db.commit()
+
+    # The stored hash is valid, but its cost is not the one of the policy: it is replaced on login
+    assert authenticate_user("outdated_hash", "test123", override_get_db, new_policy) is not None
+    assert user_model.hashed_password.startswith("$2b$05$")
+    assert passwords.verify_and_update("test123", user_model.hashed_password, new_policy) == (True, None)
+
+    # A wrong password never changes the hash
+    stored_hash = user_model.hashed_password
+    assert authenticate_user("outdated_hash", "wrong", override_get_db, passwords.PasswordPolicy(bcrypt_rounds=6)) is None
+    assert user_model.hashed_password == stored_hash
+
+def test_password_calibration():
+    from utils import passwords
+    policy, seconds = passwords.calibrate(target_seconds=0.001, max_cost=6)
+    assert policy.scheme == "bcrypt" and 4 <= policy.bcrypt_rounds <= 6
+    assert seconds > 0
+
+def test_argon2_policy_upgrades_bcrypt_hashes():
+    pytest.importorskip("argon2")
+    from utils import passwords
+    policy = passwords.PasswordPolicy(scheme="argon2", argon2_time_cost=1, argon2_memory_cost=1024, argon2_parallelism=1)
+    valid, new_hash = passwords.verify_and_update("test123", passwords.hash_password("test123", passwords.PasswordPolicy(bcrypt_rounds=4)), policy)
+    assert valid and new_hash.startswith("$argon2id$")
@@ -0,0 +1,167 @@
+import pytest
+from fastapi import status
+from starlette.testclient import TestClient
+from database import db, models, shards
+from utils import tokens
+from utils.settings import Settings
+from main import create_app
+
+"""
+READ REPLICAS: two SQLite files as stand-ins for the primary and the replica.
+There is no replication between them, so the answer of GET /todo/ shows which database was used.
+"""
+
+todo = {
+    "title" : "Learn to code",
+    "description" : "Need to learn everyday",
+    "priority" : 5,
+    "completed" : False,
+}
+
+@pytest.fixture(scope="module")
+def replica_app(tmp_path_factory, override_get_logged_in_user):
+    directory = tmp_path_factory.mktemp("replicas")
+    settings = Settings(
+        database_uri=f"sqlite:///{directory}/primary.db",
+        read_replica_uris=f"sqlite:///{directory}/replica.db",
+        secret_key="test-secret-key-test-secret-key!",
+    )
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+
+    replica = app.state.db_router.replicas[0]
+    db.Base.metadata.create_all(bind=replica)
+    with app.state.db_router.replica_sessions[0]() as replica_session:
+        replica_session.add(models.Todos(owner_id=1, **{**todo, "title": "Only in the replica"}))
+        replica_session.commit()
+    return app
+
+def test_reads_go_to_the_replica(replica_app):
+    with TestClient(replica_app) as client:
+        response = client.get("/todo/")
+        assert response.status_code == status.HTTP_200_OK
+        assert [item["title"] for item in response.json()] == ["Only in the replica"]
+
+def test_read_your_writes(replica_app):
+    with TestClient(replica_app) as client:
+        response = client.post("/todo/", json=todo)
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.cookies.get(db.READ_PRIMARY_COOKIE) is not None
+
+        # The client that wrote reads from the primary during the stickiness window
+        response = client.get("/todo/")
+        assert [item["title"] for item in response.json()] == [todo["title"]]
+
+        # Once the window is over (no cookie), reads go to the replica again
+        client.cookies.clear()
+        response = client.get("/todo/")
+        assert [item["title"] for item in response.json()] == ["Only in the replica"]
+
+def test_reads_do_not_make_the_client_sticky(replica_app):
+    with TestClient(replica_app) as client:
+        response = client.get("/todo/")
+        assert response.cookies.get(db.READ_PRIMARY_COOKIE) is None
+
+def test_replica_routing_policies(tmp_path):
+    engines = [db.create_db_engine(f"sqlite:///{tmp_path}/{name}.db") for name in ("primary", "replica_1", "replica_2")]
+    router = db.DatabaseRouter(engines[0], engines[1:])
+    assert [router.replica_index() for _ in range(4)] == [0, 1, 0, 1]
+
+    router = db.DatabaseRouter(engines[0], engines[1:], policy="least_connections")
+    with engines[1].connect():
+        assert router.replica_index() == 1
+
+
+"""
+SHARDS: a primary and two shards, all of them SQLite files. The logged in user is changed between requests
+"""
+
+logged_in = {}
+
+@pytest.fixture(scope="module")
+def sharded_app(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("shards")
+    settings = Settings(
+        database_uri=f"sqlite:///{directory}/primary.db",
+        todo_shards=f"a=sqlite:///{directory}/a.db,b=sqlite:///{directory}/b.db",
+        secret_key="test-secret-key-test-secret-key!",
+    )
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: dict(logged_in)
+    return app
+
+@pytest.fixture(scope="module")
+def owners(sharded_app):
+    # One owner in each shard
+    ring = sharded_app.state.shard_router.ring
+    return {shard: next(user_id for user_id in range(1, 1000) if ring.node_for(user_id) == shard) for shard in ("a", "b")}
+
+def shard_titles(app, shard: str) -> list[str]:
+    with app.state.shard_router.sessions[shard]() as session:
+        return [todo.title for todo in session.query(models.Todos).order_by(models.Todos.id)]
+
+def test_hash_ring_moves_few_keys():
+    before = shards.HashRing(["a", "b", "c"])
+    after = shards.HashRing(["a", "b", "c", "d"])
+    moved = [key for key in range(10_000) if before.node_for(key) != after.node_for(key)]
+    # Only the keys taken by the new node move (~1/4)
+    assert all(after.node_for(key) == "d" for key in moved)
+    assert 1500 < len(moved) < 3500
+
+def test_todos_are_stored_in_the_shard_of_their_owner(sharded_app, owners):
+    with TestClient(sharded_app) as client:
+        for shard, owner_id in owners.items():
+            logged_in.update(username=f"user_{shard}", user_id=owner_id, user_role="user")
+            response = client.post("/todo/", json={**todo, "title": f"Todo of {shard}"})
+            assert response.status_code == status.HTTP_201_CREATED
+
+            response = client.get("/todo/")
+            assert [item["title"] for item in response.json()] == [f"Todo of {shard}"]
+
+    assert shard_titles(sharded_app, "a") == ["Todo of a"]
+    assert shard_titles(sharded_app, "b") == ["Todo of b"]
+
+def test_admin_merges_the_shards(sharded_app):
+    logged_in.update(username="admin", user_id=999_999, user_role="admin")
+    with TestClient(sharded_app) as client:
+        response = client.get("/admin/todo")
+        todos = response.json()
+        assert sorted(item["title"] for item in todos) == ["Todo of a", "Todo of b"]
+        # Unique ids across the shards, merged in order
+        assert [item["id"] for item in todos] == sorted({item["id"] for item in todos})
+
+        first_page = client.get("/admin/todo", params={"limit": 1}).json()
+        second_page = client.get("/admin/todo", params={"limit": 1, "after_id": first_page[0]["id"]}).json()
+        assert first_page + second_page == todos
+
+        response = client.delete(f"/admin/todo/{todos[1]['id']}")
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        assert client.get("/admin/todo").json() == todos[:1]
+        assert client.delete(f"/admin/todo/{todos[1]['id']}").status_code == status.HTTP_404_NOT_FOUND
+
+def test_move_owner_between_shards(sharded_app, owners):
+    router = sharded_app.state.shard_router
+    logged_in.update(username="user_a", user_id=owners["a"], user_role="user")
+    with TestClient(sharded_app) as client:
+        todo_id = client.get("/todo/").json()[0]["id"]
+
+        assert shards.move_owner(router, owners["a"], "b", freeze_seconds=0) == 1
+        assert shard_titles(sharded_app, "a") == []
+
+        # Same todo (and id), now in the shard "b"
+        response = client.get(f"/todo/{todo_id}")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["title"] == "Todo of a"
+
+        # The ring would send the owner back to "a"
+        assert shards.rebalance(router, freeze_seconds=0) == 1
+        assert shard_titles(sharded_app, "a") == ["Todo of a"]
+
+def test_writes_are_rejected_while_moving(sharded_app, owners):
+    shards.set_placement(sharded_app.state.shard_router, owners["a"], "a", moving=True)
+    logged_in.update(username="user_a", user_id=owners["a"], user_role="user")
+    with TestClient(sharded_app) as client:
+        response = client.post("/todo/", json=todo)
+        assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        assert "Retry-After" in response.headers
+        assert client.get("/todo/").status_code == status.HTTP_200_OK
@@ -1,6 +1,12 @@
+import json, os, statistics, subprocess, sys
+import pytest
 from fastapi.testclient import TestClient
 from fastapi import status
+from sqlalchemy.orm import Session
 import main
+from main import create_app
+from utils.settings import Settings
+from benchmarks import startup
 
 client = TestClient(main.app)
 
@@ -8,3 +14,57 @@ def test_return_health_check():
     response = client.get("/healthy")
     assert response.status_code == status.HTTP_200_OK
     assert response.json() == {"status": "Healthy"}
+
+# STARTUP BUDGET (see benchmarks/startup.py). Measured in a fresh interpreter, so the modules imported by other tests don't count
+STARTUP_IMPORT_BUDGET_MS = float(os.getenv("STARTUP_IMPORT_BUDGET_MS", "3000"))
+LAZY_MODULES = ("passlib", "jinja2", "dotenv")
+
+def test_heavy_modules_are_imported_lazily():
+    code = f"import sys, main; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=startup.ROOT, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ""
+
+# Wall-clock: not measured while pytest-xdist workers compete for the CPU, and the MEDIAN of a few runs (one slow run
+# is noise, not a regression)
+@pytest.mark.skipif("PYTEST_XDIST_WORKER" in os.environ, reason="Import time is not measured under pytest -n")
+def test_import_time_budget():
+    import_time_ms = statistics.median(startup.import_times("main")["main"] / 1000 for _ in range(5))
+    assert import_time_ms < STARTUP_IMPORT_BUDGET_MS, f"import main took {import_time_ms:.0f} ms (median of 5)"
+
+def test_structured_logs(tmp_path, monkeypatch):
+    log_file = tmp_path / "app.log"
+    settings = Settings(database_uri=f"sqlite:///{tmp_path}/logs.db", secret_key="test-secret-key-test-secret-key!",
+                        bcrypt_rounds=4, log_file=str(log_file), access_log_sampling="GET /todo/=0")
+    user = {"username": "logged", "email": "logged@email.com", "phone_number": "1", "first_name": "A", "last_name": "B",
+            "password": "secret1"}
+
+    with TestClient(create_app(settings)) as app_client:
+        assert app_client.post("/auth/", json=user).status_code == status.HTTP_201_CREATED
+        access_token = app_client.post("/auth/login", data={"username": "logged", "password": "secret1"}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {access_token}", "X-Request-ID": "req-42"}
+        response = app_client.get("/todo/1", headers=headers)
+        assert (response.status_code, response.headers["X-Request-ID"]) == (status.HTTP_404_NOT_FOUND, "req-42")
+        # Sampled out: successful GET /todo/ is never logged with a rate of 0
+        assert app_client.get("/todo/", headers=headers).status_code == status.HTTP_200_OK
+
+        def failing_commit(self):
+            raise RuntimeError("database is gone")
+        monkeypatch.setattr(Session, "commit", failing_commit)
+        response = app_client.post("/auth/", json={**user, "username": "other", "email": "other@email.com"})
+        monkeypatch.undo()
+        assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+    # The listener wrote every queued line when the app stopped
+    lines = [json.loads(line) for line in log_file.read_text().splitlines()]
+
+    access = [line for line in lines if line["logger"] == "todoapp.access"]
+    assert [(line["method"], line["route"], line["status"]) for line in access] == [
+        ("POST", "/auth/", 201), ("POST", "/auth/login", 200), ("GET", "/todo/{todo_id}", 404), ("POST", "/auth/", 500),
+    ]
+    not_found = access[2]
+    assert (not_found["request_id"], not_found["user_id"]) == ("req-42", 1)
+    assert not_found["queries"] >= 1 and not_found["db_ms"] > 0 and not_found["latency_ms"] >= not_found["db_ms"]
+
+    error = next(line for line in lines if line["logger"] == "todoapp.errors")
+    assert (error["level"], error["message"], error["username"]) == ("ERROR", "Unexpected error creating user", "other")
+    assert "database is gone" in error["exception"]
+    assert error["request_id"] == access[3]["request_id"] and access[3]["level"] == "ERROR"
@@ -0,0 +1,57 @@
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine, inspect, text
+from alembic_env import online
+
+"""
+ONLINE MIGRATION HELPERS (alembic_env/online.py), on a SQLite file.
+The PostgreSQL-only paths (CONCURRENTLY, lock retries, dry run) fall back to plain operations here
+"""
+
+@pytest.fixture
+def migration_connection(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/migrations.db")
+    with engine.connect() as connection:
+        connection.execute(text("CREATE TABLE todos (id INTEGER PRIMARY KEY, owner_id INTEGER, position VARCHAR)"))
+        connection.execute(text("INSERT INTO todos (id, owner_id) VALUES " + ", ".join(f"({i}, {i % 3})" for i in range(1, 26))))
+        connection.commit()
+        # Like env.py: the helpers run inside the transaction of a migration
+        migration_context = MigrationContext.configure(connection)
+        with Operations.context(migration_context), migration_context.begin_transaction():
+            yield connection
+    engine.dispose()
+
+def test_backfill_in_batches(migration_connection):
+    progress = []
+    updated = online.backfill("todos", "position = 'a' || id", where="position IS NULL", batch_size=10, pause_seconds=0,
+                              progress=lambda done, total: progress.append((done, total)))
+    assert updated == 25
+    # One commit per batch of 10 keys
+    assert progress == [(10, 25), (20, 25), (25, 25)]
+    assert migration_connection.execute(text("SELECT COUNT(*) FROM todos WHERE position IS NULL")).scalar() == 0
+
+    # Resumable: the rows that were already updated are not selected again
+    assert online.backfill("todos", "position = 'b'", where="position IS NULL", pause_seconds=0) == 0
+
+def test_create_and_drop_index(migration_connection):
+    online.create_index_concurrently("ix_todos_owner_id", "todos", ["owner_id"])
+    assert "ix_todos_owner_id" in {index["name"] for index in inspect(migration_connection).get_indexes("todos")}
+    online.drop_index_concurrently("ix_todos_owner_id", "todos")
+    assert inspect(migration_connection).get_indexes("todos") == []
+
+def test_lock_classification():
+    assert online.classify("CREATE INDEX CONCURRENTLY ix ON todos (owner_id)") == ("SHARE UPDATE EXCLUSIVE", "nothing (other DDL only)", "todos")
+    assert online.classify("CREATE INDEX ix ON todos (owner_id)") == ("SHARE", "writes", "todos")
+    assert online.classify("ALTER TABLE users ADD COLUMN phone_number VARCHAR") == ("ACCESS EXCLUSIVE", "reads and writes", "users")
+    assert online.classify("UPDATE todos SET position = 'a'")[2] == "todos"
+
+def test_dry_run_report_estimates_backfills(migration_connection):
+    report = online.LockReport()
+    migration_connection.info["lock_report"] = report
+    try:
+        assert online.backfill("todos", "position = 'a'", batch_size=10) == 0
+    finally:
+        del migration_connection.info["lock_report"]
+    assert "25 rows in 3 batches" in report.entries[0]["note"]
+    assert migration_connection.execute(text("SELECT COUNT(*) FROM todos WHERE position IS NULL")).scalar() == 25
@@ -0,0 +1,195 @@
+import pytest
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from fastapi import status
+from fastapi.testclient import TestClient
+from sqlalchemy import event, insert, text, update
+from database import models
+from main import create_app
+from utils import archiver, ranks, tokens
+from utils.settings import Settings
+
+"""
+QUERY PLAN REGRESSION TESTS
+The routes run against a seeded SQLite file (SEEDED_OWNERS owners with SEEDED_TODOS_PER_OWNER todos each, ANALYZEd).
+Every statement they send to the database is captured, and explained (EXPLAIN QUERY PLAN) with the same parameters.
+A statement that reads a table with a full scan ("SCAN todos") instead of an index ("SEARCH todos USING INDEX ...")
+fails the test: an index that was dropped, or a query that cannot use it anymore, is caught before production.
+"""
+
+SEEDED_OWNERS = 50
+SEEDED_TODOS_PER_OWNER = 40
+OWNER_ID = 7
+INDEXED_TABLES = ("todos", "todos_archive", "users", "refresh_tokens")
+# Scanning them reads only the rows of their WHERE clause
+PARTIAL_INDEXES = ("ix_todos_positions_to_rebalance", "ix_todos_pending_due_at", "ix_todos_completed_updated_at",
+                   "ix_todos_deleted_at")
+
+
+@pytest.fixture(scope="module")
+def seeded_app(tmp_path_factory):
+    database = tmp_path_factory.mktemp("plans") / "plans.db"
+    settings = Settings(database_uri=f"sqlite:///{database}", secret_key="test-secret-key-test-secret-key!",
+                        single_flight_reads=False)
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: {"username": "owner7", "user_id": OWNER_ID, "user_role": "admin"}
+
+    with TestClient(app) as client:
+        with app.state.engine.begin() as connection:
+            connection.execute(insert(models.Users), [
+                {"id": owner, "username": f"owner{owner}", "email": f"owner{owner}@example.com", "role": "user"}
+                for owner in range(1, SEEDED_OWNERS + 1)
+            ])
+            rows = [{"owner_id": owner, "title": f"Todo {index}", "description": "Seeded", "priority": 1 + index % 5,
+                     "completed": index % 4 == 0, "position": f"a{index}"}
+                    for owner in range(1, SEEDED_OWNERS + 1) for index in range(SEEDED_TODOS_PER_OWNER)]
+            connection.execute(insert(models.Todos), rows)
+            archived = [{"id": 100000 + number, "owner_id": 1 + number % SEEDED_OWNERS, "title": "Archived", "description": "Seeded", "priority": 1,
+                         "completed": True}
+                        for number in range(len(rows))]
+            connection.execute(insert(models.TodosArchive), archived)
+            # The planner statistics, as in a database that has been running for a while
+            connection.execute(text("ANALYZE"))
+        yield app, client
+
+
+@contextmanager
+def capturing(app):
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            # executemany: the plan is the same for every set of parameters
+            statements.append((statement, parameters[0] if executemany else parameters))
+
+    event.listen(app.state.engine, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        event.remove(app.state.engine, "before_cursor_execute", capture)
+
+
+def captured_statements(app, send) -> list[tuple[str, tuple]]:
+    with capturing(app) as statements:
+        response = send()
+    assert response.status_code < 400, response.text
+    return statements
+
+
+def full_scans(app, statements: list[tuple[str, tuple]]) -> list[str]:
+    # [plan line with a full scan of an indexed table, statement]
+    scans = []
+    with app.state.engine.connect() as connection:
+        for statement, parameters in statements:
+            plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+            for row in plan:
+                detail = row[-1]
+                words = detail.split()
+                # "SCAN <table>" reads every row. "SCAN <table> USING [COVERING] INDEX" too, in index order
+                if words[0] == "SCAN" and words[1] in INDEXED_TABLES and words[-1] not in PARTIAL_INDEXES:
+                    scans.append(f"{detail}\n    {statement}")
+    return scans
+
+
+def assert_indexed(app, send):
+    statements = captured_statements(app, send)
+    assert statements, "The route did not query the database"
+    scans = full_scans(app, statements)
+    assert scans == [], "Full table scans:\n" + "\n".join(scans)
+
+
+@pytest.mark.parametrize("method, url", [
+    ("GET", "/todo/"),
+    ("GET", "/todo/?after_id=250&limit=20"),
+    ("GET", "/todo/?order=position&limit=20"),
+    ("GET", f"/todo/?order=position&after_id={(OWNER_ID - 1) * SEEDED_TODOS_PER_OWNER + 5}&limit=20"),
+    ("GET", f"/todo/{(OWNER_ID - 1) * SEEDED_TODOS_PER_OWNER + 1}"),
+    ("GET", "/todo/archive"),
+    ("GET", "/todo/archive?before_id=100500"),
+    ("GET", "/admin/todo?after_id=1000&limit=50"),
+    ("GET", "/todo/changes?since=0&limit=20"),
+    ("GET", "/admin/quotas/top"),
+    ("GET", "/user/"),
+])
+def test_reads_use_indexes(seeded_app, method, url):
+    app, client = seeded_app
+    assert_indexed(app, lambda: client.request(method, url))
+
+
+def test_writes_use_indexes(seeded_app):
+    app, client = seeded_app
+    todo_id = (OWNER_ID - 1) * SEEDED_TODOS_PER_OWNER + 2
+    new_todo = {"title": "Indexed", "description": "Updated through the index", "priority": 3, "completed": False}
+    assert_indexed(app, lambda: client.put(f"/todo/{todo_id}", json=new_todo))
+    assert_indexed(app, lambda: client.delete(f"/todo/{todo_id}"))
+    # Delta sync: the two changes above
+    assert_indexed(app, lambda: client.get("/todo/changes?since=1"))
+    assert_indexed(app, lambda: client.delete(f"/admin/todo/{todo_id + 1}"))
+    # Manual ordering: the neighbours of the anchor, and the last position of the owner (new todo)
+    assert_indexed(app, lambda: client.patch(f"/todo/{todo_id + 3}/move", json={"after_id": todo_id + 5}))
+    assert_indexed(app, lambda: client.patch(f"/todo/{todo_id + 3}/move", json={"before_id": todo_id + 5}))
+    assert_indexed(app, lambda: client.post("/todo/", json=new_todo))
+
+
+def test_rebalance_job_uses_the_partial_index(seeded_app):
+    app, client = seeded_app
+    with app.state.engine.begin() as connection:
+        connection.execute(update(models.Todos).where(models.Todos.id == 3 * SEEDED_TODOS_PER_OWNER).values(position="a1" + "V" * 30))
+    with app.state.session_factory() as db_session, capturing(app) as statements:
+        assert ranks.rebalance_positions(db_session) == 1
+    scans = full_scans(app, statements)
+    assert scans == [], "Full table scans:\n" + "\n".join(scans)
+
+
+def test_archival_job_uses_the_partial_indexes(seeded_app):
+    app, client = seeded_app
+    # Nothing is old enough: only the plans of the batch queries are checked
+    with app.state.session_factory() as db_session, capturing(app) as statements:
+        assert archiver.archive_todos(db_session, older_than=timedelta(days=3650)) == 0
+    assert len(statements) == 2
+    plans = []
+    with app.state.engine.connect() as connection:
+        for statement, parameters in statements:
+            plans += [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+    assert any("ix_todos_completed_updated_at" in detail for detail in plans), plans
+    assert any("ix_todos_deleted_at" in detail for detail in plans), plans
+    scans = full_scans(app, statements)
+    assert scans == [], "Full table scans:\n" + "\n".join(scans)
+
+
+def test_due_scheduler_uses_the_partial_index(seeded_app):
+    app, client = seeded_app
+    scheduler = app.state.due_scheduler
+    now = datetime.now(timezone.utc)
+    with app.state.engine.begin() as connection:
+        connection.execute(update(models.Todos).where(models.Todos.id.in_([6, 7])).values(due_at=now + timedelta(seconds=30)))
+    with capturing(app) as statements:
+        entries, _ = scheduler.scan(now, (now - scheduler.refresh, 0))
+        assert sorted(todo_id for _, todo_id, _ in entries) == [6, 7]
+        scheduler.check_due({0: [(due_at, todo_id) for due_at, todo_id, _ in entries]})
+    scans = full_scans(app, statements)
+    assert scans == [], "Full table scans:\n" + "\n".join(scans)
+
+
+def test_a_missing_index_is_detected(seeded_app):
+    # The suite itself: without the owner indexes, reading the todos of an owner is a full scan
+    app, client = seeded_app
+    owner_indexes = {
+        "ix_todos_owner_id_id": "todos (owner_id, id)",
+        "ix_todos_owner_id_change_seq": "todos (owner_id, change_seq)",
+        "ix_todos_owner_id_position": "todos (owner_id, position, id)",
+    }
+    with app.state.engine.begin() as connection:
+        for index in owner_indexes:
+            connection.execute(text(f"DROP INDEX {index}"))
+    # The pooled connections keep the statements they prepared (and their plans) with the old schema
+    app.state.engine.dispose()
+    try:
+        statements = captured_statements(app, lambda: client.get("/todo/"))
+        assert any(scan.startswith("SCAN todos") for scan in full_scans(app, statements))
+    finally:
+        with app.state.engine.begin() as connection:
+            for index, columns in owner_indexes.items():
+                connection.execute(text(f"CREATE INDEX {index} ON {columns}"))
+        app.state.engine.dispose()
+    assert client.get("/todo/").status_code == status.HTTP_200_OK
@@ -0,0 +1,84 @@
+import os, re, signal, subprocess, sys, threading, time, urllib.request
+import pytest
+import serve
+from benchmarks import startup
+from utils.settings import Settings
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="The pre-fork server needs os.fork")
+
+
+def test_pools_fit_the_connection_limit():
+    settings = Settings(database_uri="postgresql://localhost/todos", secret_key="test-secret-key-test-secret-key!",
+                        db_pool_size=5, db_max_overflow=10)
+    # No limit: the pools are the configured ones
+    assert serve.size_pools(settings, 8) is settings
+
+    # 100 connections for 8 workers + the extra one of a reload: 11 per worker (5 kept open, 6 overflow)
+    sized = serve.size_pools(settings.model_copy(update={"db_max_connections": 100}), 8)
+    assert (sized.db_pool_size, sized.db_max_overflow) == (5, 6)
+    assert 9 * (sized.db_pool_size + sized.db_max_overflow) <= 100
+    # A small limit lowers the persistent pool too
+    sized = serve.size_pools(settings.model_copy(update={"db_max_connections": 30}), 9)
+    assert (sized.db_pool_size, sized.db_max_overflow) == (3, 0)
+    # A generous limit never raises the configured pools
+    sized = serve.size_pools(settings.model_copy(update={"db_max_connections": 10_000}), 2)
+    assert (sized.db_pool_size, sized.db_max_overflow) == (5, 10)
+    with pytest.raises(ValueError):
+        serve.size_pools(settings.model_copy(update={"db_max_connections": 4}), 4)
+
+
+def ready_workers(output: list[str]) -> list[int]:
+    return [int(pid) for line in output for pid in re.findall(r"Worker (\d+) ready", line)]
+
+
+def wait_for(condition, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.05)
+
+
+def test_graceful_reload_and_recycling(tmp_path):
+    port = startup.free_port()
+    env = {**os.environ, "POSTGRESQL_DB_URI": f"sqlite:///{tmp_path}/serve.db",
+           "SECRET_KEY": "test-secret-key-test-secret-key!", "LOG_FILE": str(tmp_path / "app.log")}
+    process = subprocess.Popen([sys.executable, "serve.py", "--workers", "2", "--port", str(port), "--max-requests", "100"],
+                               cwd=startup.ROOT, env=env, stderr=subprocess.PIPE, text=True)
+    output = []
+    reader = threading.Thread(target=lambda: output.extend(iter(process.stderr.readline, "")), daemon=True)
+    reader.start()
+    try:
+        wait_for(lambda: len(ready_workers(output)) == 2)
+        first_workers = set(ready_workers(output))
+
+        # Requests keep coming during the reload: none of them fails
+        statuses, stop = [], threading.Event()
+        def send_requests():
+            while not stop.is_set():
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthy", timeout=5) as response:
+                        statuses.append(response.status)
+                except OSError as err:
+                    statuses.append(repr(err))
+        sender = threading.Thread(target=send_requests)
+        sender.start()
+        process.send_signal(signal.SIGHUP)
+        wait_for(lambda: sum(f"Worker {pid} exited" in line for pid in first_workers for line in output) == 2)
+        stop.set()
+        sender.join()
+        assert statuses and set(statuses) == {200}
+
+        assert len(set(ready_workers(output)) - first_workers) >= 2
+
+        # Recycling: more than 2 x 100 requests, so at least one worker exits by itself and is replaced, without errors
+        statuses.clear()
+        for _ in range(250):
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthy", timeout=5) as response:
+                statuses.append(response.status)
+        assert set(statuses) == {200}
+        wait_for(lambda: any(line.endswith("(exit code 0)\n") for line in output))
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=30) == 0
+        reader.join(timeout=5)
+    assert "Stopping the workers" in "".join(output)
@@ -1,5 +1,18 @@
+import asyncio, time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.testclient import TestClient
 from fastapi import status
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.exc import IntegrityError
+from database import db, models
+from main import create_app
+from utils import ranks, recurrence, tokens
+from utils.archiver import archive_todos
+from utils.group_commit import TodoInsertBatcher
+from utils.scheduler import DueScheduler
+from utils.settings import Settings
+from utils.single_flight import SingleFlight
 
 todo = {
     "title" : "Learn to code",
@@ -7,6 +20,8 @@ todo = {
     "priority" : 5,
     "completed" : False,
     "owner_id" : 1,
+    "due_at" : None,
+    "recurrence" : None,
 }
 
 def test_empty_todos(logged_in_client: TestClient):
@@ -17,6 +32,7 @@ def test_empty_todos(logged_in_client: TestClient):
 def test_create_todo(logged_in_client: TestClient):
     response = logged_in_client.post("/todo/", json=todo)
     assert response.status_code == status.HTTP_201_CREATED
+    assert response.json() == {"id": 1}
 
 def test_read_all_authenticated(logged_in_client: TestClient):
     todo["id"] = 1
@@ -57,3 +73,514 @@ def test_delete_todo(logged_in_client: TestClient):
 def test_delete_todo_not_found(logged_in_client: TestClient):
     response = logged_in_client.delete("/todo/999")
     assert response.status_code == status.HTTP_404_NOT_FOUND
+
+def test_archive_completed_and_deleted_todos(logged_in_client: TestClient, override_get_db):
+    completed_todo = {**todo, "title": "Already done", "completed": True}
+    completed_todo.pop("id")
+    response = logged_in_client.post("/todo/", json=completed_todo)
+    assert response.status_code == status.HTTP_201_CREATED
+
+    # The soft-deleted todo (id 1) and the completed one (id 2) are moved to the archive
+    assert archive_todos(override_get_db, older_than=timedelta(0), batch_size=1) == 2
+
+    response = logged_in_client.get("/todo/")
+    assert response.json() == []
+
+    # Deleted todos are archived, but not listed
+    response = logged_in_client.get("/todo/archive")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == [{**completed_todo, "id": 2}]
+
+def test_archive_pagination(logged_in_client: TestClient):
+    response = logged_in_client.get("/todo/archive", params={"before_id": 2})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == []
+
+
+"""
+GROUP COMMIT: its own app (SQLite file), because the batches are committed by the batcher, outside the test transaction
+"""
+
+@pytest.fixture(scope="module")
+def group_commit_app(tmp_path_factory, override_get_logged_in_user):
+    settings = Settings(
+        database_uri=f"sqlite:///{tmp_path_factory.mktemp('group_commit')}/todos.db",
+        secret_key="test-secret-key-test-secret-key!",
+        todo_group_commit=True,
+        todo_group_commit_max_rows=10,
+        todo_group_commit_max_delay_ms=50,
+    )
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+    return app
+
+def test_group_commit_batches_concurrent_creates(group_commit_app):
+    new_todo = {key: value for key, value in todo.items() if key not in ("id", "owner_id")}
+    with TestClient(group_commit_app) as client:
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            responses = list(pool.map(lambda index: client.post("/todo/", json={**new_todo, "title": f"Todo {index}"}), range(20)))
+        assert all(response.status_code == status.HTTP_201_CREATED for response in responses)
+
+        todos = client.get("/todo/").json()
+        assert sorted(item["title"] for item in todos) == sorted(f"Todo {index}" for index in range(20))
+        # Every create got the id of its own row
+        ids = [response.json()["id"] for response in responses]
+        assert sorted(ids) == sorted(item["id"] for item in todos)
+        assert {item["id"]: item["title"] for item in todos} == {todo_id: f"Todo {index}" for index, todo_id in enumerate(ids)}
+        # Every row of every batch got its own change number
+        assert client.get("/todo/changes", params={"since": 10}).json()["token"] == 20
+
+    stats = group_commit_app.state.todo_batcher.stats.as_dict()
+    assert stats["rows"] == 20
+    assert stats["batches"] < 20
+    assert stats["max_batch_size"] <= 10
+
+def test_group_commit_errors_are_per_row(tmp_path):
+    engine = db.create_db_engine(f"sqlite:///{tmp_path}/todos.db")
+    db.Base.metadata.create_all(bind=engine)
+
+    async def insert_batch():
+        batcher = TodoInsertBatcher(max_rows=10, max_delay_ms=20)
+        batcher.start()
+        # Two rows with the same id: the first one is saved, only the second one fails
+        results = await asyncio.gather(
+            batcher.submit(engine, {"id": 7, "title": "First", "owner_id": 1}),
+            batcher.submit(engine, {"id": 7, "title": "Duplicate", "owner_id": 1}),
+            batcher.submit(engine, {"title": "Other", "owner_id": 1}),
+            return_exceptions=True,
+        )
+        await batcher.close()
+        return results
+
+    first, duplicate, other = asyncio.run(insert_batch())
+    assert first == 7
+    assert isinstance(duplicate, IntegrityError)
+    assert isinstance(other, int)
+    with db.create_session_factory(engine)() as session:
+        assert sorted(todo.title for todo in session.query(models.Todos)) == ["First", "Other"]
+    engine.dispose()
+
+
+"""
+IDEMPOTENCY KEYS
+"""
+
+def test_create_todo_with_idempotency_key(logged_in_client: TestClient):
+    new_todo = {**{key: value for key, value in todo.items() if key not in ("id", "owner_id")}, "title": "Idempotent"}
+    headers = {"Idempotency-Key": "create-todo-1"}
+    first = logged_in_client.post("/todo/", json=new_todo, headers=headers)
+    retry = logged_in_client.post("/todo/", json=new_todo, headers=headers)
+    assert first.status_code == retry.status_code == status.HTTP_201_CREATED
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert [item["title"] for item in logged_in_client.get("/todo/").json()].count("Idempotent") == 1
+
+    # Same key, different request
+    response = logged_in_client.post("/todo/", json={**new_todo, "title": "Other"}, headers=headers)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_CONTENT
+
+def test_concurrent_duplicates_are_executed_once(tmp_path, override_get_logged_in_user):
+    settings = Settings(database_uri=f"sqlite:///{tmp_path}/todos.db", secret_key="test-secret-key-test-secret-key!")
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+    new_todo = {key: value for key, value in todo.items() if key not in ("id", "owner_id")}
+
+    with TestClient(app) as client:
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            responses = list(pool.map(lambda _: client.post("/todo/", json=new_todo, headers={"Idempotency-Key": "burst"}), range(10)))
+        assert all(response.status_code == status.HTTP_201_CREATED for response in responses)
+        assert sum(response.headers.get("Idempotent-Replayed") == "true" for response in responses) == 9
+        assert len(client.get("/todo/").json()) == 1
+
+
+"""
+SINGLE-FLIGHT
+"""
+
+def test_single_flight_collapses_identical_calls():
+    executions = []
+
+    def slow_query():
+        executions.append(1)
+        time.sleep(0.05)
+        return [{"title": "Learn to code"}]
+
+    async def burst():
+        flights = SingleFlight()
+        results = await asyncio.gather(*(flights.do((1, "todos"), slow_query) for _ in range(5)),
+                                       flights.do((2, "todos"), slow_query))
+        return flights, results
+
+    flights, results = asyncio.run(burst())
+    # One query per owner, the other 4 calls of the owner 1 got the same result
+    assert len(executions) == 2
+    assert flights.stats() == {"calls": 2, "collapsed": 4, "in_flight": 0}
+    assert all(result == [{"title": "Learn to code"}] for result in results)
+
+def test_single_flight_writes_forget_the_owner():
+    async def read_after_write():
+        flights = SingleFlight()
+        started = asyncio.Event()
+
+        def stale_query():
+            time.sleep(0.05)
+            return "before the write"
+
+        async def leader():
+            task = asyncio.ensure_future(flights.do((1, "todos"), stale_query))
+            started.set()
+            return await task
+
+        leader_task = asyncio.ensure_future(leader())
+        await started.wait()
+        await asyncio.sleep(0)
+        # A write of the owner 1 happens here: the next read does not join the query that is in flight
+        flights.forget_owner(1)
+        fresh = await flights.do((1, "todos"), lambda: "after the write")
+        return await leader_task, fresh, flights.stats()
+
+    stale, fresh, stats = asyncio.run(read_after_write())
+    assert (stale, fresh) == ("before the write", "after the write")
+    assert stats["collapsed"] == 0
+
+def test_single_flight_stats_endpoint(logged_in_admin_client: TestClient):
+    response = logged_in_admin_client.get("/admin/single-flight")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["enabled"] is True
+
+
+"""
+DELTA SYNC (GET /todo/changes): its own app (SQLite file), the archival job commits with its own session
+"""
+
+def test_delta_sync(tmp_path, override_get_logged_in_user):
+    settings = Settings(database_uri=f"sqlite:///{tmp_path}/todos.db", secret_key="test-secret-key-test-secret-key!")
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+    new_todo = {"description": "Need to learn everyday", "priority": 5, "completed": False}
+
+    with TestClient(app) as client:
+        assert client.get("/todo/changes").json() == {"changes": [], "deleted": [], "token": 0, "has_more": False}
+        for title in ("First", "Second", "Third"):
+            assert client.post("/todo/", json={**new_todo, "title": title}).status_code == status.HTTP_201_CREATED
+
+        # First sync: everything
+        first_sync = client.get("/todo/changes", params={"since": 0}).json()
+        assert [item["title"] for item in first_sync["changes"]] == ["First", "Second", "Third"]
+        assert first_sync["token"] == 3
+        first, second, third = (item["id"] for item in first_sync["changes"])
+        # Paged like the changes: the next page of the first sync is requested with since=<token>
+        page = client.get("/todo/changes", params={"since": 0, "limit": 2}).json()
+        assert ([item["title"] for item in page["changes"]], page["token"], page["has_more"]) == (["First", "Second"], 2, True)
+        page = client.get("/todo/changes", params={"since": page["token"], "limit": 2}).json()
+        assert ([item["title"] for item in page["changes"]], page["token"], page["has_more"]) == (["Third"], 3, False)
+
+        # Paginated GET /todo/ (virtualized table of todos.js), with the sync token of the list
+        response = client.get("/todo/", params={"limit": 2})
+        assert ([item["id"] for item in response.json()], response.headers["Sync-Token"]) == ([first, second], "3")
+        assert [item["id"] for item in client.get("/todo/", params={"after_id": second, "limit": 2}).json()] == [third]
+
+        assert client.put(f"/todo/{first}", json={**new_todo, "title": "First, updated", "completed": True}).status_code == status.HTTP_204_NO_CONTENT
+        assert client.delete(f"/todo/{second}").status_code == status.HTTP_204_NO_CONTENT
+
+        # Only the changes since the token, one page at a time
+        page = client.get("/todo/changes", params={"since": 3, "limit": 1}).json()
+        assert ([item["title"] for item in page["changes"]], page["deleted"], page["token"], page["has_more"]) == (["First, updated"], [], 4, True)
+        page = client.get("/todo/changes", params={"since": 4, "limit": 1}).json()
+        assert (page["changes"], page["deleted"], page["token"], page["has_more"]) == ([], [second], 5, False)
+        assert client.get("/todo/changes", params={"since": 5}).json() == {"changes": [], "deleted": [], "token": 5, "has_more": False}
+
+        # Archived todos are gone from GET /todo/: they are synced as deleted
+        with app.state.session_factory() as session:
+            assert archive_todos(session, older_than=timedelta(0)) == 2
+        page = client.get("/todo/changes", params={"since": 5}).json()
+        assert (page["changes"], sorted(page["deleted"]), page["token"]) == ([], sorted([first, second]), 7)
+        assert [item["id"] for item in client.get("/todo/").json()] == [third]
+
+
+def test_rank_keys():
+    keys = ranks.sequential_keys(4000)
+    assert keys[:3] == ["a0", "a1", "a2"] and keys[62] == "b00"
+    assert keys == sorted(keys) and len(set(keys)) == len(keys)
+    # Always room between two keys, before the first one and after the last one
+    low, high = "a0", "a1"
+    for _ in range(50):
+        middle = ranks.key_between(low, high)
+        assert low < middle < high
+        low = middle
+    assert ranks.key_between(None, "a0") < "a0" < ranks.key_between("a0", None)
+    with pytest.raises(ValueError):
+        ranks.key_between("a1", "a1")
+
+
+def test_manual_ordering(tmp_path, override_get_logged_in_user):
+    settings = Settings(database_uri=f"sqlite:///{tmp_path}/todos.db", secret_key="test-secret-key-test-secret-key!")
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+    new_todo = {"description": "Need to learn everyday", "priority": 5, "completed": False}
+
+    def titles(**params) -> list[str]:
+        return [item["title"] for item in client.get("/todo/", params={"order": "position", **params}).json()]
+
+    with TestClient(app) as client:
+        for title in ("Todo A", "Todo B", "Todo C", "Todo D"):
+            assert client.post("/todo/", json={**new_todo, "title": title}).status_code == status.HTTP_201_CREATED
+        a, b, c, d = (item["id"] for item in client.get("/todo/").json())
+        assert titles() == ["Todo A", "Todo B", "Todo C", "Todo D"]
+
+        assert client.patch(f"/todo/{d}/move", json={"after_id": a}).status_code == status.HTTP_204_NO_CONTENT
+        assert client.patch(f"/todo/{c}/move", json={"before_id": a}).status_code == status.HTTP_204_NO_CONTENT
+        assert titles() == ["Todo C", "Todo A", "Todo D", "Todo B"]
+        # Keyset pagination in that order
+        assert titles(limit=2) == ["Todo C", "Todo A"]
+        assert titles(after_id=a, limit=2) == ["Todo D", "Todo B"]
+        # The default order is still by id. A move is a change for the delta sync
+        assert [item["title"] for item in client.get("/todo/").json()] == ["Todo A", "Todo B", "Todo C", "Todo D"]
+        assert client.get("/todo/changes", params={"since": 4}).json()["token"] == 6
+
+        assert client.patch(f"/todo/{a}/move", json={"after_id": a}).status_code == status.HTTP_422_UNPROCESSABLE_CONTENT
+        assert client.patch(f"/todo/{a}/move", json={"after_id": b, "before_id": c}).status_code == status.HTTP_422_UNPROCESSABLE_CONTENT
+        assert client.patch(f"/todo/{a}/move", json={"after_id": 999}).status_code == status.HTTP_404_NOT_FOUND
+
+        # Moving into the same gap again and again makes the keys longer, until the rebalance job shortens them
+        for _ in range(200):
+            client.patch(f"/todo/{b}/move", json={"after_id": c})
+            client.patch(f"/todo/{d}/move", json={"after_id": c})
+        assert titles() == ["Todo C", "Todo D", "Todo B", "Todo A"]
+        with app.state.session_factory() as session:
+            assert max(len(todo.position) for todo in session.query(models.Todos)) > models.MAX_POSITION_LENGTH
+            assert ranks.rebalance_positions(session) == 1
+            assert [todo.position for todo in session.query(models.Todos).order_by(models.Todos.position)] == ["a0", "a1", "a2", "a3"]
+        assert titles() == ["Todo C", "Todo D", "Todo B", "Todo A"]
+
+
+def test_quotas(tmp_path, override_get_logged_in_user, override_get_logged_in_admin):
+    settings = Settings(database_uri=f"sqlite:///{tmp_path}/todos.db", secret_key="test-secret-key-test-secret-key!",
+                        todo_quota_max_todos=3, todo_quota_writes_per_minute=5, todo_quota_roles="admin=0:0")
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+    new_todo = {"title": "Quota", "description": "Need to learn everyday", "priority": 5, "completed": False}
+
+    with TestClient(app) as client:
+        with app.state.session_factory() as session:
+            session.add(models.Users(id=1, username="evasq", email="evasq@example.com", role="user"))
+            session.commit()
+
+        for remaining in (2, 1, 0):
+            response = client.post("/todo/", json=new_todo)
+            assert response.status_code == status.HTTP_201_CREATED
+            assert response.headers["Todo-Quota-Limit"] == "3"
+            assert response.headers["Todo-Quota-Remaining"] == str(remaining)
+        response = client.post("/todo/", json=new_todo)
+        assert (response.status_code, response.json()["detail"]) == (status.HTTP_403_FORBIDDEN, "Todo quota exceeded")
+
+        # Deleting frees a slot. The rejected create did not use the bucket (5 writes): it is empty after one more write
+        todo_id = client.get("/todo/").json()[0]["id"]
+        assert client.delete(f"/todo/{todo_id}").status_code == status.HTTP_204_NO_CONTENT
+        response = client.post("/todo/", json=new_todo)
+        assert (response.status_code, response.headers["RateLimit-Remaining"]) == (status.HTTP_201_CREATED, "0")
+        response = client.put(f"/todo/{todo_id + 1}", json=new_todo)
+        assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+        assert int(response.headers["Retry-After"]) >= 1
+
+        # Per-user quota, set by an admin (whose role is unlimited)
+        app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_admin
+        quota = {"max_todos": 4, "writes_per_minute": 0}
+        assert client.put("/admin/user/1/quota", json=quota).status_code == status.HTTP_204_NO_CONTENT
+        assert client.put("/admin/user/999/quota", json=quota).status_code == status.HTTP_404_NOT_FOUND
+        top = client.get("/admin/quotas/top").json()
+        assert top["owners"] == [{"owner_id": 1, "changes": 5, "todos": 3}]
+        assert (top["recent"][0]["owner_id"], top["recent"][0]["rejected"]) == (1, 2)
+        app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+
+        response = client.post("/todo/", json=new_todo)
+        assert response.status_code == status.HTTP_201_CREATED
+        assert "RateLimit-Limit" not in response.headers
+        assert client.post("/todo/", json=new_todo).status_code == status.HTTP_403_FORBIDDEN
+
+
+def test_quota_rejections_are_not_replayed(tmp_path, override_get_logged_in_user):
+    # 60 writes per minute: one token per second. The 429 of a create is not saved under its Idempotency-Key
+    settings = Settings(database_uri=f"sqlite:///{tmp_path}/todos.db", secret_key="test-secret-key-test-secret-key!",
+                        todo_quota_writes_per_minute=60)
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+    new_todo = {"title": "Quota", "description": "Need to learn everyday", "priority": 5, "completed": False}
+
+    with TestClient(app) as client:
+        usage = None
+        while usage is None or usage.tokens >= 1:
+            assert client.post("/todo/", json=new_todo).status_code == status.HTTP_201_CREATED
+            usage = app.state.quotas._usage[1]
+        response = client.post("/todo/", json=new_todo, headers={"Idempotency-Key": "k1"})
+        assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+        time.sleep(int(response.headers["Retry-After"]))
+
+        retry = client.post("/todo/", json=new_todo, headers={"Idempotency-Key": "k1"})
+        assert retry.status_code == status.HTTP_201_CREATED
+        assert "Idempotent-Replayed" not in retry.headers
+        # Saved now: the next retry is a replay, with the headers of the first response
+        replay = client.post("/todo/", json=new_todo, headers={"Idempotency-Key": "k1"})
+        assert (replay.status_code, replay.headers["Idempotent-Replayed"], replay.json()) == (status.HTTP_201_CREATED, "true", retry.json())
+        for header in ("RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset", "Content-Type"):
+            assert replay.headers[header] == retry.headers[header]
+
+def test_user_quota_without_default_quotas(tmp_path, override_get_logged_in_user, override_get_logged_in_admin):
+    # No default or role quota: the user_quotas row of the owner is enforced alone
+    settings = Settings(database_uri=f"sqlite:///{tmp_path}/todos.db", secret_key="test-secret-key-test-secret-key!")
+    app = create_app(settings)
+    new_todo = {"title": "Quota", "description": "Need to learn everyday", "priority": 5, "completed": False}
+
+    with TestClient(app) as client:
+        with app.state.session_factory() as session:
+            session.add(models.Users(id=1, username="evasq", email="evasq@example.com", role="user"))
+            session.commit()
+        app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_admin
+        assert client.put("/admin/user/1/quota", json={"max_todos": 1, "writes_per_minute": None}).status_code == status.HTTP_204_NO_CONTENT
+
+        app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+        response = client.post("/todo/", json=new_todo)
+        assert (response.status_code, response.headers["Todo-Quota-Remaining"]) == (status.HTTP_201_CREATED, "0")
+        assert client.post("/todo/", json=new_todo).status_code == status.HTTP_403_FORBIDDEN
+
+        # A delete by an admin frees the slot too
+        app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_admin
+        todo_id = client.get("/admin/todo").json()[0]["id"]
+        assert client.delete(f"/admin/todo/{todo_id}").status_code == status.HTTP_204_NO_CONTENT
+        app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+        assert client.post("/todo/", json=new_todo).status_code == status.HTTP_201_CREATED
+        assert client.post("/todo/", json=new_todo).status_code == status.HTTP_403_FORBIDDEN
+
+def test_recurrence_rules():
+    monday = datetime(2026, 10, 19, 9, 0, tzinfo=timezone.utc)
+    assert str(recurrence.parse_rule("rrule:freq=weekly;byday=th,mo;interval=2")) == "FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH"
+    for invalid in ("FREQ=HOURLY", "FREQ=DAILY;BYDAY=MO", "FREQ=DAILY;COUNT=0", "FREQ=DAILY;BYSETPOS=1", "INTERVAL=2",
+                    "FREQ=DAILY;COUNT=2;UNTIL=20300101"):
+        with pytest.raises(ValueError):
+            recurrence.parse_rule(invalid)
+
+    # The next occurrence after now: the missed ones are skipped (and counted)
+    assert recurrence.next_occurrence("FREQ=DAILY", monday, monday) == (monday + timedelta(days=1), "FREQ=DAILY")
+    assert recurrence.next_occurrence("FREQ=DAILY;COUNT=5", monday, monday + timedelta(days=2, hours=1)) == (
+        monday + timedelta(days=3), "FREQ=DAILY;COUNT=2")
+    assert recurrence.next_occurrence("FREQ=DAILY;COUNT=1", monday, monday) is None
+    assert recurrence.next_occurrence("FREQ=DAILY;UNTIL=20261020", monday, monday) is None
+    # Thursday of the same week, then Monday two weeks later
+    thursday, _ = recurrence.next_occurrence("FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH", monday, monday)
+    assert thursday == monday + timedelta(days=3)
+    assert recurrence.next_occurrence("FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH", thursday, thursday)[0] == monday + timedelta(weeks=2)
+    # The months without a 31st are skipped
+    october_31 = datetime(2026, 10, 31, tzinfo=timezone.utc)
+    assert recurrence.next_occurrence("FREQ=MONTHLY", october_31, october_31)[0] == datetime(2026, 12, 31, tzinfo=timezone.utc)
+    leap_day = datetime(2028, 2, 29, tzinfo=timezone.utc)
+    assert recurrence.next_occurrence("FREQ=YEARLY", leap_day, leap_day)[0] == datetime(2032, 2, 29, tzinfo=timezone.utc)
+
+    # The missed occurrences are skipped by whole cycles, not one by one (and counted)
+    started = time.perf_counter()
+    assert recurrence.next_occurrence("FREQ=DAILY", datetime(1, 1, 1, 9, 0, tzinfo=timezone.utc), monday) == (
+        monday + timedelta(days=1), "FREQ=DAILY")
+    assert time.perf_counter() - started < 0.1
+    assert recurrence.next_occurrence("FREQ=WEEKLY;BYDAY=MO,FR;COUNT=1000", monday - timedelta(weeks=52, days=3), monday) == (
+        monday + timedelta(days=4), "FREQ=WEEKLY;BYDAY=MO,FR;COUNT=894")
+    # A series that would go past datetime.max is over
+    for rule in ("FREQ=DAILY", "FREQ=WEEKLY;BYDAY=SU", "FREQ=MONTHLY", "FREQ=YEARLY"):
+        assert recurrence.next_occurrence(rule, datetime(9999, 12, 31, tzinfo=timezone.utc), monday) is None
+
+
+def test_recurring_todos(tmp_path, override_get_logged_in_user):
+    settings = Settings(database_uri=f"sqlite:///{tmp_path}/todos.db", secret_key="test-secret-key-test-secret-key!")
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+    due_at = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(hours=1)
+    routine = {"title": "Water the plants", "description": "Every two days", "priority": 3, "completed": False,
+               "due_at": due_at.isoformat(), "recurrence": "freq=daily;interval=2;count=3"}
+
+    with TestClient(app) as client:
+        assert client.post("/todo/", json={**routine, "recurrence": "FREQ=HOURLY"}).status_code == status.HTTP_422_UNPROCESSABLE_CONTENT
+        assert client.post("/todo/", json={**routine, "due_at": None}).status_code == status.HTTP_422_UNPROCESSABLE_CONTENT
+        for out_of_range in ("0001-01-01T00:00:00Z", "9999-12-31T00:00:00Z"):
+            assert client.post("/todo/", json={**routine, "due_at": out_of_range}).status_code == status.HTTP_422_UNPROCESSABLE_CONTENT
+        assert client.post("/todo/", json=routine).status_code == status.HTTP_201_CREATED
+        created = client.get("/todo/").json()[0]
+        assert (datetime.fromisoformat(created["due_at"]), created["recurrence"]) == (due_at, "FREQ=DAILY;INTERVAL=2;COUNT=3")
+
+        # Completing an occurrence: the todo stays open, due at the next one
+        for expected_due_at, expected_rule in ((due_at + timedelta(days=2), "FREQ=DAILY;INTERVAL=2;COUNT=2"),
+                                               (due_at + timedelta(days=4), "FREQ=DAILY;INTERVAL=2;COUNT=1")):
+            current = client.get(f"/todo/{created['id']}").json()
+            assert client.put(f"/todo/{created['id']}", json={**current, "completed": True}).status_code == status.HTTP_204_NO_CONTENT
+            updated = client.get(f"/todo/{created['id']}").json()
+            assert (updated["completed"], datetime.fromisoformat(updated["due_at"]), updated["recurrence"]) == (False, expected_due_at, expected_rule)
+        # The last occurrence completes it
+        assert client.put(f"/todo/{created['id']}", json={**updated, "completed": True}).status_code == status.HTTP_204_NO_CONTENT
+        assert client.get(f"/todo/{created['id']}").json()["completed"] is True
+
+
+def test_due_scheduler(tmp_path):
+    engine = db.create_db_engine(f"sqlite:///{tmp_path}/todos.db")
+    db.Base.metadata.create_all(bind=engine)
+    session_factory = db.create_session_factory(engine)
+    now = datetime(2026, 10, 19, 9, 0, tzinfo=timezone.utc)
+    with session_factory() as session:
+        session.add_all([models.Todos(id=todo_id, owner_id=1, title=f"Todo {todo_id}", completed=todo_id == 3,
+                                      due_at=now + timedelta(seconds=todo_id)) for todo_id in range(1, 9)])
+        # Not due in the window: far in the future, in the past, without due date, deleted
+        session.add_all([models.Todos(id=20, owner_id=1, title="Later", completed=False, due_at=now + timedelta(days=1)),
+                         models.Todos(id=21, owner_id=1, title="Past", completed=False, due_at=now - timedelta(hours=1)),
+                         models.Todos(id=22, owner_id=1, title="Undated", completed=False),
+                         models.Todos(id=23, owner_id=1, title="Deleted", completed=False, due_at=now, deleted_at=now)])
+        session.commit()
+
+    scheduler = DueScheduler([session_factory], window_seconds=60, max_entries=3, refresh_seconds=10)
+    events = []
+    scheduler.subscribe(events.append)
+
+    def step(at: datetime):
+        if scheduler.last_loaded is not None and not scheduler.heap:
+            after = max((at - scheduler.refresh, 0), scheduler.last_loaded)
+        else:
+            after = (at - scheduler.refresh, 0)
+        if at >= scheduler.next_scan_at:
+            scheduler.load(at, *scheduler.scan(at, after))
+        scheduler.emit(scheduler.check_due(scheduler.pop_due(at)))
+
+    scheduler.next_scan_at = now
+    step(now)
+    # BOUNDED: the 3 first pending todos of the window (3 is completed), the window ends at the last one
+    assert sorted(todo_id for _, todo_id, _ in scheduler.heap) == [1, 2, 4]
+    assert scheduler.horizon == now + timedelta(seconds=4)
+
+    # Todo 2 is moved out of the window before its time: the heap entry is stale, nothing is emitted for it
+    with session_factory() as session:
+        session.get(models.Todos, 2).due_at = now + timedelta(days=2)
+        session.commit()
+    for seconds in range(1, 12):
+        step(now + timedelta(seconds=seconds))
+    # The scans after the end of the window resumed from the last loaded todo
+    assert [event.todo_id for event in events] == [1, 4, 5, 6, 7, 8]
+    assert all(event.due_at == now + timedelta(seconds=event.todo_id) for event in events)
+    assert len(scheduler.heap) <= 3
+
+    # A rescan of the same window (todos due less than refresh_seconds ago) does not emit them again
+    scheduler.next_scan_at = now
+    step(now + timedelta(seconds=12))
+    assert len(events) == 6
+
+
+def test_due_events_are_emitted(tmp_path, override_get_logged_in_user):
+    settings = Settings(database_uri=f"sqlite:///{tmp_path}/todos.db", secret_key="test-secret-key-test-secret-key!")
+    app = create_app(settings)
+    app.dependency_overrides[tokens.get_logged_in_user] = lambda: override_get_logged_in_user
+    events = []
+    app.state.due_scheduler.subscribe(events.append)
+    reminder = {"title": "Call back", "description": "In a moment", "priority": 2, "completed": False}
+
+    with TestClient(app) as client:
+        due_at = datetime.now(timezone.utc) + timedelta(seconds=1)
+        assert client.post("/todo/", json={**reminder, "due_at": due_at.isoformat()}).status_code == status.HTTP_201_CREATED
+        assert client.post("/todo/", json={**reminder, "title": "Tomorrow", "due_at": (due_at + timedelta(days=1)).isoformat()}).status_code == status.HTTP_201_CREATED
+        deadline = time.monotonic() + 10
+        while not events and time.monotonic() < deadline:
+            time.sleep(0.05)
+    assert [(event.title, event.due_at) for event in events] == [("Call back", due_at)]
@@ -57,3 +57,26 @@ def test_change_phone_number(logged_in_client: TestClient):
     response = logged_in_client.get("/user/")
     assert response.status_code == status.HTTP_200_OK
     assert response.json().get("phone_number") == user.get("phone_number")
+
+def test_get_user_does_not_expose_password(logged_in_client: TestClient):
+    response = logged_in_client.get("/user/")
+    assert response.status_code == status.HTTP_200_OK
+    assert "hashed_password" not in response.json()
+
+def test_profile_cache_invalidation(logged_in_client: TestClient, monkeypatch):
+    from utils.cache import TTLCache
+    profile_cache = TTLCache(ttl=60)
+    monkeypatch.setattr(logged_in_client.app.state, "profile_cache", profile_cache)
+
+    response = logged_in_client.get("/user/")
+    assert response.status_code == status.HTTP_200_OK
+    assert profile_cache.get(user.get("id")) is not None
+
+    # Writes invalidate the cached profile, so the next read returns the new value
+    user["phone_number"] = "+1 44 44 44"
+    response = logged_in_client.put("/user/change_phone_number", json={"phone_number": user.get("phone_number")})
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert profile_cache.get(user.get("id")) is None
+
+    response = logged_in_client.get("/user/")
+    assert response.json().get("phone_number") == user.get("phone_number")
@@ -0,0 +1,97 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, insert, delete, update, literal, text
+from sqlalchemy.orm import Session, sessionmaker
+from database import db, models
+from utils import logs, todo_changes
+from utils.settings import Settings
+
+"""
+TODOS ARCHIVAL JOB
+Moves the todos that were completed or (soft) deleted more than todos_archive_after_days days ago (Settings) from the
+hot "todos" table to "todos_archive". Each batch (at most todos_archive_batch_size rows) is its own short transaction:
+    INSERT INTO todos_archive SELECT ... FROM todos WHERE id IN (batch)
+    DELETE FROM todos WHERE id IN (batch)
+so the job never holds long locks on "todos", and can be stopped at any time without losing rows.
+The rows of a batch are found with two range scans, one per partial index (completed todos by updated_at, deleted todos
+by deleted_at): the job does not read the whole hot table, in every worker, every todos_archive_interval_seconds.
+Archived todos leave GET /todo/: each one gets a new change number (delta sync, see utils/todo_changes.py).
+
+Running it once, from the command line:
+    python -m utils.archiver
+"""
+
+ARCHIVED_COLUMNS = ("id", "title", "description", "priority", "completed", "owner_id", "created_at", "updated_at", "deleted_at")
+
+
+def archive_todos(db_session: Session, older_than: timedelta, batch_size: int = 1000, max_batches: int | None = None) -> int:
+    cutoff = datetime.now(timezone.utc) - older_than
+    # No OR between the two conditions: each one uses its partial index. The predicates are the same text as the
+    # indexes (see models.COMPLETED_TODOS / DELETED_TODOS), so the planner can use them
+    branches = (
+        (text(models.COMPLETED_TODOS), models.Todos.updated_at),
+        (text(models.DELETED_TODOS), models.Todos.deleted_at),
+    )
+
+    archived = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        rows_by_id = {}
+        for predicate, column in branches:
+            for row in db_session.execute(
+                select(models.Todos.id, models.Todos.owner_id)
+                .where(predicate, column < cutoff).order_by(column, models.Todos.id).limit(batch_size)
+            ).mappings():
+                # A todo both completed and deleted is found twice
+                rows_by_id.setdefault(row["id"], dict(row))
+        # A full branch fills the batch: fewer rows mean both branches are exhausted
+        batch = sorted(rows_by_id.values(), key=lambda row: row["id"])[:batch_size]
+        if not batch:
+            break
+        batch_ids = [row["id"] for row in batch]
+        # Before touching the rows: the counters are always locked before the todos (see utils/todo_changes.py)
+        todo_changes.number_changes(db_session, batch)
+
+        source_columns = [getattr(models.Todos, column) for column in ARCHIVED_COLUMNS]
+        db_session.execute(
+            insert(models.TodosArchive).from_select(
+                [*ARCHIVED_COLUMNS, "archived_at"],
+                select(*source_columns, literal(datetime.now(timezone.utc), models.TodosArchive.archived_at.type))
+                .where(models.Todos.id.in_(batch_ids)),
+            )
+        )
+        db_session.execute(update(models.TodosArchive), [{"id": row["id"], "change_seq": row["change_seq"]} for row in batch])
+        db_session.execute(delete(models.Todos).where(models.Todos.id.in_(batch_ids)))
+        db_session.commit()
+
+        archived += len(batch_ids)
+        batches += 1
+        if len(batch_ids) < batch_size:
+            break
+    return archived
+
+
+def archive_with_new_session(session_factory: sessionmaker, settings: Settings) -> int:
+    database_session = session_factory()
+    try:
+        return archive_todos(database_session, timedelta(days=settings.todos_archive_after_days), settings.todos_archive_batch_size)
+    finally:
+        database_session.close()
+
+
+# Started by the main.py lifespan when settings.todos_archive_after_days > 0
+async def run_periodically(session_factory: sessionmaker, settings: Settings):
+    while True:
+        try:
+            # The job uses the synchronous SQLAlchemy session, so it runs in a thread to keep the event loop free
+            await asyncio.to_thread(archive_with_new_session, session_factory, settings)
+        except Exception:
+            logs.error_logger.exception("Archival job error")
+        await asyncio.sleep(settings.todos_archive_interval_seconds)
+
+
+if __name__ == "__main__":
+    cli_settings = Settings.from_env()
+    engine = db.create_db_engine(cli_settings.database_uri)
+    print("Archived todos:", archive_with_new_session(db.create_session_factory(engine), cli_settings))
+    engine.dispose()
@@ -0,0 +1,223 @@
+import asyncio, codecs, csv, io, json, multiprocessing, os
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Iterator, Literal
+from fastapi import FastAPI
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from sqlalchemy import insert, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from database import models
+from utils import passwords
+
+"""
+BULK USER IMPORT AND EXPORT (admins, see routers/admin.py)
+Import: a streamed CSV (with header) or NDJSON body, one user per line, processed in chunks of IMPORT_CHUNK_SIZE rows:
+1. Each row is validated (ImportedUser). Invalid rows are reported as errors
+2. Rows whose username/email already exist (in the database or earlier in the file) are reported as conflicts,
+   BEFORE hashing, so no bcrypt time is wasted on them
+3. Plain passwords are hashed in parallel in a process pool (bcrypt is CPU-bound, threads would share the GIL).
+   Rows may bring a "hashed_password" instead (e.g. an export of another instance), that is not hashed again
+4. The chunk is inserted with ONE multi-row INSERT and one commit. If it fails (a user was created meanwhile), its
+   rows are inserted one by one, so every conflict is reported on its own line
+Export: streamed with a server-side cursor (yield_per), so the users are never loaded in memory all at once.
+Quoted CSV fields with line breaks are not supported (the body is split by lines).
+"""
+
+IMPORT_CHUNK_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+EXPORTED_COLUMNS = ("id", "username", "email", "first_name", "last_name", "role", "is_active", "phone_number")
+
+
+class ImportedUser(BaseModel):
+    username: str = Field(min_length=1)
+    email: str = Field(min_length=1)
+    first_name: str
+    last_name: str
+    phone_number: str | None = None
+    role: Literal["user", "admin"] = "user"
+    password: str | None = Field(default=None, min_length=6) # as plain text
+    hashed_password: str | None = None # already hashed (bcrypt)
+
+    @model_validator(mode="after")
+    def one_password(self):
+        if (self.password is None) == (self.hashed_password is None):
+            raise ValueError("Provide either password or hashed_password")
+        if self.hashed_password is not None and not passwords.is_password_hash(self.hashed_password):
+            raise ValueError("hashed_password is not a supported password hash")
+        return self
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.conflicts: list[dict] = []
+        self.errors: list[dict] = []
+
+    def as_dict(self) -> dict:
+        return {"created": self.created, "conflicts": self.conflicts, "errors": self.errors}
+
+
+# One pool per application, created by the first import and shut down by the main.py lifespan
+def get_hash_pool(app: FastAPI) -> ProcessPoolExecutor:
+    if app.state.hash_pool is None:
+        workers = app.state.settings.password_hash_workers or os.cpu_count() or 1
+        # spawn: forking a process that runs an event loop and threads is not safe
+        app.state.hash_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return app.state.hash_pool
+
+
+async def read_lines(body: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, str]]:
+    # (line number, line) of a streamed body, without loading it whole in memory
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    line_number = 0
+    async for chunk in body:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            line_number += 1
+            yield line_number, line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield line_number + 1, pending.rstrip("\r")
+
+
+async def read_rows(body: AsyncIterator[bytes], file_format: Literal["csv", "ndjson"]) -> AsyncIterator[tuple[int, dict | Exception]]:
+    header = None
+    async for line_number, line in read_lines(body):
+        if not line.strip():
+            continue
+        try:
+            if file_format == "ndjson":
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError("Each line must be a JSON object")
+            elif header is None:
+                header = next(csv.reader([line]))
+                continue
+            else:
+                values = next(csv.reader([line]))
+                # Empty CSV cells are missing values
+                row = {name: value for name, value in zip(header, values) if value != ""}
+            yield line_number, row
+        except (ValueError, csv.Error) as err:
+            yield line_number, err
+
+
+def find_conflicts(db_session: Session, users: list[tuple[int, ImportedUser]], seen: dict[str, set], report: ImportReport) -> list[tuple[int, ImportedUser]]:
+    usernames = [user.username for _, user in users]
+    emails = [user.email for _, user in users]
+    existing = db_session.execute(
+        select(models.Users.username, models.Users.email)
+        .where(or_(models.Users.username.in_(usernames), models.Users.email.in_(emails)))
+    ).all()
+    taken = {"username": {row.username for row in existing} | seen["username"], "email": {row.email for row in existing} | seen["email"]}
+
+    accepted = []
+    for line_number, user in users:
+        field = next((field for field in ("username", "email") if getattr(user, field) in taken[field]), None)
+        if field is not None:
+            report.conflicts.append({"line": line_number, "field": field, "value": getattr(user, field)})
+            continue
+        for field in ("username", "email"):
+            taken[field].add(getattr(user, field))
+            seen[field].add(getattr(user, field))
+        accepted.append((line_number, user))
+    return accepted
+
+
+async def hash_in_pool(pool: ProcessPoolExecutor, plain_passwords: list[str], policy: passwords.PasswordPolicy) -> list[str]:
+    if not plain_passwords:
+        return []
+    # One slice per worker process, in parallel
+    workers = pool._max_workers
+    size = -(-len(plain_passwords) // workers)
+    slices = [plain_passwords[start:start + size] for start in range(0, len(plain_passwords), size)]
+    loop = asyncio.get_running_loop()
+    hashed = await asyncio.gather(*(loop.run_in_executor(pool, passwords.hash_passwords, part, policy) for part in slices))
+    return [hashed_password for part in hashed for hashed_password in part]
+
+
+def insert_users(db_session: Session, rows: list[tuple[int, dict]], report: ImportReport):
+    try:
+        db_session.execute(insert(models.Users), [row for _, row in rows])
+        db_session.commit()
+        report.created += len(rows)
+        return
+    except IntegrityError:
+        db_session.rollback()
+
+    # Somebody created one of these users after find_conflicts: one row at a time
+    for line_number, row in rows:
+        try:
+            db_session.execute(insert(models.Users), [row])
+            db_session.commit()
+            report.created += 1
+        except IntegrityError:
+            db_session.rollback()
+            report.conflicts.append({"line": line_number, "field": "username/email", "value": f"{row['username']}/{row['email']}"})
+
+
+async def import_chunk(db_session: Session, pool: ProcessPoolExecutor, policy: passwords.PasswordPolicy,
+                       chunk: list[tuple[int, dict | Exception]], seen: dict[str, set], report: ImportReport):
+    users = []
+    for line_number, row in chunk:
+        if isinstance(row, Exception):
+            report.errors.append({"line": line_number, "detail": str(row)})
+            continue
+        try:
+            users.append((line_number, ImportedUser.model_validate(row)))
+        except ValidationError as err:
+            report.errors.append({"line": line_number, "detail": "; ".join(error["msg"] for error in err.errors())})
+
+    users = find_conflicts(db_session, users, seen, report)
+    hashed = iter(await hash_in_pool(pool, [user.password for _, user in users if user.password is not None], policy))
+
+    rows = []
+    for line_number, user in users:
+        row = user.model_dump(exclude={"password"})
+        if user.password is not None:
+            row["hashed_password"] = next(hashed)
+        rows.append((line_number, {**row, "is_active": True}))
+    if rows:
+        insert_users(db_session, rows, report)
+
+
+async def import_users(db_session: Session, pool: ProcessPoolExecutor, policy: passwords.PasswordPolicy, body: AsyncIterator[bytes],
+                       file_format: Literal["csv", "ndjson"], chunk_size: int = IMPORT_CHUNK_SIZE) -> ImportReport:
+    report = ImportReport()
+    seen = {"username": set(), "email": set()}
+    chunk = []
+    async for line_number, row in read_rows(body, file_format):
+        chunk.append((line_number, row))
+        if len(chunk) >= chunk_size:
+            await import_chunk(db_session, pool, policy, chunk, seen, report)
+            chunk = []
+    if chunk:
+        await import_chunk(db_session, pool, policy, chunk, seen, report)
+    return report
+
+
+def export_users(db_session: Session, file_format: Literal["csv", "ndjson"], include_password_hashes: bool = False) -> Iterator[str]:
+    columns = [*EXPORTED_COLUMNS, "hashed_password"] if include_password_hashes else list(EXPORTED_COLUMNS)
+    # yield_per: the rows are fetched in batches from a server-side cursor (stream_results), instead of all at once
+    result = db_session.execute(
+        select(*(getattr(models.Users, column) for column in columns))
+        .order_by(models.Users.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+    if file_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for partition in result.partitions():
+            writer.writerows(partition)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+        return
+
+    for partition in result.partitions():
+        yield "".join(json.dumps(dict(row._mapping)) + "\n" for row in partition)
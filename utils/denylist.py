@@ -0,0 +1,149 @@
+import time, uuid, threading
+from abc import ABC, abstractmethod
+from typing import Annotated
+from fastapi import Depends, Request
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.orm import Session
+from database import models
+
+# Longer than a publish transaction, plus the clock difference between the workers
+FETCH_OVERLAP_SECONDS = 60
+
+"""
+ACCESS TOKENS DENYLIST
+Access tokens are stateless: after a logout, they remain valid until they expire (ACCESS_TOKEN_EXPIRE_MINUTES).
+In order to reject them, their 'jti' is added to a denylist:
+- Hot path: every worker keeps the revoked jtis in memory (jti -> exp), so checking a token costs a dict lookup
+- Authoritative store: a pluggable backend (by default, the revoked_access_tokens table) shared by all the workers
+- Every worker fetches the new revocations from the backend at most once every denylist_sync_seconds (Settings).
+  OVERLAPPING WINDOWS: each fetch reads again the revocations of the last FETCH_OVERLAP_SECONDS before the previous
+  one, so a revocation committed late (or stamped by a worker whose clock is behind) is not skipped. The entries
+  fetched twice are the same key of the in-memory dict
+- Entries are dropped (in memory and in the backend) once the token expires, so the denylist stays small:
+  it never holds more entries than the tokens revoked during the last ACCESS_TOKEN_EXPIRE_MINUTES
+"""
+
+
+class DenylistBackend(ABC):
+    """
+    Shared store of revocations. Other implementations (e.g. Redis streams) only have to implement these methods
+    (abstract: a backend that misses one can not be instantiated).
+    - publish: stores the (jti, exp) entries. Must accept a batch, so a logout storm is a bounded number of writes
+    - fetch: returns the entries published since the cursor (None: every entry), and the new cursor. An entry may be
+      returned by several fetches, but none may be missed
+    - purge: deletes the expired entries
+    """
+
+    @abstractmethod
+    def publish(self, entries: list[tuple[uuid.UUID, int]], db_session: Session):
+        ...
+
+    @abstractmethod
+    def fetch(self, cursor: datetime | None, db_session: Session) -> tuple[list[tuple[uuid.UUID, int]], datetime]:
+        ...
+
+    @abstractmethod
+    def purge(self, db_session: Session):
+        ...
+
+
+class DatabaseDenylistBackend(DenylistBackend):
+    def __init__(self, batch_size: int = 500):
+        self.batch_size = batch_size
+
+    def publish(self, entries: list[tuple[uuid.UUID, int]], db_session: Session):
+        revoked_at = models.utc_now()
+        rows = [{'jti': jti, 'expires_at': datetime.fromtimestamp(exp, timezone.utc), 'revoked_at': revoked_at}
+                for jti, exp in entries]
+        # Multi-row INSERT statements of at most batch_size rows
+        for start in range(0, len(rows), self.batch_size):
+            db_session.execute(models.RevokedAccessTokens.__table__.insert(), rows[start:start + self.batch_size])
+        db_session.commit()
+
+    def fetch(self, cursor: datetime | None, db_session: Session) -> tuple[list[tuple[uuid.UUID, int]], datetime]:
+        # First fetch: every revocation that has not expired (range scan on expires_at). Then the ones of the window
+        # [previous fetch - FETCH_OVERLAP_SECONDS, now] (range scan on revoked_at). NOT an id cursor: a worker that reads
+        # id N + 1 before id N is committed would never see N
+        now = models.utc_now()
+        query = (db_session.query(models.RevokedAccessTokens.jti, models.RevokedAccessTokens.expires_at)
+                 .filter(models.RevokedAccessTokens.expires_at > now))
+        if cursor is not None:
+            query = query.filter(models.RevokedAccessTokens.revoked_at >= cursor - timedelta(seconds=FETCH_OVERLAP_SECONDS))
+        entries = []
+        for jti, expires_at in query.all():
+            if expires_at.tzinfo is None: # Backends without timezone support (e.g. SQLite) store naive UTC datetimes
+                expires_at = expires_at.replace(tzinfo=timezone.utc)
+            entries.append((jti, int(expires_at.timestamp())))
+        return entries, now
+
+    def purge(self, db_session: Session):
+        (db_session.query(models.RevokedAccessTokens)
+         .filter(models.RevokedAccessTokens.expires_at <= datetime.now(timezone.utc))
+         .delete(synchronize_session=False))
+        db_session.commit()
+
+
+class AccessTokenDenylist:
+    def __init__(self, backend: DenylistBackend, sync_interval: float = 1.0, purge_interval: float = 300.0):
+        self.backend = backend
+        self.sync_interval = sync_interval
+        self.purge_interval = purge_interval
+        # jti (as a 128-bit int, more compact than the UUID string) -> exp (epoch seconds)
+        self._revoked: dict[int, int] = {}
+        self._cursor: datetime | None = None
+        self._last_sync = float("-inf")
+        self._last_purge = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def revoke(self, entries: list[tuple[str, int]], db_session: Session):
+        # entries: (jti, exp) of the access tokens to revoke. Effective immediately in this worker,
+        # and in the rest of the workers after their next sync
+        entries = [(uuid.UUID(jti), exp) for jti, exp in entries if exp > time.time()]
+        if not entries:
+            return
+        with self._lock:
+            for jti, exp in entries:
+                self._revoked[jti.int] = exp
+        self.backend.publish(entries, db_session)
+
+    def is_revoked(self, jti: str | None, db_session: Session) -> bool:
+        self.sync(db_session)
+        try:
+            key = uuid.UUID(jti).int
+        except (TypeError, ValueError):
+            return False
+        exp = self._revoked.get(key)
+        return exp is not None and exp > time.time()
+
+    def sync(self, db_session: Session, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_sync < self.sync_interval:
+            return
+        with self._lock:
+            if not force and now - self._last_sync < self.sync_interval:
+                return # Another thread synced while this one was waiting for the lock
+            self._last_sync = now
+
+            entries, self._cursor = self.backend.fetch(self._cursor, db_session)
+            for jti, exp in entries:
+                self._revoked[jti.int] = exp
+
+            # Dropping the entries of the tokens that already expired
+            epoch = time.time()
+            for key in [key for key, exp in self._revoked.items() if exp <= epoch]:
+                del self._revoked[key]
+
+            if now - self._last_purge >= self.purge_interval:
+                self._last_purge = now
+                self.backend.purge(db_session)
+
+
+# One denylist per application instance (see create_app in main.py), kept in app.state.denylist
+def get_denylist(request: Request) -> AccessTokenDenylist:
+    return request.app.state.denylist
+
+
+denylist_dependency: type[AccessTokenDenylist] = Annotated[AccessTokenDenylist, Depends(get_denylist)]
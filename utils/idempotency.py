@@ -0,0 +1,190 @@
+import asyncio, hashlib, time
+from datetime import datetime, timedelta, timezone
+from typing import Annotated
+from fastapi import Depends, HTTPException, Request, Response, status
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from database import db, models
+from utils.tokens import get_logged_in_user
+
+"""
+IDEMPOTENCY KEYS (POST /todo/ and POST /auth/)
+Clients that retry a POST send the same "Idempotency-Key: <unique value>" header in every attempt:
+1. The first request CLAIMS the key: it inserts an idempotency_keys row without response (the primary key makes
+   the insert fail for any other request with the same key, in any worker)
+2. After the route handler, the store_responses middleware saves the status code, the headers (without the hop-by-hop
+   ones) and the body in that row
+3. A retry gets the saved response ("Idempotent-Replayed: true"), without running the handler again.
+   A retry that arrives while the first request is still running waits for it (idempotency_wait_seconds), so
+   concurrent duplicates are executed only once. If it is still running after that, the answer is 409 (Retry-After)
+- Keys are scoped by path and user (anonymous for POST /auth/), and kept during idempotency_key_ttl_seconds
+- Reusing a key with a different request (method, path or body) is rejected with 422
+- 5XX responses are not saved: the claim is released, so the client can retry. The same for the 4XX that can succeed
+  later (RETRYABLE_STATUSES: e.g. the 429 and 403 of the todo quotas, see utils/quotas.py, which run after the claim)
+"""
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+POLL_SECONDS = 0.05
+PURGE_INTERVAL_SECONDS = 60
+# Not saved either: a retry after Retry-After (or after freeing a todo slot) runs the handler again
+RETRYABLE_STATUSES = (403, 408, 425, 429)
+# Headers of the connection, not of the response (RFC 9110). Content-Length is computed again for the replay
+NOT_STORED_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+                      "transfer-encoding", "upgrade", "content-length"}
+
+
+# Raised by the dependency when the response was already saved. Handled by replay_response (registered in main.py)
+class IdempotentReplay(Exception):
+    def __init__(self, status_code: int, body: bytes | None, media_type: str | None, headers: list[list[str]] | None):
+        self.status_code = status_code
+        self.body = body
+        self.media_type = media_type
+        self.headers = headers
+
+
+class IdempotencyStore:
+    def __init__(self, ttl_seconds: float = 86400, wait_seconds: float = 10):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.wait_seconds = wait_seconds
+        self._last_purge = 0.0
+
+    def claim(self, db_session: Session, scope: str, key: str, fingerprint: str):
+        # Returns None if the key was claimed by this request, or the (fingerprint, status_code, body, media_type, headers) row
+        now = models.utc_now()
+        self.purge_expired(db_session, now)
+        try:
+            db_session.add(models.IdempotencyKeys(scope=scope, key=key, fingerprint=fingerprint, created_at=now, expires_at=now + self.ttl))
+            db_session.commit()
+            return None
+        except IntegrityError:
+            db_session.rollback()
+
+        row = db_session.execute(
+            select(models.IdempotencyKeys.fingerprint, models.IdempotencyKeys.status_code, models.IdempotencyKeys.body,
+                   models.IdempotencyKeys.media_type, models.IdempotencyKeys.headers, models.IdempotencyKeys.expires_at)
+            .where(models.IdempotencyKeys.scope == scope, models.IdempotencyKeys.key == key)
+        ).first()
+        db_session.commit() # Ending the transaction, so the next poll sees the new commits
+        if row is None:
+            # Released (5XX, retryable 4XX) or purged in the meantime
+            return self.claim(db_session, scope, key, fingerprint)
+
+        expires_at = row.expires_at if row.expires_at.tzinfo is not None else row.expires_at.replace(tzinfo=timezone.utc)
+        if expires_at <= now:
+            self.release(db_session, scope, key)
+            return self.claim(db_session, scope, key, fingerprint)
+        return row
+
+    def complete(self, db_session: Session, scope: str, key: str, status_code: int, body: bytes, media_type: str | None,
+                 headers: list[list[str]]):
+        db_session.execute(
+            update(models.IdempotencyKeys)
+            .where(models.IdempotencyKeys.scope == scope, models.IdempotencyKeys.key == key)
+            .values(status_code=status_code, body=body, media_type=media_type, headers=headers)
+        )
+        db_session.commit()
+
+    def release(self, db_session: Session, scope: str, key: str):
+        db_session.execute(delete(models.IdempotencyKeys).where(models.IdempotencyKeys.scope == scope, models.IdempotencyKeys.key == key))
+        db_session.commit()
+
+    def purge_expired(self, db_session: Session, now: datetime):
+        # At most once per PURGE_INTERVAL_SECONDS per process, using the expires_at index
+        if time.monotonic() - self._last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = time.monotonic()
+        db_session.execute(delete(models.IdempotencyKeys).where(models.IdempotencyKeys.expires_at < now))
+        db_session.commit()
+
+
+def request_fingerprint(request: Request, body: bytes) -> str:
+    return hashlib.sha256(b"\n".join([request.method.encode(), request.url.path.encode(), body])).hexdigest()
+
+
+async def claim_idempotency_key(request: Request, db_session: Session, scope: str):
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return
+    if not 0 < len(key) <= MAX_KEY_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid {IDEMPOTENCY_HEADER} header")
+
+    store: IdempotencyStore = request.app.state.idempotency
+    scope = f"{request.url.path}|{scope}"
+    # The body was already read by FastAPI (it is cached in the request)
+    fingerprint = request_fingerprint(request, await request.body())
+    deadline = time.monotonic() + store.wait_seconds
+
+    while True:
+        row = store.claim(db_session, scope, key, fingerprint)
+        if row is None:
+            # The middleware saves the response of this request
+            request.state.idempotency = (scope, key, db_session)
+            return
+        if row.fingerprint != fingerprint:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+                                detail=f"This {IDEMPOTENCY_HEADER} was used with a different request")
+        if row.status_code is not None:
+            raise IdempotentReplay(row.status_code, row.body, row.media_type, row.headers)
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"A request with this {IDEMPOTENCY_HEADER} is in progress",
+                                headers={"Retry-After": "1"})
+        # The first request is still running (here or in another worker)
+        await asyncio.sleep(POLL_SECONDS)
+
+
+### DEPENDENCY FUNCTIONS (used as dependencies=[...] of the routes) ###
+db_dependency: type[Session] = Annotated[Session, Depends(db.get_db)]
+user_dependency: type[dict] = Annotated[dict, Depends(get_logged_in_user)]
+
+
+async def user_idempotency_key(request: Request, user_data: user_dependency, db_session: db_dependency):
+    await claim_idempotency_key(request, db_session, f"user:{user_data.get('user_id')}")
+
+
+async def anonymous_idempotency_key(request: Request, db_session: db_dependency):
+    await claim_idempotency_key(request, db_session, "anonymous")
+
+
+### MIDDLEWARE AND EXCEPTION HANDLER (registered in main.py) ###
+async def store_responses(request: Request, call_next):
+    try:
+        response = await call_next(request)
+    except Exception:
+        claim = getattr(request.state, "idempotency", None)
+        if claim is not None:
+            scope, key, db_session = claim
+            request.app.state.idempotency.release(db_session, scope, key)
+        raise
+
+    claim = getattr(request.state, "idempotency", None)
+    if claim is None:
+        return response
+
+    scope, key, db_session = claim
+    store: IdempotencyStore = request.app.state.idempotency
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    # The session of the request (get_db) was closed after the handler, it starts a new transaction
+    if response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES:
+        store.release(db_session, scope, key)
+    else:
+        headers = [[name, value] for name, value in response.headers.items() if name.lower() not in NOT_STORED_HEADERS]
+        store.complete(db_session, scope, key, response.status_code, body, response.headers.get("content-type"), headers)
+
+    # The body iterator was consumed, a new response is returned with the same body and headers
+    stored_response = Response(content=body, status_code=response.status_code)
+    stored_response.raw_headers = response.raw_headers
+    return stored_response
+
+
+async def replay_response(request: Request, exc: IdempotentReplay):
+    response = Response(content=exc.body or b"", status_code=exc.status_code)
+    if exc.headers is not None:
+        # The headers of the first response (quota headers, Retry-After, Sync-Token...), repeated ones included
+        response.raw_headers = [*response.raw_headers, *((name.encode("latin-1"), value.encode("latin-1")) for name, value in exc.headers)]
+    elif exc.media_type:
+        # Saved before the headers were
+        response.headers["Content-Type"] = exc.media_type
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
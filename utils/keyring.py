@@ -0,0 +1,122 @@
+import json, hashlib, jwt
+from typing import Annotated
+from fastapi import Depends, Request
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
+from jwt.algorithms import RSAAlgorithm, OKPAlgorithm
+
+"""
+JWT KEYRING
+- Asymmetric keys (RS256 / EdDSA) are signed with a PRIVATE key and verified with the PUBLIC key.
+  Other services can verify our access tokens locally, downloading the public keys from /.well-known/jwks.json
+- Every asymmetric token carries a 'kid' (Key ID) header, so the verifier knows which key was used to sign it
+- Key rotation: the first private key of JWT_KEYS signs new tokens. The rest of the keys are only used for verification,
+  so tokens signed with a retired key remain valid until they expire
+- SECRET_KEY (HS256) is kept as a fallback/legacy key: tokens without a 'kid' header are verified with it
+
+Settings (.env) example:
+    JWT_KEYS="2025-12=keys/2025-12.pem,2025-11=keys/2025-11.pub.pem"
+
+Creating keys:
+    openssl genpkey -algorithm ed25519 -out keys/2025-12.pem
+    openssl genpkey -algorithm RSA -pkeyopt rsa_keygen_bits:2048 -out keys/2025-12.pem
+    openssl pkey -in keys/2025-11.pem -pubout -out keys/2025-11.pub.pem
+"""
+
+
+class JWTKey:
+    def __init__(self, kid: str | None, algorithm: str, signing_key, verifying_key):
+        self.kid = kid
+        self.algorithm = algorithm
+        self.signing_key = signing_key # None for verification-only (retired) keys
+        self.verifying_key = verifying_key
+
+    @property
+    def is_asymmetric(self) -> bool:
+        return self.algorithm in ("RS256", "EdDSA")
+
+    def to_jwk(self) -> dict:
+        # Only PUBLIC keys are published. A symmetric secret must never leave the server
+        if self.algorithm == "RS256":
+            jwk = RSAAlgorithm.to_jwk(self.verifying_key, as_dict=True)
+        elif self.algorithm == "EdDSA":
+            jwk = OKPAlgorithm.to_jwk(self.verifying_key, as_dict=True)
+        else:
+            raise ValueError(f"Cannot publish a {self.algorithm} key")
+        jwk.update({"kid": self.kid, "alg": self.algorithm, "use": "sig"})
+        return jwk
+
+
+def _algorithm_for(key) -> str:
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return "RS256"
+    if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+        return "EdDSA"
+    raise ValueError(f"Unsupported key type: {type(key).__name__}. Use RSA or Ed25519 keys")
+
+
+def load_pem_key(kid: str, pem: bytes) -> JWTKey:
+    # A private key can sign and verify. A public key can only verify (useful for retired keys)
+    try:
+        private_key = serialization.load_pem_private_key(pem, password=None)
+        return JWTKey(kid, _algorithm_for(private_key), private_key, private_key.public_key())
+    except ValueError:
+        public_key = serialization.load_pem_public_key(pem)
+        return JWTKey(kid, _algorithm_for(public_key), None, public_key)
+
+
+class KeyRing:
+    def __init__(self, keys: list[JWTKey] | None = None, secret_key: str | None = None, secret_algorithm: str = "HS256"):
+        self.keys: dict[str, JWTKey] = {key.kid: key for key in keys or []}
+        self.hmac_key: JWTKey | None = None
+        if secret_key:
+            self.hmac_key = JWTKey(None, secret_algorithm, secret_key, secret_key)
+
+        # The first key that is able to sign becomes the ACTIVE key. Falling back to SECRET_KEY if there is none
+        self.active_key: JWTKey | None = next((key for key in keys or [] if key.signing_key is not None), self.hmac_key)
+        if self.active_key is None:
+            raise ValueError("No JWT signing key configured. Set JWT_KEYS and/or SECRET_KEY")
+
+        self._jwks: dict | None = None
+
+    @classmethod
+    def from_settings(cls, settings) -> "KeyRing":
+        keys = []
+        for entry in filter(None, (item.strip() for item in settings.jwt_keys.split(","))):
+            kid, _, path = entry.partition("=")
+            if not path:
+                raise ValueError(f"Invalid JWT_KEYS entry '{entry}'. Expected <kid>=<path to PEM file>")
+            with open(path.strip(), "rb") as pem_file:
+                keys.append(load_pem_key(kid.strip(), pem_file.read()))
+        return cls(keys, settings.secret_key, settings.algorithm)
+
+    def encode(self, payload: dict) -> str:
+        key = self.active_key
+        headers = {"kid": key.kid} if key.kid is not None else None
+        return jwt.encode(payload, key.signing_key, algorithm=key.algorithm, headers=headers)
+
+    def decode(self, token: str, options: dict | None = None) -> dict:
+        # The 'kid' header selects the key. The accepted algorithm comes from OUR key, never from the token header,
+        # preventing algorithm confusion attacks (e.g. an RS256 public key used as an HS256 secret)
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self.hmac_key if kid is None else self.keys.get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError("Unknown signing key")
+        return jwt.decode(token, key.verifying_key, algorithms=[key.algorithm], options=options)
+
+    def jwks(self) -> dict:
+        # The key set does not change while the process is alive, so it is built only once
+        if self._jwks is None:
+            self._jwks = {"keys": [key.to_jwk() for key in self.keys.values() if key.is_asymmetric]}
+        return self._jwks
+
+    def jwks_etag(self) -> str:
+        return '"' + hashlib.sha256(json.dumps(self.jwks(), sort_keys=True).encode()).hexdigest()[:32] + '"'
+
+
+# Parsed only once per application instance (see create_app in main.py), and kept in app.state.keyring
+def get_keyring(request: Request) -> KeyRing:
+    return request.app.state.keyring
+
+
+keyring_dependency: type[KeyRing] = Annotated[KeyRing, Depends(get_keyring)]
@@ -0,0 +1,218 @@
+import json, logging, queue, random, re, sys, time, traceback, uuid
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from fastapi import Request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from utils.settings import Settings
+
+"""
+STRUCTURED LOGS (JSON lines: one object per line, on stdout or in Settings.log_file)
+- ACCESS LOG ("todoapp.access"): one line per request, with request_id, user_id, method, route (the path template,
+  e.g. /todo/{todo_id}), status, latency_ms, db_ms and queries (time and number of the SQL statements of the request)
+- ERROR LOG ("todoapp.errors" and every other "todoapp.*" logger): the lines logged while a request is handled carry its
+  request_id and user_id too, so an error can be matched with its access log line
+- NON-BLOCKING: the loggers only put the formatted line in a queue (QueueHandler). A QueueListener thread writes them,
+  so a slow disk or pipe never blocks the event loop. Started and stopped by the main.py lifespan
+- SAMPLING: the successful requests of high-volume routes (Settings.access_log_sampling, e.g. "GET /todo/=0.1") are only
+  logged with that probability, and their line has sample_rate (each line stands for 1 / sample_rate requests).
+  Errors (status >= 400) and slow requests (>= access_log_slow_ms) are always logged
+- The request id comes from the X-Request-ID header (e.g. set by the load balancer), or is generated. It is sent back
+  in the X-Request-ID response header
+
+Uvicorn has its own (plain text) access log: run it with --no-access-log.
+"""
+
+REQUEST_ID_HEADER = "X-Request-ID"
+VALID_REQUEST_ID = re.compile(r"[A-Za-z0-9._-]{1,128}")
+
+logger = logging.getLogger("todoapp")
+access_logger = logging.getLogger("todoapp.access")
+error_logger = logging.getLogger("todoapp.errors")
+
+
+### REQUEST CONTEXT ###
+# Mutable: the threads of the request (sync dependencies, asyncio.to_thread) get a copy of the context, with the same object
+@dataclass
+class RequestLog:
+    request_id: str
+    user_id: int | None = None
+    queries: int = 0
+    db_seconds: float = 0.0
+
+
+current_request: ContextVar[RequestLog | None] = ContextVar("current_request", default=None)
+
+
+def annotate(user_id: int | None = None):
+    # Called by get_logged_in_user (utils/tokens.py)
+    request_log = current_request.get()
+    if request_log is not None and user_id is not None:
+        request_log.user_id = user_id
+
+
+### DB TIME AND QUERY COUNT ###
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._log_started_at = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    request_log = current_request.get()
+    started_at = getattr(context, "_log_started_at", None)
+    if request_log is not None and started_at is not None:
+        request_log.queries += 1
+        request_log.db_seconds += time.perf_counter() - started_at
+
+
+def instrument_engine(engine: Engine):
+    # Every engine of the app (primary, replicas, shards). Outside a request (background jobs), nothing is counted
+    if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+### FORMATTING AND SHIPPING ###
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record. The fields passed as extra={"fields": {...}} are added to it, and the request_id and
+    user_id of the current request (if any)
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request_log = current_request.get()
+        if request_log is not None:
+            line["request_id"] = request_log.request_id
+            line["user_id"] = request_log.user_id
+        line.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            line["exception"] = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+        return json.dumps(line, default=str)
+
+
+class LogShipper:
+    """
+    The QueueHandler of the "todoapp" loggers, and the QueueListener thread that writes their lines.
+    Logging is per process: with several apps in the same process (tests), each one adds its own handler while it runs
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.queue_handler: QueueHandler | None = None
+        self.listener: QueueListener | None = None
+
+    def start(self):
+        if self.settings.log_file:
+            output = logging.FileHandler(self.settings.log_file, encoding="utf-8")
+        else:
+            output = logging.StreamHandler(sys.stdout)
+        # The line is formatted (JSON) by the QueueHandler, in the thread of the request: the request context is there
+        output.setFormatter(logging.Formatter("%(message)s"))
+        log_queue = queue.SimpleQueue()
+        self.queue_handler = QueueHandler(log_queue)
+        self.queue_handler.setFormatter(JsonFormatter())
+        self.listener = QueueListener(log_queue, output)
+        self.listener.start()
+
+        logger.addHandler(self.queue_handler)
+        logger.setLevel(self.settings.log_level.upper())
+        logger.propagate = False
+
+    def stop(self):
+        if self.listener is None:
+            return
+        logger.removeHandler(self.queue_handler)
+        if not logger.handlers:
+            logger.propagate = True
+        # Writes the lines that are still in the queue, then joins the thread
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        self.listener = self.queue_handler = None
+
+
+### ACCESS LOG MIDDLEWARE (registered in main.py) ###
+def parse_sampling(value: str) -> dict[str, float]:
+    rates = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        route, separator, rate = entry.rpartition("=")
+        try:
+            sample_rate = float(rate)
+        except ValueError:
+            sample_rate = -1
+        if not separator or len(route.split()) != 2 or not 0 <= sample_rate <= 1:
+            raise ValueError(f"Invalid ACCESS_LOG_SAMPLING entry {entry!r}, expected <METHOD> <route>=<rate between 0 and 1>")
+        method, path = route.split()
+        rates[f"{method.upper()} {path}"] = sample_rate
+    return rates
+
+
+class AccessLog:
+    def __init__(self, enabled: bool = True, sampling: dict[str, float] | None = None, slow_ms: float = 1000):
+        self.enabled = enabled
+        self.sampling = sampling or {}
+        self.slow_ms = slow_ms
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "AccessLog":
+        return cls(settings.access_log, parse_sampling(settings.access_log_sampling), settings.access_log_slow_ms)
+
+    def sample_rate(self, method: str, route: str, status_code: int, latency_ms: float) -> float:
+        if status_code >= 400 or latency_ms >= self.slow_ms:
+            return 1.0
+        return self.sampling.get(f"{method} {route}", 1.0)
+
+
+def route_template(request: Request) -> str:
+    # Set in the scope by the router (e.g. "/todo/{todo_id}"). Not found / static files: the path itself
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or request.url.path
+
+
+async def log_requests(request: Request, call_next):
+    request_id = request.headers.get(REQUEST_ID_HEADER, "")
+    if not VALID_REQUEST_ID.fullmatch(request_id):
+        request_id = uuid.uuid4().hex
+    request_log = RequestLog(request_id)
+    # Set before call_next: the task that runs the route gets a copy of this context
+    context_token = current_request.set(request_log)
+    started_at = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        error_logger.exception("Unhandled error", extra={"fields": {
+            "method": request.method, "route": route_template(request), "status": 500,
+            "latency_ms": round((time.perf_counter() - started_at) * 1000, 2),
+        }})
+        current_request.reset(context_token)
+        raise
+
+    latency_ms = (time.perf_counter() - started_at) * 1000
+    response.headers[REQUEST_ID_HEADER] = request_id
+    access_log: AccessLog = request.app.state.access_log
+    route = route_template(request)
+    sample_rate = access_log.sample_rate(request.method, route, response.status_code, latency_ms)
+    if access_log.enabled and (sample_rate >= 1 or random.random() < sample_rate):
+        fields = {
+            "method": request.method,
+            "route": route,
+            "status": response.status_code,
+            "latency_ms": round(latency_ms, 2),
+            "db_ms": round(request_log.db_seconds * 1000, 2),
+            "queries": request_log.queries,
+        }
+        if sample_rate < 1:
+            fields["sample_rate"] = sample_rate
+        level = logging.ERROR if response.status_code >= 500 else logging.INFO
+        access_logger.log(level, f"{request.method} {request.url.path} {response.status_code}", extra={"fields": fields})
+    current_request.reset(context_token)
+    return response
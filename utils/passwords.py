@@ -0,0 +1,131 @@
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Literal
+
+"""
+PASSWORD HASHING POLICY (Settings: password_scheme, bcrypt_rounds, argon2_*)
+- New hashes use the configured scheme and parameters
+- Hashes of the other scheme, or with other parameters, are still verified, and are upgraded on the next login of the
+  user (authenticate_user in routers/auth.py), when the password is known: verify_and_update
+- argon2id needs argon2-cffi (pip install argon2-cffi), it is only imported when an argon2 hash is created or verified
+
+Calibration (prints the parameters whose verify time is the closest to the target on this host):
+    python -m utils.passwords --target-ms 250 [--scheme argon2] [--argon2-memory-kib 65536]
+"""
+
+
+# Frozen (hashable): it is the key of the CryptContext cache, and it can be sent to the process pool of the bulk import
+@dataclass(frozen=True)
+class PasswordPolicy:
+    scheme: Literal["bcrypt", "argon2"] = "bcrypt"
+    bcrypt_rounds: int = 12
+    argon2_time_cost: int = 3
+    argon2_memory_cost: int = 65536 # KiB
+    argon2_parallelism: int = 4
+
+    @classmethod
+    def from_settings(cls, settings) -> "PasswordPolicy":
+        return cls(settings.password_scheme, settings.bcrypt_rounds, settings.argon2_time_cost,
+                   settings.argon2_memory_cost, settings.argon2_parallelism)
+
+
+DEFAULT_POLICY = PasswordPolicy()
+
+
+# passlib (and its bcrypt backend) is imported when the first password is hashed or verified, not when the app starts.
+# Most requests (and many workers) never touch a password, so they never pay for it.
+@lru_cache(maxsize=8)
+def get_password_context(policy: PasswordPolicy = DEFAULT_POLICY):
+    from passlib.context import CryptContext
+    other_scheme = "argon2" if policy.scheme == "bcrypt" else "bcrypt"
+    # deprecated="auto": every scheme but the first one needs an update.
+    # min_rounds = max_rounds = default_rounds: hashes with a different cost need an update too
+    return CryptContext(
+        schemes=[policy.scheme, other_scheme],
+        deprecated="auto",
+        bcrypt__default_rounds=policy.bcrypt_rounds,
+        bcrypt__min_rounds=policy.bcrypt_rounds,
+        bcrypt__max_rounds=policy.bcrypt_rounds,
+        argon2__type="ID",
+        argon2__default_rounds=policy.argon2_time_cost,
+        argon2__min_rounds=policy.argon2_time_cost,
+        argon2__max_rounds=policy.argon2_time_cost,
+        argon2__memory_cost=policy.argon2_memory_cost,
+        argon2__parallelism=policy.argon2_parallelism,
+    )
+
+
+def hash_password(password: str, policy: PasswordPolicy = DEFAULT_POLICY) -> str:
+    return get_password_context(policy).hash(password)
+
+
+def verify_password(password: str, hashed_password: str, policy: PasswordPolicy = DEFAULT_POLICY) -> bool:
+    return get_password_context(policy).verify(password, hashed_password)
+
+
+# (is the password valid, new hash if the stored one does not follow the policy anymore, otherwise None)
+def verify_and_update(password: str, hashed_password: str, policy: PasswordPolicy = DEFAULT_POLICY) -> tuple[bool, str | None]:
+    return get_password_context(policy).verify_and_update(password, hashed_password)
+
+
+# Used by the bulk user import (see utils/bulk_users.py), in the worker processes of a process pool
+def hash_passwords(passwords: list[str], policy: PasswordPolicy = DEFAULT_POLICY) -> list[str]:
+    return [hash_password(password, policy) for password in passwords]
+
+
+def is_password_hash(hashed_password: str, policy: PasswordPolicy = DEFAULT_POLICY) -> bool:
+    # Pre-hashed passwords must be in a format that verify_password understands
+    return get_password_context(policy).identify(hashed_password, required=False) is not None
+
+
+### CALIBRATION ###
+def verify_time(policy: PasswordPolicy, samples: int = 3) -> float:
+    hashed_password = hash_password("calibration-password", policy)
+    start = time.perf_counter()
+    for _ in range(samples):
+        verify_password("calibration-password", hashed_password, policy)
+    return (time.perf_counter() - start) / samples
+
+
+def calibrate(target_seconds: float, scheme: Literal["bcrypt", "argon2"] = "bcrypt", argon2_memory_cost: int = 65536,
+              argon2_parallelism: int = 4, max_cost: int = 20) -> tuple[PasswordPolicy, float]:
+    # The cost grows until the verify time reaches the target. The closest of the last two costs is chosen
+    if scheme == "bcrypt":
+        make_policy = lambda cost: PasswordPolicy(scheme="bcrypt", bcrypt_rounds=cost)
+        cost = 4 # bcrypt minimum. Each round doubles the time
+    else:
+        make_policy = lambda cost: PasswordPolicy(scheme="argon2", argon2_time_cost=cost, argon2_memory_cost=argon2_memory_cost,
+                                                  argon2_parallelism=argon2_parallelism)
+        cost = 1
+
+    previous = None
+    while True:
+        policy = make_policy(cost)
+        elapsed = verify_time(policy)
+        if elapsed >= target_seconds or cost >= max_cost:
+            if previous is not None and target_seconds - previous[1] < elapsed - target_seconds:
+                return previous
+            return policy, elapsed
+        previous = (policy, elapsed)
+        cost += 1
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Chooses the password hashing parameters for a target verify time")
+    parser.add_argument("--target-ms", type=float, default=250)
+    parser.add_argument("--scheme", choices=["bcrypt", "argon2"], default="bcrypt")
+    parser.add_argument("--argon2-memory-kib", type=int, default=65536)
+    parser.add_argument("--argon2-parallelism", type=int, default=4)
+    args = parser.parse_args()
+
+    chosen, seconds = calibrate(args.target_ms / 1000, args.scheme, args.argon2_memory_kib, args.argon2_parallelism)
+    print(f"# verify time: {seconds * 1000:.1f} ms (target {args.target_ms:.0f} ms)")
+    print(f"PASSWORD_SCHEME={chosen.scheme}")
+    if chosen.scheme == "bcrypt":
+        print(f"BCRYPT_ROUNDS={chosen.bcrypt_rounds}")
+    else:
+        print(f"ARGON2_TIME_COST={chosen.argon2_time_cost}")
+        print(f"ARGON2_MEMORY_COST={chosen.argon2_memory_cost}")
+        print(f"ARGON2_PARALLELISM={chosen.argon2_parallelism}")
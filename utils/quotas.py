@@ -0,0 +1,213 @@
+import math, threading, time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Annotated
+from fastapi import Depends, HTTPException, Request, Response, status
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from database import db, models, shards
+from utils.settings import Settings
+from utils.tokens import get_logged_in_user
+
+"""
+TODO QUOTAS PER USER AND PER ROLE (Settings: todo_quota_*, table user_quotas)
+Two limits, 0 meaning unlimited:
+- max_todos: live todos of the owner (POST /todo/ is rejected with 403 when it is reached)
+- writes_per_minute: creates, updates, moves and deletes of the owner (429 with Retry-After when exceeded). TOKEN BUCKET:
+  bursts up to writes_per_minute, refilled continuously
+The quota of a user is the one of their role (Users.role, in the JWT), or the default one, with the non-NULL values
+of their user_quotas row on top (set by the admins: PUT /admin/user/{user_id}/quota).
+Without any limit for an owner (the default and role quotas are 0 and there is no user_quotas row), only that row is
+read, once per todo_quota_cache_seconds: their todos are not counted.
+
+CACHED COUNTERS: there is no COUNT(*) per insert. Every worker counts the todos of an owner once (indexed by owner), then
+keeps the count up to date with its own creates and deletes. A create is counted when it is accepted, so concurrent
+creates of a worker can not pass the limit together (a create that fails keeps its slot until the next count).
+The count and the user_quotas row are read again after todo_quota_cache_seconds, which corrects the writes of the other
+workers and the archival job. So the limits are SOFT: with N workers, an owner can go over max_todos by the creates of
+the other workers during that time, and the rate is limited per worker (N * writes_per_minute in total). Enough to stop a runaway client, without a write per request.
+
+Every write gets the headers of its quota: Todo-Quota-Limit / Todo-Quota-Remaining and RateLimit-Limit /
+RateLimit-Remaining / RateLimit-Reset (seconds until the bucket is full again).
+"""
+
+
+@dataclass(frozen=True)
+class Quota:
+    max_todos: int = 0
+    writes_per_minute: int = 0
+
+
+class OwnerUsage:
+    __slots__ = ("quota", "todos", "loaded_at", "tokens", "refilled_at", "writes", "rejected")
+
+    def __init__(self, quota: Quota, todos: int, now: float):
+        self.quota = quota
+        self.todos = todos
+        self.loaded_at = now
+        self.tokens = float(quota.writes_per_minute)
+        self.refilled_at = now
+        self.writes = 0 # accepted writes in this worker, for the top consumers (GET /admin/quotas/top)
+        self.rejected = 0
+
+    def refill(self, now: float):
+        rate = self.quota.writes_per_minute / 60
+        self.tokens = min(float(self.quota.writes_per_minute), self.tokens + (now - self.refilled_at) * rate)
+        self.refilled_at = now
+
+    def headers(self) -> dict[str, str]:
+        headers = {}
+        if self.quota.max_todos:
+            headers["Todo-Quota-Limit"] = str(self.quota.max_todos)
+            headers["Todo-Quota-Remaining"] = str(max(0, self.quota.max_todos - self.todos))
+        if self.quota.writes_per_minute:
+            missing = self.quota.writes_per_minute - self.tokens
+            headers["RateLimit-Limit"] = str(self.quota.writes_per_minute)
+            headers["RateLimit-Remaining"] = str(int(self.tokens))
+            headers["RateLimit-Reset"] = str(math.ceil(missing * 60 / self.quota.writes_per_minute))
+        return headers
+
+
+def parse_roles(value: str) -> dict[str, Quota]:
+    roles = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        role, separator, limits = entry.partition("=")
+        max_todos, colon, writes_per_minute = limits.partition(":")
+        try:
+            quota = Quota(int(max_todos), int(writes_per_minute))
+        except ValueError:
+            quota = None
+        if not separator or not colon or not role.strip() or quota is None or min(quota.max_todos, quota.writes_per_minute) < 0:
+            raise ValueError(f"Invalid TODO_QUOTA_ROLES entry {entry!r}, expected <role>=<max todos>:<writes per minute>")
+        roles[role.strip()] = quota
+    return roles
+
+
+class QuotaTracker:
+    """
+    Per-process usage of the owners that wrote recently (least recently used ones are evicted after max_owners).
+    One tracker per application instance: app.state.quotas
+    """
+
+    def __init__(self, default: Quota, roles: dict[str, Quota] | None = None, cache_seconds: float = 60,
+                 max_owners: int = 100_000):
+        self.default = default
+        self.roles = roles or {}
+        self.cache_seconds = cache_seconds
+        self.max_owners = max_owners
+        self._usage: OrderedDict[int, OwnerUsage] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "QuotaTracker":
+        return cls(Quota(settings.todo_quota_max_todos, settings.todo_quota_writes_per_minute),
+                   parse_roles(settings.todo_quota_roles), settings.todo_quota_cache_seconds)
+
+    def quota_for(self, role: str | None, override: models.UserQuotas | None) -> Quota:
+        quota = self.roles.get(role, self.default)
+        if override is not None:
+            quota = replace(quota, **{field: getattr(override, field) for field in ("max_todos", "writes_per_minute")
+                                      if getattr(override, field) is not None})
+        return quota
+
+    def usage(self, owner_id: int, role: str | None, db_session: Session, todo_db_session: Session) -> OwnerUsage:
+        now = time.monotonic()
+        with self._lock:
+            usage = self._usage.get(owner_id)
+            if usage is not None and now - usage.loaded_at < self.cache_seconds:
+                self._usage.move_to_end(owner_id)
+                return usage
+
+        # Cache miss or stale: the quota (primary, by primary key). A user_quotas row applies even when neither the
+        # default nor the role has a limit
+        quota = self.quota_for(role, db_session.get(models.UserQuotas, owner_id))
+        # The live todos (shard of the owner, indexed by owner), only counted when they are limited
+        todos = 0
+        if quota.max_todos:
+            todos = todo_db_session.scalar(
+                select(func.count()).select_from(models.Todos)
+                .where(models.Todos.owner_id == owner_id, models.Todos.deleted_at.is_(None))
+            )
+        with self._lock:
+            usage = self._usage.get(owner_id)
+            if usage is None:
+                usage = self._usage[owner_id] = OwnerUsage(quota, todos, now)
+            else:
+                # The counters of the owner are kept, and the token bucket too (full again if the quota changed)
+                usage.refill(now)
+                if quota != usage.quota:
+                    usage.tokens = float(quota.writes_per_minute)
+                usage.quota, usage.todos, usage.loaded_at = quota, todos, now
+            self._usage.move_to_end(owner_id)
+            while len(self._usage) > self.max_owners:
+                self._usage.popitem(last=False)
+            return usage
+
+    def acquire(self, usage: OwnerUsage, creating: bool):
+        # Raises 403 (todo count) or 429 (rate), with the quota headers. Otherwise, one write is taken from the bucket,
+        # and a create takes its place in the todo count
+        with self._lock:
+            quota = usage.quota
+            if creating and quota.max_todos and usage.todos >= quota.max_todos:
+                usage.rejected += 1
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Todo quota exceeded", headers=usage.headers())
+            if quota.writes_per_minute:
+                usage.refill(time.monotonic())
+                if usage.tokens < 1:
+                    usage.rejected += 1
+                    retry_after = math.ceil((1 - usage.tokens) * 60 / quota.writes_per_minute)
+                    raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many writes, slow down",
+                                        headers={**usage.headers(), "Retry-After": str(retry_after)})
+                usage.tokens -= 1
+            if creating:
+                usage.todos += 1
+            usage.writes += 1
+
+    def record_delete(self, owner_id: int):
+        # After the commit of a delete of this worker
+        with self._lock:
+            usage = self._usage.get(owner_id)
+            if usage is not None:
+                usage.todos = max(0, usage.todos - 1)
+
+    def forget(self, owner_id: int):
+        # The quota of the owner changed: read again on the next write (in this worker, the others after cache_seconds)
+        with self._lock:
+            usage = self._usage.get(owner_id)
+            if usage is not None:
+                usage.loaded_at = -math.inf
+
+    def top_writers(self, limit: int) -> list[dict]:
+        with self._lock:
+            usages = list(self._usage.items())
+        usages.sort(key=lambda item: item[1].writes, reverse=True)
+        return [{"owner_id": owner_id, "writes": usage.writes, "rejected": usage.rejected, "todos": usage.todos}
+                for owner_id, usage in usages[:limit]]
+
+
+### DEPENDENCY FUNCTIONS (used as dependencies=[...] of the todo write routes) ###
+db_dependency: type[Session] = Annotated[Session, Depends(db.get_db)]
+todo_db_dependency: type[Session] = Annotated[Session, Depends(shards.get_todo_db)]
+user_dependency: type[dict] = Annotated[dict, Depends(get_logged_in_user)]
+
+
+def enforce_quota(request: Request, response: Response, user_data: dict, db_session: Session, todo_db_session: Session,
+                  creating: bool):
+    # Every owner has a quota, maybe unlimited: it is only known after reading their user_quotas row (cached)
+    tracker: QuotaTracker = request.app.state.quotas
+    usage = tracker.usage(user_data.get("user_id"), user_data.get("user_role"), db_session, todo_db_session)
+    tracker.acquire(usage, creating)
+    # FastAPI copies the headers of this response to the response of the route
+    response.headers.update(usage.headers())
+
+
+async def todo_create_quota(request: Request, response: Response, user_data: user_dependency,
+                            db_session: db_dependency, todo_db_session: todo_db_dependency):
+    enforce_quota(request, response, user_data, db_session, todo_db_session, creating=True)
+
+
+async def todo_write_quota(request: Request, response: Response, user_data: user_dependency,
+                           db_session: db_dependency, todo_db_session: todo_db_dependency):
+    enforce_quota(request, response, user_data, db_session, todo_db_session, creating=False)
@@ -0,0 +1,264 @@
+import asyncio
+from sqlalchemy import distinct, func, select, text, tuple_, update
+from sqlalchemy.orm import Session, sessionmaker
+from database import db, models
+from utils import logs, todo_changes
+from utils.settings import Settings
+
+"""
+MANUAL ORDERING OF TODOS (Todos.position, PATCH /todo/{id}/move, GET /todo/?order=position)
+Positions are RANK KEYS: strings that are compared byte by byte (base 62 digits, 0-9 < A-Z < a-z), so a todo can be
+put between two others by giving it a key between theirs. Moving a todo updates ONE row, its neighbours keep their keys.
+- A key is an "integer part" plus an optional "fraction". The first character (head) tells the length of the integer
+  part (a -> 2 characters "a0".."az", b -> 3 characters "b00"..., Z, Y... for the ones before "a0"):
+    * Appending (new todos) increments the integer part: keys grow by one character every 62^n todos
+    * Moving between two todos takes the midpoint of their fractions: keys grow by one character every ~6 moves
+      into the same gap
+- When a key is longer than models.MAX_POSITION_LENGTH, the rebalance job (run_periodically, started by main.py) gives
+  the todos of its owner new short keys, in the same order. Those owners are found with a partial index
+- The changes of the positions of an owner are serialized by its change counter (see utils/todo_changes.py)
+
+Rebalancing every owner that needs it, once, from the command line:
+    python -m utils.ranks
+"""
+
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+INTEGER_ZERO = "a0"
+SMALLEST_INTEGER = "A" + "0" * 26
+
+
+### RANK KEYS ###
+def integer_length(head: str) -> int:
+    if "a" <= head <= "z":
+        return ord(head) - ord("a") + 2
+    if "A" <= head <= "Z":
+        return ord("Z") - ord(head) + 2
+    raise ValueError(f"Invalid rank key head: {head!r}")
+
+
+def split_key(key: str) -> tuple[str, str]:
+    # (integer part, fraction)
+    length = integer_length(key[0]) if key else 0
+    if not key or length > len(key):
+        raise ValueError(f"Invalid rank key: {key!r}")
+    return key[:length], key[length:]
+
+
+def validate_key(key: str):
+    integer, fraction = split_key(key)
+    if integer == SMALLEST_INTEGER or fraction.endswith("0") or any(char not in DIGITS for char in key[1:]):
+        raise ValueError(f"Invalid rank key: {key!r}")
+
+
+def midpoint(low: str, high: str | None) -> str:
+    # A fraction between two fractions (low < high, high None: the end). Fractions never end with "0", so there is
+    # always room before them
+    if high is not None:
+        common = 0
+        while (low[common] if common < len(low) else "0") == high[common]:
+            common += 1
+        if common > 0:
+            return high[:common] + midpoint(low[common:], high[common:])
+    low_digit = DIGITS.index(low[0]) if low else 0
+    high_digit = DIGITS.index(high[0]) if high is not None else len(DIGITS)
+    if high_digit - low_digit > 1:
+        return DIGITS[(low_digit + high_digit + 1) // 2]
+    # Consecutive digits: one more digit is needed
+    if high is not None and len(high) > 1:
+        return high[:1]
+    return DIGITS[low_digit] + midpoint(low[1:], None)
+
+
+def increment_integer(integer: str) -> str | None:
+    head, digits = integer[0], list(integer[1:])
+    for index in reversed(range(len(digits))):
+        digit = DIGITS.index(digits[index]) + 1
+        if digit < len(DIGITS):
+            digits[index] = DIGITS[digit]
+            return head + "".join(digits)
+        digits[index] = "0"
+    # Every digit overflowed: the integer part gets longer (or shorter, for the negative heads A-Z)
+    if head == "Z":
+        return INTEGER_ZERO
+    if head == "z":
+        return None
+    head = chr(ord(head) + 1)
+    if head > "a":
+        digits.append("0")
+    else:
+        digits.pop()
+    return head + "".join(digits)
+
+
+def decrement_integer(integer: str) -> str | None:
+    head, digits = integer[0], list(integer[1:])
+    for index in reversed(range(len(digits))):
+        digit = DIGITS.index(digits[index]) - 1
+        if digit >= 0:
+            digits[index] = DIGITS[digit]
+            return head + "".join(digits)
+        digits[index] = DIGITS[-1]
+    if head == "a":
+        return "Z" + DIGITS[-1]
+    if head == "A":
+        return None
+    head = chr(ord(head) - 1)
+    if head < "Z":
+        digits.append(DIGITS[-1])
+    else:
+        digits.pop()
+    return head + "".join(digits)
+
+
+def key_between(low: str | None, high: str | None) -> str:
+    # A key between low and high (None: the start / the end of the list)
+    for key in (low, high):
+        if key is not None:
+            validate_key(key)
+    if low is not None and high is not None and low >= high:
+        raise ValueError(f"{low!r} is not before {high!r}")
+
+    if low is None:
+        if high is None:
+            return INTEGER_ZERO
+        integer, fraction = split_key(high)
+        if integer == SMALLEST_INTEGER:
+            return integer + midpoint("", fraction)
+        if fraction:
+            return integer
+        previous = decrement_integer(integer)
+        if previous is None:
+            raise ValueError("No key before the smallest key")
+        return previous
+
+    low_integer, low_fraction = split_key(low)
+    if high is None:
+        following = increment_integer(low_integer)
+        return low_integer + midpoint(low_fraction, None) if following is None else following
+
+    high_integer, high_fraction = split_key(high)
+    if low_integer == high_integer:
+        return low_integer + midpoint(low_fraction, high_fraction)
+    following = increment_integer(low_integer)
+    if following is not None and following < high:
+        return following
+    return low_integer + midpoint(low_fraction, None)
+
+
+def sequential_keys(count: int) -> list[str]:
+    # The shortest keys for <count> todos, in order: a0, a1, ..., az, b00, ...
+    keys, key = [], None
+    for _ in range(count):
+        key = key_between(key, None)
+        keys.append(key)
+    return keys
+
+
+### POSITIONS OF THE TODOS ###
+# The callers hold the change counter of the owner (todo_changes.next_seq), so no other transaction reads the same
+# neighbours at the same time
+def last_position(db_session: Session, owner_id: int) -> str | None:
+    return db_session.scalar(select(func.max(models.Todos.position)).where(models.Todos.owner_id == owner_id))
+
+
+def next_position(db_session: Session, owner_id: int) -> str:
+    # New todos go to the end of the list
+    return key_between(last_position(db_session, owner_id), None)
+
+
+def assign_positions(db_session: Session, rows: list[dict]):
+    # Sets the "position" of each row (dicts with "owner_id", group commit), at the end of the list of its owner
+    rows_by_owner: dict[int, list[dict]] = {}
+    for row in rows:
+        rows_by_owner.setdefault(row["owner_id"], []).append(row)
+    for owner_id, owner_rows in rows_by_owner.items():
+        position = last_position(db_session, owner_id)
+        for row in owner_rows:
+            position = row["position"] = key_between(position, None)
+
+
+def neighbour_position(db_session: Session, todo: models.Todos, anchor: models.Todos, after: bool) -> str | None:
+    # Position of the todo that follows (after=True) or precedes the anchor, ignoring the todo that is moved
+    order_key = tuple_(models.Todos.position, models.Todos.id)
+    anchor_key = tuple_(anchor.position, anchor.id)
+    query = select(models.Todos.position).where(models.Todos.owner_id == anchor.owner_id, models.Todos.id != todo.id)
+    if after:
+        query = query.where(order_key > anchor_key).order_by(models.Todos.position, models.Todos.id)
+    else:
+        query = query.where(order_key < anchor_key).order_by(models.Todos.position.desc(), models.Todos.id.desc())
+    return db_session.scalar(query.limit(1))
+
+
+def move_next_to(db_session: Session, todo: models.Todos, anchor: models.Todos, after: bool):
+    for attempt in range(2):
+        try:
+            neighbour = neighbour_position(db_session, todo, anchor, after)
+            low, high = (anchor.position, neighbour) if after else (neighbour, anchor.position)
+            todo.position = key_between(low, high)
+            return
+        except (ValueError, TypeError):
+            # Keys without room between them (equal, or NULL before the migration backfill): the owner is rebalanced
+            # first, in this transaction
+            if attempt == 1:
+                raise
+            rebalance_owner(db_session, anchor.owner_id)
+            db_session.refresh(anchor)
+
+
+### REBALANCE JOB ###
+def owners_to_rebalance(db_session: Session, limit: int = 100) -> list[int]:
+    # The SAME TEXT as the predicate of the partial index ix_todos_positions_to_rebalance (not a bound parameter),
+    # otherwise the planner can not prove that the index has every matching row: only the rows that need it are read
+    return list(db_session.scalars(
+        select(distinct(models.Todos.owner_id)).where(text(models.POSITIONS_TO_REBALANCE)).limit(limit)
+    ))
+
+
+def rebalance_owner(db_session: Session, owner_id: int) -> int:
+    # Same order, shortest keys. The todos without position (created before the migration backfill) go last
+    todo_ids = db_session.scalars(
+        select(models.Todos.id).where(models.Todos.owner_id == owner_id)
+        .order_by(models.Todos.position.is_(None), models.Todos.position, models.Todos.id)
+    ).all()
+    db_session.execute(update(models.Todos), [
+        {"id": todo_id, "position": position} for todo_id, position in zip(todo_ids, sequential_keys(len(todo_ids)))
+    ])
+    return len(todo_ids)
+
+
+def rebalance_positions(db_session: Session, max_owners: int | None = None) -> int:
+    rebalanced = 0
+    while max_owners is None or rebalanced < max_owners:
+        owners = owners_to_rebalance(db_session)
+        if not owners:
+            break
+        for owner_id in owners:
+            # One short transaction per owner, holding its change counter (no move or create of the owner meanwhile)
+            todo_changes.lock_owner(db_session, owner_id)
+            rebalance_owner(db_session, owner_id)
+            db_session.commit()
+            rebalanced += 1
+    return rebalanced
+
+
+def rebalance_with_new_session(session_factory: sessionmaker) -> int:
+    with session_factory() as database_session:
+        return rebalance_positions(database_session)
+
+
+# Started by the main.py lifespan when settings.todo_position_rebalance_seconds > 0 (one per shard)
+async def run_periodically(session_factory: sessionmaker, settings: Settings):
+    while True:
+        await asyncio.sleep(settings.todo_position_rebalance_seconds)
+        try:
+            # The job uses the synchronous SQLAlchemy session, so it runs in a thread to keep the event loop free
+            await asyncio.to_thread(rebalance_with_new_session, session_factory)
+        except Exception:
+            logs.error_logger.exception("Position rebalance job error")
+
+
+if __name__ == "__main__":
+    cli_settings = Settings.from_env()
+    engine = db.create_db_engine(cli_settings.database_uri)
+    print("Rebalanced owners:", rebalance_with_new_session(db.create_session_factory(engine)))
+    engine.dispose()
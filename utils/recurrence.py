@@ -0,0 +1,159 @@
+import calendar
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
+
+"""
+RECURRING TODOS (Todos.recurrence): a subset of the iCalendar RRULE (RFC 5545), e.g.
+    FREQ=DAILY
+    FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH
+    FREQ=MONTHLY;COUNT=6
+    FREQ=YEARLY;UNTIL=20301231T000000Z
+- Every occurrence has the time of day of Todos.due_at (in UTC: there is no time zone, so no daylight saving shift)
+- MONTHLY / YEARLY keep the day of the month: the months without that day are skipped (the 31st: Jan, Mar, May...)
+- COUNT is the number of occurrences LEFT, the current one included: it decreases as the todo moves forward
+- Completing a recurring todo completes its current occurrence: it stays open, due at the next occurrence after now
+  (the missed ones are skipped, whole cycles at once: no loop over every missed day). The last occurrence completes it
+  (see routers/todos.py). A series that would go past datetime.max is over
+"""
+
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY", "YEARLY")
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+MAX_INTERVAL = 1000
+# Todos.due_at must be in [MIN_DUE_AT, MAX_DUE_AT) (see models.TodoValidator): the months without the day of a MONTHLY
+# rule (29th to 31st) are skipped one by one, at most (now - MIN_DUE_AT) months
+MIN_DUE_AT = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MAX_DUE_AT = datetime(3000, 1, 1, tzinfo=timezone.utc)
+
+
+@dataclass(frozen=True)
+class Rule:
+    freq: str
+    interval: int = 1
+    count: int | None = None
+    until: datetime | None = None
+    by_day: tuple[int, ...] = () # weekdays (0: Monday), only with FREQ=WEEKLY
+
+    def __str__(self) -> str:
+        parts = [f"FREQ={self.freq}"]
+        if self.interval != 1:
+            parts.append(f"INTERVAL={self.interval}")
+        if self.by_day:
+            parts.append("BYDAY=" + ",".join(WEEKDAYS[day] for day in self.by_day))
+        if self.count is not None:
+            parts.append(f"COUNT={self.count}")
+        if self.until is not None:
+            parts.append("UNTIL=" + self.until.strftime("%Y%m%dT%H%M%SZ"))
+        return ";".join(parts)
+
+
+def parse_rule(value: str) -> Rule:
+    # ValueError with the part that is not supported
+    fields = {}
+    for part in value.strip().upper().removeprefix("RRULE:").split(";"):
+        name, separator, field_value = part.partition("=")
+        if not separator or name in fields:
+            raise ValueError(f"Invalid recurrence part {part!r}")
+        fields[name] = field_value
+
+    freq = fields.pop("FREQ", None)
+    if freq not in FREQUENCIES:
+        raise ValueError(f"FREQ must be one of {', '.join(FREQUENCIES)}")
+    rule = Rule(freq)
+    try:
+        if "INTERVAL" in fields:
+            rule = replace(rule, interval=int(fields.pop("INTERVAL")))
+        if "COUNT" in fields:
+            rule = replace(rule, count=int(fields.pop("COUNT")))
+        if "UNTIL" in fields:
+            until = fields.pop("UNTIL")
+            until_format = "%Y%m%dT%H%M%SZ" if "T" in until else "%Y%m%d"
+            rule = replace(rule, until=datetime.strptime(until, until_format).replace(tzinfo=timezone.utc))
+        if "BYDAY" in fields:
+            rule = replace(rule, by_day=tuple(sorted({WEEKDAYS.index(day) for day in fields.pop("BYDAY").split(",")})))
+    except ValueError:
+        raise ValueError(f"Invalid recurrence {value!r}")
+    if fields:
+        raise ValueError(f"Unsupported recurrence parts: {', '.join(fields)}")
+    if not 1 <= rule.interval <= MAX_INTERVAL or (rule.count is not None and rule.count < 1):
+        raise ValueError(f"INTERVAL must be between 1 and {MAX_INTERVAL}, COUNT at least 1")
+    if rule.count is not None and rule.until is not None:
+        raise ValueError("COUNT and UNTIL can not be used together")
+    if rule.by_day and rule.freq != "WEEKLY":
+        raise ValueError("BYDAY is only supported with FREQ=WEEKLY")
+    return rule
+
+
+def add_months(moment: datetime, months: int) -> datetime | None:
+    # None when the month has no such day. OverflowError after datetime.max, like the datetime arithmetic
+    month_index = moment.month - 1 + months
+    year, month = moment.year + month_index // 12, month_index % 12 + 1
+    if year > datetime.max.year:
+        raise OverflowError("date value out of range")
+    if moment.day > calendar.monthrange(year, month)[1]:
+        return None
+    return moment.replace(year=year, month=month)
+
+
+def following(rule: Rule, moment: datetime) -> datetime:
+    # The occurrence after <moment>, ignoring COUNT and UNTIL
+    if rule.freq == "DAILY":
+        return moment + timedelta(days=rule.interval)
+    if rule.freq == "WEEKLY":
+        if not rule.by_day:
+            return moment + timedelta(weeks=rule.interval)
+        later_days = [day for day in rule.by_day if day > moment.weekday()]
+        if later_days:
+            return moment + timedelta(days=later_days[0] - moment.weekday())
+        week_start = moment - timedelta(days=moment.weekday())
+        return week_start + timedelta(weeks=rule.interval, days=rule.by_day[0])
+    months = rule.interval * (12 if rule.freq == "YEARLY" else 1)
+    # At most 12 months (the 31st) or 8 years (February 29th) are skipped, with an interval of 1
+    for step in range(1, 400):
+        candidate = add_months(moment, months * step)
+        if candidate is not None:
+            return candidate
+    raise ValueError("No next occurrence")
+
+
+def skip_cycles(rule: Rule, moment: datetime, limit: datetime) -> tuple[datetime, int]:
+    # The whole cycles (INTERVAL days, weeks, months or years) from the occurrence <moment> that end before <limit>, in
+    # one step: (occurrence after them, number of occurrences passed). (moment, 0) when the cycles do not all have the
+    # same occurrences: a first due_at that is not on a BYDAY, or a day that some months (or years) do not have
+    if rule.freq in ("DAILY", "WEEKLY"):
+        if rule.by_day and moment.weekday() not in rule.by_day:
+            return moment, 0
+        cycle = timedelta(days=rule.interval) if rule.freq == "DAILY" else timedelta(weeks=rule.interval)
+        cycles = max(0, (limit - moment) // cycle)
+        # Every cycle of a BYDAY rule, from one of its days to the same day INTERVAL weeks later, has all of its days
+        return moment + cycles * cycle, cycles * max(1, len(rule.by_day))
+    if moment.day > 28 if rule.freq == "MONTHLY" else (moment.month, moment.day) == (2, 29):
+        return moment, 0
+    months = rule.interval * (12 if rule.freq == "YEARLY" else 1)
+    # One cycle less than the months between them: the day and time of <limit> are not compared
+    cycles = max(0, ((limit.year - moment.year) * 12 + limit.month - moment.month) // months - 1)
+    return add_months(moment, cycles * months), cycles
+
+
+def next_occurrence(value: str, due_at: datetime, now: datetime) -> tuple[datetime, str] | None:
+    # The first occurrence after max(due_at, now), with the rule that is left (COUNT decreased by the occurrences passed).
+    # None: the series is over
+    rule = parse_rule(value)
+    # SQLite returns naive datetimes (in UTC)
+    due_at = due_at if due_at.tzinfo is not None else due_at.replace(tzinfo=timezone.utc)
+    limit = max(due_at, now)
+    moment, count = due_at, rule.count
+    try:
+        while moment <= limit:
+            moment, passed = skip_cycles(rule, moment, limit)
+            if not passed:
+                moment, passed = following(rule, moment), 1
+            if count is not None:
+                count -= passed
+                if count <= 0:
+                    return None
+            if rule.until is not None and moment > rule.until:
+                return None
+    except OverflowError:
+        # After datetime.max
+        return None
+    return moment, str(replace(rule, count=count))
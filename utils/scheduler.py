@@ -0,0 +1,205 @@
+import asyncio, heapq, logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+from fastapi import Request
+from sqlalchemy import select, text, tuple_
+from sqlalchemy.orm import Session, sessionmaker
+from database import models
+from utils import logs
+from utils.settings import Settings
+
+"""
+DUE-TIME SCHEDULER (one per process: app.state.due_scheduler, started by the main.py lifespan)
+Emits a DueEvent when the due_at of a pending todo (not completed, not deleted) is reached, without scanning the todos:
+- MIN-HEAP of (due_at, todo id) with only the todos due in the next todo_due_window_seconds. It is fed by RANGE SCANS of
+  the partial index ix_todos_pending_due_at (due_at BETWEEN <a bit before now> AND <end of the window>), at most
+  todo_due_max_entries rows per database: with more todos due in the window, the window ends at the last one loaded,
+  and the next scan resumes after it. Memory is bounded by max_entries, not by the number of scheduled todos
+- The window is scanned again every todo_due_refresh_seconds (the writes of the other processes), when the heap reaches
+  its end, and soon after a write of this process that is due in the window (notify_due)
+- The heap is a cache: when their time comes, the todos are read again (by primary key). Todos that were completed,
+  deleted or moved to another time meanwhile are dropped
+- Recurring todos (see utils/recurrence.py): completing one moves its due_at to the next occurrence, the next scan (or
+  notify_due) puts that one in the heap
+- AT LEAST ONCE: the scans start todo_due_refresh_seconds before now, so the todos written by other processes with an
+  imminent due_at are not missed. The events already emitted are remembered for that time. A due_at set in the past (or
+  reached while no scheduler was running) does not emit anything. Every process that runs a scheduler emits the events
+
+The events are logged ("todoapp.scheduler") and passed to the listeners (subscribe), in the event loop: a listener must
+not block (schedule a task for slow work: sending an e-mail, a push notification...).
+"""
+
+logger = logging.getLogger("todoapp.scheduler")
+
+# After a write that is due in the window, the window is scanned again after at most this time (a burst of writes: one scan)
+RESCAN_DELAY_SECONDS = 0.5
+
+
+@dataclass(frozen=True)
+class DueEvent:
+    todo_id: int
+    owner_id: int
+    title: str
+    due_at: datetime
+    recurrence: str | None
+
+
+def utc(moment: datetime) -> datetime:
+    # SQLite returns naive datetimes (stored in UTC)
+    return moment if moment.tzinfo is not None else moment.replace(tzinfo=timezone.utc)
+
+
+### RANGE SCANS (run in a thread, with the synchronous sessions) ###
+def pending_due(db_session: Session, after: tuple[datetime, int], end: datetime, limit: int) -> list[tuple[datetime, int]]:
+    # Keyset range on (due_at, id). The predicate of the partial index is the same text (see models.PENDING_DUE_TODOS),
+    # so the planner can use it
+    rows = db_session.execute(
+        select(models.Todos.due_at, models.Todos.id)
+        .where(text(models.PENDING_DUE_TODOS), tuple_(models.Todos.due_at, models.Todos.id) > tuple_(*after),
+               models.Todos.due_at <= end)
+        .order_by(models.Todos.due_at, models.Todos.id)
+        .limit(limit)
+    ).all()
+    return [(utc(due_at), todo_id) for due_at, todo_id in rows]
+
+
+def still_due(db_session: Session, entries: list[tuple[datetime, int]]) -> list[DueEvent]:
+    # The todos of the heap whose time has come, if they are still pending with the same due_at
+    due_at_by_id = {todo_id: due_at for due_at, todo_id in entries}
+    todos = db_session.scalars(
+        select(models.Todos).where(models.Todos.id.in_(due_at_by_id), text(models.PENDING_DUE_TODOS))
+    ).all()
+    return [DueEvent(todo.id, todo.owner_id, todo.title, utc(todo.due_at), todo.recurrence)
+            for todo in todos if utc(todo.due_at) == due_at_by_id[todo.id]]
+
+
+class DueScheduler:
+    def __init__(self, session_factories: list[sessionmaker], window_seconds: float = 300, max_entries: int = 10_000,
+                 refresh_seconds: float = 10):
+        self.session_factories = session_factories
+        self.window = timedelta(seconds=window_seconds)
+        self.max_entries = max_entries
+        self.refresh = timedelta(seconds=refresh_seconds)
+        # (due_at, todo id, index of the session factory). Only the window [now - refresh, horizon]
+        self.heap: list[tuple[datetime, int, int]] = []
+        self.horizon: datetime | None = None
+        self.last_loaded: tuple[datetime, int] | None = None
+        self.next_scan_at: datetime | None = None
+        # (todo id, due_at) of the events emitted in the last refresh seconds, so a scan does not emit them again
+        self.emitted: set[tuple[int, datetime]] = set()
+        self.listeners: list[Callable[[DueEvent], None]] = []
+        self.wakeup = asyncio.Event()
+        self.events = 0
+
+    @classmethod
+    def from_settings(cls, settings: Settings, session_factories: list[sessionmaker]) -> "DueScheduler":
+        if settings.todo_due_max_entries < 1 or settings.todo_due_refresh_seconds <= 0:
+            raise ValueError("TODO_DUE_MAX_ENTRIES must be at least 1 and TODO_DUE_REFRESH_SECONDS positive")
+        return cls(session_factories, settings.todo_due_window_seconds, settings.todo_due_max_entries,
+                   settings.todo_due_refresh_seconds)
+
+    def subscribe(self, listener: Callable[[DueEvent], None]):
+        self.listeners.append(listener)
+
+    def notify_due(self, due_at: datetime | None):
+        # After the commit of a todo with a due date. The heap only changes with the next scan (every scheduled todo
+        # is read from the index, so a todo that moved out of the window is not kept)
+        if due_at is None or self.horizon is None or utc(due_at) > self.horizon:
+            return
+        soon = datetime.now(timezone.utc) + timedelta(seconds=RESCAN_DELAY_SECONDS)
+        if self.next_scan_at is None or soon < self.next_scan_at:
+            self.next_scan_at = soon
+            self.wakeup.set()
+
+    def scan(self, now: datetime, after: tuple[datetime, int]) -> tuple[list[tuple[datetime, int, int]], tuple | None]:
+        # The whole window, again: from <after> to now + window. With more than max_entries rows in a database, the
+        # window ends at its last loaded row (returned: the next scan resumes after it, once the heap is empty)
+        horizon = now + self.window
+        entries, last_loaded = [], None
+        for index, session_factory in enumerate(self.session_factories):
+            with session_factory() as db_session:
+                rows = pending_due(db_session, after, horizon, self.max_entries)
+            if len(rows) == self.max_entries:
+                last_loaded = min(last_loaded or rows[-1], rows[-1])
+            entries += [(due_at, todo_id, index) for due_at, todo_id in rows]
+        if last_loaded is not None:
+            entries = [entry for entry in entries if entry[:2] <= last_loaded]
+        return entries, last_loaded
+
+    def load(self, now: datetime, entries: list[tuple[datetime, int, int]], last_loaded: tuple | None):
+        # The heap is replaced by the result of the scan: the todos that left the window (or changed) are gone
+        self.emitted = {(todo_id, due_at) for todo_id, due_at in self.emitted if due_at > now - self.refresh}
+        self.heap = [entry for entry in entries if (entry[1], entry[0]) not in self.emitted]
+        heapq.heapify(self.heap)
+        self.last_loaded = last_loaded
+        self.horizon = now + self.window if last_loaded is None else last_loaded[0]
+        self.next_scan_at = min(now + self.refresh, self.horizon)
+
+    def pop_due(self, now: datetime) -> dict[int, list[tuple[datetime, int]]]:
+        # The entries whose time has come, by session factory
+        due: dict[int, list[tuple[datetime, int]]] = {}
+        while self.heap and self.heap[0][0] <= now:
+            due_at, todo_id, index = heapq.heappop(self.heap)
+            if (todo_id, due_at) not in self.emitted:
+                due.setdefault(index, []).append((due_at, todo_id))
+        return due
+
+    def check_due(self, due: dict[int, list[tuple[datetime, int]]]) -> list[DueEvent]:
+        events = []
+        for index, entries in due.items():
+            with self.session_factories[index]() as db_session:
+                events += still_due(db_session, entries)
+        return sorted(events, key=lambda event: (event.due_at, event.todo_id))
+
+    def emit(self, events: list[DueEvent]):
+        for event in events:
+            if (event.todo_id, event.due_at) in self.emitted:
+                continue
+            self.emitted.add((event.todo_id, event.due_at))
+            self.events += 1
+            logger.info("Todo due", extra={"fields": {"todo_id": event.todo_id, "owner_id": event.owner_id,
+                                                      "due_at": event.due_at.isoformat()}})
+            for listener in self.listeners:
+                try:
+                    listener(event)
+                except Exception:
+                    logs.error_logger.exception("Due event listener error")
+
+    async def tick(self):
+        # One step of run(): scan if needed, emit the due events. Returns the seconds until the next step
+        now = datetime.now(timezone.utc)
+        if self.next_scan_at is None or now >= self.next_scan_at:
+            after = (now - self.refresh, 0)
+            if self.last_loaded is not None and not self.heap:
+                # More todos due than max_entries: the rows after the last loaded one
+                after = max(after, self.last_loaded)
+            # The sessions are synchronous: the database work runs in a thread, the heap is only touched in the loop
+            self.load(now, *await asyncio.to_thread(self.scan, now, after))
+        due = self.pop_due(now)
+        if due:
+            self.emit(await asyncio.to_thread(self.check_due, due))
+        next_at = min(self.heap[0][0], self.next_scan_at) if self.heap else self.next_scan_at
+        return max(0.0, (next_at - datetime.now(timezone.utc)).total_seconds())
+
+    async def run(self):
+        while True:
+            # Cleared before the step: a notify_due during the step wakes the next wait up
+            self.wakeup.clear()
+            try:
+                delay = await self.tick()
+            except Exception:
+                logs.error_logger.exception("Due scheduler error")
+                delay = self.refresh.total_seconds()
+                self.next_scan_at = None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+def notify_due(request: Request, due_at: datetime | None):
+    # Called by the todo routes after their commit
+    scheduler: DueScheduler | None = request.app.state.due_scheduler
+    if scheduler is not None:
+        scheduler.notify_due(due_at)
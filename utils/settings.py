@@ -0,0 +1,95 @@
+import os
+from typing import Literal
+from pydantic import BaseModel
+
+# Environment variables whose name is not the upper-cased field name
+ENV_NAMES = {
+    "database_uri": "POSTGRESQL_DB_URI",
+}
+
+
+class Settings(BaseModel):
+    """
+    Configuration of ONE application instance (see create_app in main.py).
+    Parsed and validated once, instead of calling os.getenv all over the code at import time.
+    """
+    database_uri: str
+    # Connection pool of EACH engine (primary, every replica and shard), in each worker process (see database/db.py).
+    # db_max_connections > 0: the connections that the app may open on a database server, shared by all the workers
+    # of serve.py, which lowers the pools so that they stay under it (the other clients of the server are not counted)
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout_seconds: float = 30
+    db_max_connections: int = 0
+    # Read replicas (comma separated URIs). Read-only dependencies are routed to them (see database/db.py)
+    read_replica_uris: str = ""
+    replica_routing: Literal["round_robin", "least_connections"] = "round_robin"
+    read_your_writes_seconds: float = 5
+    # Todos shards (comma separated <name>=<uri>). Empty: the todos are stored in the primary (see database/shards.py)
+    todo_shards: str = ""
+    shard_placement_cache_seconds: float = 5
+    # JWTs (see utils/keyring.py)
+    secret_key: str | None = None
+    algorithm: str = "HS256"
+    jwt_keys: str = ""
+    # Caches
+    user_profile_cache_seconds: float = 0
+    denylist_sync_seconds: float = 1
+    # Identical concurrent reads share one query (see utils/single_flight.py)
+    single_flight_reads: bool = True
+    # Group commit of the todo inserts (see utils/group_commit.py)
+    todo_group_commit: bool = False
+    todo_group_commit_max_rows: int = 100
+    todo_group_commit_max_delay_ms: float = 5
+    # Idempotency-Key header (see utils/idempotency.py)
+    idempotency_key_ttl_seconds: float = 86400
+    idempotency_wait_seconds: float = 10
+    # Password hashing policy (see utils/passwords.py). Tune it with: python -m utils.passwords --target-ms 250
+    password_scheme: Literal["bcrypt", "argon2"] = "bcrypt"
+    bcrypt_rounds: int = 12
+    argon2_time_cost: int = 3
+    argon2_memory_cost: int = 65536
+    argon2_parallelism: int = 4
+    # Processes that hash the passwords of the bulk user import. 0: one per CPU (see utils/bulk_users.py)
+    password_hash_workers: int = 0
+    # Todos archival job (see utils/archiver.py)
+    todos_archive_after_days: float = 0
+    todos_archive_batch_size: int = 1000
+    todos_archive_interval_seconds: float = 3600
+    # Rebalance job of the manual ordering (see utils/ranks.py). 0: disabled (python -m utils.ranks does it once)
+    todo_position_rebalance_seconds: float = 300
+    # Due-time scheduler (see utils/scheduler.py). Window: how far ahead the heap is loaded, 0: disabled.
+    # At most max_entries todos per database in the heap; the window is scanned again every refresh_seconds
+    todo_due_window_seconds: float = 300
+    todo_due_max_entries: int = 10000
+    todo_due_refresh_seconds: float = 10
+    # Todo quotas (see utils/quotas.py). 0: unlimited. Per role: comma separated <role>=<max todos>:<writes per minute>
+    todo_quota_max_todos: int = 0
+    todo_quota_writes_per_minute: int = 0
+    todo_quota_roles: str = ""
+    # How long a worker trusts its cached todo counts and per-user quotas
+    todo_quota_cache_seconds: float = 60
+    # JSON logs (see utils/logs.py). log_file empty: stdout
+    log_level: str = "INFO"
+    log_file: str = ""
+    access_log: bool = True
+    # Successful requests of these routes are logged with this probability (comma separated <METHOD> <route>=<rate>)
+    access_log_sampling: str = "GET /todo/=0.1,GET /todo/changes=0.1"
+    # Slower requests are always logged
+    access_log_slow_ms: float = 1000
+    # Base.metadata.create_all at startup. Disabled when the schema is managed by Alembic only
+    create_tables: bool = True
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        # Getting variables from .env file (they don't override the variables that are already set)
+        # Imported here, so the apps that receive their Settings directly never import python-dotenv
+        from dotenv import load_dotenv
+        load_dotenv()
+        values = {}
+        for field in cls.model_fields:
+            value = os.getenv(ENV_NAMES.get(field, field.upper()))
+            if value is not None:
+                values[field] = value
+        # Pydantic converts the strings to the type of each field
+        return cls(**values)
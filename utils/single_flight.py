@@ -0,0 +1,68 @@
+import asyncio
+from typing import Callable, Hashable
+from fastapi import Request
+
+"""
+SINGLE-FLIGHT (request coalescing) for read-only queries
+Several tabs of the same user, or the refresh-then-retry logic of the frontend, send bursts of identical reads
+(GET /todo/, GET /user/) within milliseconds. Instead of running the same query N times:
+- The first request (leader) runs the query in a thread, the event loop stays free
+- Identical requests that arrive while it is running (followers) wait for the SAME call and get its result
+- The result is the serialized data (dicts, not ORM objects), so it can be shared by requests with different sessions
+- Keys start with the owner id. The writes of an owner "forget" its in-flight keys, so a read that starts after a
+  write never joins a query that may have started before it
+The counters (calls executed, calls collapsed) are exposed in GET /admin/single-flight.
+"""
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.collapsed = 0
+
+    async def do(self, key: Hashable, function: Callable[[], object]):
+        future = self._calls.get(key)
+        if future is not None:
+            self.collapsed += 1
+            # shield: a follower that is cancelled (client disconnected) does not cancel the call of the others
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        self.calls += 1
+        try:
+            result = await asyncio.to_thread(function)
+        except BaseException as err:
+            # The followers get the same error (or a new attempt, if the leader was cancelled)
+            future.set_exception(err if isinstance(err, Exception) else RuntimeError("The coalesced call was cancelled"))
+            future.exception() # Marking the exception as retrieved, in case there are no followers
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def forget_owner(self, owner_id: int):
+        for key in [key for key in self._calls if key[0] == owner_id]:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "collapsed": self.collapsed, "in_flight": len(self._calls)}
+
+
+# Helpers used by the routers. Without single-flight (Settings.single_flight_reads=False), the query runs directly
+async def coalesce(request: Request, key: tuple, function: Callable[[], object]):
+    flights: SingleFlight | None = request.app.state.single_flight
+    if flights is None:
+        return function()
+    # Requests that must read from the primary (read-your-writes, see database/db.py) do not share the replica reads
+    return await flights.do((*key, request.app.state.db_router.is_sticky(request)), function)
+
+
+def forget_owner(request: Request, owner_id: int):
+    flights: SingleFlight | None = request.app.state.single_flight
+    if flights is not None:
+        flights.forget_owner(owner_id)
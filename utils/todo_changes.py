@@ -0,0 +1,112 @@
+import heapq
+from itertools import islice
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from database import models
+
+"""
+DELTA SYNC OF TODOS (GET /todo/changes?since=<token>)
+Clients that keep a local copy of their todos (e.g. IndexedDB) ask only for what changed since their last sync:
+- Every owner has a change counter (todo_change_counters). Each create, update, delete (and archival) of a todo takes
+  the next number of its owner and stores it in the todo (change_seq), IN THE SAME TRANSACTION as the change
+- The counter row is locked until the commit, so the changes of an owner are committed in the order of their numbers
+- Deletes are soft (deleted_at), so a deleted todo is its own tombstone. Archived todos (utils/archiver.py) get a new
+  number in todos_archive, they left GET /todo/ too
+- since=0 (first sync) returns the live todos, <limit> at a time. The response has the token of the next sync, the
+  owner's counter (or, while has_more is true, the change_seq of the last todo of the page)
+Both tables are indexed by (owner_id, change_seq): a sync reads O(changes) rows, not O(todos).
+"""
+
+DEFAULT_PAGE_SIZE = 500
+
+
+def reserve(db_session: Session, owner_id: int, count: int = 1) -> int:
+    # First of <count> new consecutive change numbers of the owner. The counter row stays locked until the commit
+    counters = models.TodoChangeCounters
+    last_seq = db_session.scalar(
+        update(counters).where(counters.owner_id == owner_id)
+        .values(last_seq=counters.last_seq + count)
+        .returning(counters.last_seq)
+    )
+    if last_seq is not None:
+        return last_seq - count + 1
+    try:
+        # First change of the owner. SAVEPOINT: losing the race must not roll back the rest of the transaction
+        with db_session.begin_nested():
+            db_session.execute(insert(counters).values(owner_id=owner_id, last_seq=count))
+        return 1
+    except IntegrityError:
+        return reserve(db_session, owner_id, count)
+
+
+def next_seq(db_session: Session, owner_id: int) -> int:
+    return reserve(db_session, owner_id)
+
+
+def lock_owner(db_session: Session, owner_id: int):
+    # Only the lock of the counter (no new number): serializes with the changes of the owner until the commit
+    reserve(db_session, owner_id, 0)
+
+
+def number_changes(db_session: Session, rows: list[dict]):
+    # Sets the "change_seq" of each row (dicts with "owner_id"), one counter update per owner.
+    # The owners are always locked in the same order, so two batches can not deadlock on their counters
+    rows_by_owner: dict[int, list[dict]] = {}
+    for row in rows:
+        rows_by_owner.setdefault(row["owner_id"], []).append(row)
+    for owner_id in sorted(rows_by_owner):
+        first = reserve(db_session, owner_id, len(rows_by_owner[owner_id]))
+        for offset, row in enumerate(rows_by_owner[owner_id]):
+            row["change_seq"] = first + offset
+
+
+def current_token(db_session: Session, owner_id: int) -> int:
+    counters = models.TodoChangeCounters
+    return db_session.scalar(select(counters.last_seq).where(counters.owner_id == owner_id)) or 0
+
+
+def read_changes(db_session: Session, owner_id: int, since: int, limit: int = DEFAULT_PAGE_SIZE) -> dict:
+    # The counter is read BEFORE the todos. A change committed in between has a higher number: it is left for the next sync
+    token = current_token(db_session, owner_id)
+    if 0 < since and token <= since:
+        # Nothing new. (A token AHEAD of the counter was given by the primary, and this is a read replica that is behind)
+        return {"changes": [], "deleted": [], "token": since, "has_more": False}
+    if since == 0:
+        # The live todos, paged by (change_seq, id) like the changes: the token of a page is its last change_seq, and the
+        # next page (since=<token>) is a delta. It has the rest of the todos, with the tombstones of that range
+        todos = (db_session.query(models.Todos)
+                 .filter(models.Todos.owner_id == owner_id, models.Todos.change_seq <= token, models.Todos.deleted_at.is_(None))
+                 .order_by(models.Todos.change_seq, models.Todos.id)
+                 .limit(limit + 1)
+                 .all())
+        has_more = len(todos) > limit
+        todos = todos[:limit]
+        return {"changes": [models.TodoResponse.model_validate(todo).model_dump() for todo in todos], "deleted": [],
+                "token": todos[-1].change_seq if has_more else token, "has_more": has_more}
+
+    live = (db_session.query(models.Todos)
+            .filter(models.Todos.owner_id == owner_id, models.Todos.change_seq > since, models.Todos.change_seq <= token)
+            .order_by(models.Todos.change_seq)
+            .limit(limit + 1)
+            .all())
+    archived = db_session.execute(
+        select(models.TodosArchive.id, models.TodosArchive.change_seq)
+        .where(models.TodosArchive.owner_id == owner_id, models.TodosArchive.change_seq > since,
+               models.TodosArchive.change_seq <= token)
+        .order_by(models.TodosArchive.change_seq)
+        .limit(limit + 1)
+    ).all()
+
+    # Both lists are ordered by change_seq: their first <limit> changes, merged, are the first <limit> changes of the owner
+    page = list(islice(heapq.merge(live, archived, key=lambda todo: todo.change_seq), limit + 1))
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    changes, deleted = [], []
+    for todo in page:
+        if isinstance(todo, models.Todos) and todo.deleted_at is None:
+            changes.append(models.TodoResponse.model_validate(todo).model_dump())
+        else:
+            deleted.append(todo.id)
+    return {"changes": changes, "deleted": deleted, "token": page[-1].change_seq if has_more else token, "has_more": has_more}
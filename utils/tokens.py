@@ -1,15 +1,16 @@
-import os, uuid, jwt
+import uuid, jwt
 from typing import Annotated, Union
 from datetime import timedelta, datetime, timezone
 from fastapi import HTTPException, status, Depends, Cookie, Response
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from database import db, models
+from utils.keyring import KeyRing, keyring_dependency
+from utils.denylist import AccessTokenDenylist, denylist_dependency
+from utils import logs
 
-# Variables for JWTs creation
-# openssl rand -hex 32 | pbcopy
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
+# Keys for JWTs creation are managed by the keyring (see utils/keyring.py)
+# SECRET_KEY (HS256 fallback): openssl rand -hex 32 | pbcopy
 
 # Routes for ACCESS TOKENS and REFRESH TOKENS
 PREFIX = "/auth"
@@ -26,80 +27,127 @@ db_dependency: type[Session] = Annotated[Session, Depends(db.get_db)]
 # The tokenUrl specifies the endpoint where the client should send the username and password to obtain an access token.
 # When a user interacts with the Swagger UI and enters their credentials, the OAuth2PasswordBearer logic uses this tokenUrl to send a POST request with those credentials to that specific endpoint to retrieve the bearer token.
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl=PREFIX+TOKEN_URL, refreshUrl=PREFIX+REFRESH_URL)
+# auto_error=False: if the Authorization header is missing, the token is None instead of a 401 response
+optional_oauth2_bearer = OAuth2PasswordBearer(tokenUrl=PREFIX+TOKEN_URL, refreshUrl=PREFIX+REFRESH_URL, auto_error=False)
 
 
-def add_jwt_to_db(token: str, user_data: dict, expires_at: datetime, db_session: Session):
-    new_token = models.RefreshTokens(
+def add_jwt_to_db(jti: uuid.UUID, family_id: uuid.UUID, user_data: dict, expires_at: datetime, db_session: Session):
+    # A new session (refresh token family) starts with its first refresh token
+    new_family = models.RefreshTokens(
+        family_id=family_id,
         user_id=user_data.get('user_id'),
-        refresh_token=token,
+        jti=jti,
+        created_at=datetime.now(timezone.utc),
         expires_at=expires_at, # Is recommended to execute clean-up scripts to delete expired refresh tokens from the database
     )
-    db_session.add(new_token)
+    db_session.add(new_family)
     db_session.commit()
 
 
-def delete_jwt_from_db(db_session: Session, token: str = "", token_model: type[models.RefreshTokens] | None = None):
-    if token != "":
-        token_model = db_session.query(models.RefreshTokens).filter(models.RefreshTokens.refresh_token == token).first()
+def rotate_jwt_in_db(family_id: uuid.UUID, previous_jti: uuid.UUID, jti: uuid.UUID, db_session: Session) -> bool:
+    # Compare-and-swap: the jti is only replaced if the previous refresh token is still the current one of its family.
+    # If two requests use the same refresh token concurrently, only one of them is able to rotate it
+    updated_rows = (db_session.query(models.RefreshTokens)
+                    .filter(models.RefreshTokens.family_id == family_id, models.RefreshTokens.jti == previous_jti)
+                    .update({models.RefreshTokens.jti: jti, models.RefreshTokens.rotated_at: datetime.now(timezone.utc)},
+                            synchronize_session=False))
+    db_session.commit()
+    return updated_rows == 1
+
+
+def revoke_token_family(db_session: Session, family_id: uuid.UUID):
+    # Every refresh token of the session (the current one and the ones already used) becomes invalid
+    (db_session.query(models.RefreshTokens)
+     .filter(models.RefreshTokens.family_id == family_id)
+     .delete(synchronize_session=False))
+    db_session.commit()
+
 
-    if token_model is not None:
-        db_session.delete(token_model)
-        db_session.commit()
+def revoke_user_sessions(db_session: Session, user_id: int) -> int:
+    # "Logout from all devices"
+    deleted_rows = (db_session.query(models.RefreshTokens)
+                    .filter(models.RefreshTokens.user_id == user_id)
+                    .delete(synchronize_session=False))
+    db_session.commit()
+    return deleted_rows
 
 
-def is_valid_refresh_token(refresh_token: str, user_id: int, db_session: Session) -> type[models.RefreshTokens] | None:
-    # Making sure that the refresh token is not blacklisted (if a token is blacklisted, it is not going to be found on the database)
-    # The expiration time is validated before this point
-    user_tokens: list[type[models.RefreshTokens]] = (db_session.query(models.RefreshTokens)
-                                                     .filter(models.RefreshTokens.user_id == user_id)
-                                                     .all())
-    for user_token in user_tokens:
-        if user_token.refresh_token == refresh_token:
-            return user_token
-    return None
+def get_token_ids(payload: dict) -> tuple[uuid.UUID, uuid.UUID] | None:
+    # Returns the (family_id, jti) of a refresh token payload, or None if the claims are missing/malformed
+    try:
+        return uuid.UUID(payload.get('fid')), uuid.UUID(payload.get('jti'))
+    except (TypeError, ValueError):
+        return None
+
+
+def delete_jwt_from_db(db_session: Session, token: str, keyring: KeyRing):
+    # Revoking the session of a refresh token, even if it is already expired
+    try:
+        payload = keyring.decode(token, options={'verify_exp': False})
+    except jwt.PyJWTError:
+        return
+
+    token_ids = get_token_ids(payload)
+    if payload.get('refresh') is True and token_ids is not None:
+        revoke_token_family(db_session, token_ids[0])
 
 
-def create_jwt(db_session: Session, user_data: dict, expires_delta: timedelta = None, is_refresh_token: bool = False, previous_expiry: datetime = None) -> str | tuple[str, datetime]:
+def create_jwt(db_session: Session, keyring: KeyRing, user_data: dict, expires_delta: timedelta = None, is_refresh_token: bool = False,
+               previous_expiry: datetime = None, previous_payload: dict = None) -> str | tuple[str, datetime]:
     # Scenarios for JWTs creation:
     # 1. Access token..........: expires_delta:timedelta
     # 2. First refresh token...: expires_delta:timedelta, is_refresh_token=True
-    # 3. Refresh token rotation: previous_expiry:timedelta, is_refresh_token=True
+    # 3. Refresh token rotation: previous_expiry:timedelta, is_refresh_token=True, previous_payload:dict (same family)
     if (expires_delta is None and previous_expiry is None) or \
        (expires_delta is not None and previous_expiry is not None) or \
-       (expires_delta is None and is_refresh_token is False):
+       (expires_delta is None and is_refresh_token is False) or \
+       (previous_expiry is not None and previous_payload is None):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Invalid JTW creation")
 
     # Preventing refresh token's lifetime extension beyond the lifetime of the initial refresh token
     exp: datetime = datetime.now(timezone.utc) + expires_delta if previous_expiry is None else previous_expiry
 
+    jti = uuid.uuid4() # Universally Unique Identifier (UUID, 128-bit)
+
     # JWT PAYLOAD
     to_encode = {
         # Registered Claims
-        'jti': str(uuid.uuid4()), # Universally Unique Identifier (UUID, 128-bit)
+        'jti': str(jti),
         'sub': user_data.get('username', ''),
         'exp': exp,
         # Custom Claims
         'refresh': is_refresh_token,
         'user': user_data,
     }
-    
-    new_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-    # Adding refresh token to database
-    if is_refresh_token:
-        add_jwt_to_db(token=new_jwt, user_data=user_data, expires_at=to_encode.get('exp'), db_session=db_session)
-        # Returning the RT and its expiration datetime, in order to add it to the http-only cookie
-        return new_jwt, exp
+    if not is_refresh_token:
+        # Signed with the active key of the keyring. Asymmetric keys add the 'kid' header
+        return keyring.encode(to_encode)
+
+    # Refresh tokens belong to a family (session). A rotated refresh token keeps the family of the previous one
+    if previous_payload is None:
+        family_id = uuid.uuid4()
+        add_jwt_to_db(jti=jti, family_id=family_id, user_data=user_data, expires_at=exp, db_session=db_session)
+    else:
+        family_id, previous_jti = get_token_ids(previous_payload)
+        if not rotate_jwt_in_db(family_id=family_id, previous_jti=previous_jti, jti=jti, db_session=db_session):
+            # The previous refresh token was already rotated by another request: treated as a reuse
+            revoke_token_family(db_session, family_id)
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="An invalid refresh token was provided")
+
+    to_encode['fid'] = str(family_id)
+    new_jwt = keyring.encode(to_encode)
 
-    return new_jwt
+    # Returning the RT and its expiration datetime, in order to add it to the http-only cookie
+    return new_jwt, exp
 
 
-def get_payload_from_jwt(token: str, db_session: Session) -> dict:
+def get_payload_from_jwt(token: str, db_session: Session, keyring: KeyRing) -> dict:
     try:
-        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        return keyring.decode(token)
     except jwt.ExpiredSignatureError: # ExpiredSignatureError < DecodeError < InvalidTokenError < PyJWTError
-        # If a refresh_token expires, it must be deleted from the database
-        delete_jwt_from_db(db_session=db_session, token=token)
+        # If a refresh_token expires, its session must be deleted from the database
+        delete_jwt_from_db(db_session=db_session, token=token, keyring=keyring)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate token.")
     except jwt.PyJWTError as err: # PyJWTError < Exception
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Could not validate token. Error: {str(err)}")
@@ -108,10 +156,11 @@ def get_payload_from_jwt(token: str, db_session: Session) -> dict:
 
 
 # Annotated[str, Depends(oauth2_bearer)] tells the application to get the token in the Authorization: Bearer <token> header
-async def get_logged_in_user(access_token: Annotated[str, Depends(oauth2_bearer)], db_session: db_dependency):
+async def get_logged_in_user(access_token: Annotated[str, Depends(oauth2_bearer)], db_session: db_dependency,
+                             keyring: keyring_dependency, denylist: denylist_dependency):
     # Making sure that the token is a valid JWT
     try:
-        payload = get_payload_from_jwt(access_token, db_session)
+        payload = get_payload_from_jwt(access_token, db_session, keyring)
     except Exception:
         raise
 
@@ -123,6 +172,12 @@ async def get_logged_in_user(access_token: Annotated[str, Depends(oauth2_bearer)
     if user_data is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
 
+    # Making sure that the access token was not revoked (logout). In-memory lookup, see utils/denylist.py
+    if denylist.is_revoked(payload.get('jti'), db_session):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+
+    # The access log line of the request (see utils/logs.py) gets the user id
+    logs.annotate(user_id=user_data.get('user_id'))
     return {
         'username': payload.get('sub'),
         'user_id': user_data.get('user_id'),
@@ -130,17 +185,30 @@ async def get_logged_in_user(access_token: Annotated[str, Depends(oauth2_bearer)
     }
 
 
+def revoke_access_token(access_token: str | None, db_session: Session, keyring: KeyRing, denylist: AccessTokenDenylist):
+    # Adding the access token to the denylist, until it expires. Invalid or expired tokens are ignored
+    if access_token is None:
+        return
+    try:
+        payload = keyring.decode(access_token)
+    except jwt.PyJWTError:
+        return
+    if payload.get('refresh') is False and payload.get('jti') is not None:
+        denylist.revoke([(payload.get('jti'), payload.get('exp'))], db_session)
+
+
 # refresh_token: Annotated[Union[str, None], Cookie()] = None
 #   - Reads a cookie named 'refresh_token' from the request
 #   - If the cookie is not present, refresh_token will be None
-async def get_payload_from_refresh_token(response: Response, db_session: db_dependency, refresh_token: Annotated[Union[str, None], Cookie()] = None):
+async def get_payload_from_refresh_token(response: Response, db_session: db_dependency, keyring: keyring_dependency,
+                                         refresh_token: Annotated[Union[str, None], Cookie()] = None):
     # Making sure that the 'refresh_token' cookie exists
     if refresh_token is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
 
     # Making sure that the token is a valid JWT
     try:
-        payload = get_payload_from_jwt(refresh_token, db_session)
+        payload = get_payload_from_jwt(refresh_token, db_session, keyring)
     except Exception:
         raise
 
@@ -152,21 +220,30 @@ async def get_payload_from_refresh_token(response: Response, db_session: db_depe
     if user_data is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
 
-    rt_object = is_valid_refresh_token(refresh_token, user_data.get('user_id'), db_session)
-
-    if rt_object is not None:
-        # Invalidating the used refresh token by deleting it from the database
-        delete_jwt_from_db(db_session=db_session, token_model=rt_object)
+    token_ids = get_token_ids(payload)
+    rt_object: models.RefreshTokens | None = None
+    if token_ids is not None:
+        # Primary key lookup of the session
+        rt_object = db_session.get(models.RefreshTokens, token_ids[0])
 
+    if rt_object is not None and rt_object.jti == token_ids[1]:
+        # The refresh token is the current one of its session. Its rotation (or its revocation on logout) is done by the route
         # TIMESTAMP is decoded as int, so we are changing it to datetime by getting it directly from the refresh token object
         # This expires_at claim will be used to rotate the refresh token with the same expiration time
-        payload['exp'] = rt_object.expires_at
+        # Backends without timezone support (e.g. SQLite) return a naive datetime, that was stored in UTC
+        expires_at: datetime = rt_object.expires_at
+        payload['exp'] = expires_at if expires_at.tzinfo is not None else expires_at.replace(tzinfo=timezone.utc)
         return payload
 
+    if rt_object is not None:
+        # REUSE DETECTION: a refresh token that was already rotated was presented again.
+        # Either the legitimate user or an attacker holds a stolen token, so the whole session is revoked
+        revoke_token_family(db_session, rt_object.family_id)
+
     # At this point:
     # - A valid REFRESH TOKEN was received from the 'refresh_token' cookie
-    # - The token is not listed as a valid JWT in our database (rt_object is None)
-    # - This could happen if we explicitly delete a refresh token to invalidate it
+    # - The token is not the current one of a session in our database (revoked, logged out or reused)
+    # - This could happen if we explicitly delete a refresh token family to invalidate it
     # - Deleting the http-only cookie:
     response.delete_cookie(key='refresh_token', path="/")
 
@@ -0,0 +1,58 @@
+from typing import Annotated
+from fastapi import Depends, HTTPException, Request, status
+from sqlalchemy.orm import Session
+from database import db, models
+from utils.cache import TTLCache
+from utils.single_flight import coalesce, forget_owner
+from utils.tokens import get_logged_in_user
+
+# The profile is read-only: it may come from a read replica (see database/db.py)
+read_db_dependency: type[Session] = Annotated[Session, Depends(db.get_read_db)]
+user_dependency: type[dict] = Annotated[dict, Depends(get_logged_in_user)]
+
+# Non-sensitive profile fields. hashed_password is NEVER part of the profile (nor of the cache)
+PROFILE_COLUMNS = (
+    models.Users.id,
+    models.Users.username,
+    models.Users.email,
+    models.Users.first_name,
+    models.Users.last_name,
+    models.Users.role,
+    models.Users.is_active,
+    models.Users.phone_number,
+)
+
+# Optional per-process cache of user profiles, disabled by default (Settings.user_profile_cache_seconds=0)
+# Entries are invalidated by the /user/ endpoints that modify the user, but other workers keep their copy until it
+# expires, so the TTL should be kept short (a few seconds). One cache per application instance: app.state.profile_cache
+
+
+# FastAPI caches the value of a dependency during a request (use_cache=True by default), so every route parameter
+# or sub-dependency that uses profile_dependency shares the same SELECT (at most one per request)
+async def get_user_profile(request: Request, user_data: user_dependency, db_session: read_db_dependency) -> dict:
+    user_id = user_data.get("user_id")
+    profile_cache: TTLCache = request.app.state.profile_cache
+
+    def query_profile() -> dict | None:
+        # Selecting only the profile columns, instead of the whole Users entity
+        row = db_session.query(*PROFILE_COLUMNS).filter(models.Users.id == user_id).first()
+        return None if row is None else dict(row._mapping)
+
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        # SINGLE-FLIGHT: concurrent cache misses of the same user share one query (see utils/single_flight.py)
+        profile = await coalesce(request, (user_id, "profile"), query_profile)
+        if profile is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        profile_cache.set(user_id, profile)
+
+    # Returning a copy, so the cached profile cannot be modified by the route handler
+    return dict(profile)
+
+
+def invalidate_user_profile(request: Request, user_id: int):
+    request.app.state.profile_cache.delete(user_id)
+    forget_owner(request, user_id)
+
+
+profile_dependency: type[dict] = Annotated[dict, Depends(get_user_profile)]